@@ -0,0 +1,131 @@
+# Shared helpers for the benchmark scripts in backend/bench.
+# Every script starts a real server from backend/src in a subprocess and talks
+# to it over localhost, so no external services are needed.
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCH_DIR), "src")
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+HOST = "127.0.0.1"
+decoder = json.JSONDecoder()
+
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind((HOST, 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def raise_nofile_limit():
+    try:
+        import resource
+
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        return hard
+    except (ImportError, ValueError, OSError):
+        return None
+
+
+def start_server(port, *args, timeout=10.0, rate_limit=False):
+    """Run backend/src/main.py on localhost and wait until it accepts.
+
+    Per-user rate limits are off unless `rate_limit`: the benchmarks push
+    one client as hard as it goes on purpose.
+    """
+    if rate_limit:
+        args = ("--rate-limit", *args)
+    proc = subprocess.Popen(
+        [sys.executable, "main.py", "--host", HOST, "--port", str(port), *args],
+        cwd=SRC_DIR,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((HOST, port), timeout=0.2).close()
+            return proc
+        except OSError:
+            time.sleep(0.05)
+    proc.kill()
+    raise RuntimeError(f"server {args} did not start on port {port}")
+
+
+def stop_server(proc):
+    proc.terminate()
+    try:
+        proc.wait(timeout=5)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+
+
+def rss_bytes(pid):
+    """Resident set size of `pid` (Linux /proc), or None if unavailable"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def cpu_seconds(pid):
+    """user+system CPU time consumed by `pid` (Linux /proc), or None"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        ticks = os.sysconf("SC_CLK_TCK")
+        return (int(fields[11]) + int(fields[12])) / ticks
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+    return values[k]
+
+
+class JsonStream:
+    """Incremental decoder for concatenated JSON that keeps partial objects"""
+
+    def __init__(self):
+        self.buffer = ""
+
+    def feed(self, data):
+        self.buffer += data.decode()
+        out = []
+        while self.buffer:
+            try:
+                obj, idx = decoder.raw_decode(self.buffer)
+            except json.JSONDecodeError:
+                break
+            out.append(obj)
+            self.buffer = self.buffer[idx:].lstrip()
+        return out
+
+
+def print_table(headers, rows):
+    widths = [
+        max(len(str(h)), *(len(str(r[i])) for r in rows)) for i, h in enumerate(headers)
+    ]
+    line = "  ".join(str(h).ljust(w) for h, w in zip(headers, widths))
+    print(line)
+    print("-" * len(line))
+    for r in rows:
+        print("  ".join(str(c).ljust(w) for c, w in zip(r, widths)))
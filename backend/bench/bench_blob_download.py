@@ -0,0 +1,150 @@
+"""Compare attachment download paths: JSON FILE relay vs. blob store ranges.
+
+    python backend/bench/bench_blob_download.py --size-mb 32 --rounds 5
+
+For each server mode one receiver downloads the same file --rounds times:
+- json-relay: a sender posts it as one base64 FILE message and the server
+  re-encodes and relays it (what every client did before the blob store)
+- blob-get: the file is already in the blob store; the receiver pulls it with
+  pipelined BLOB_GET ranges, which the server answers with os.sendfile
+
+Reported: MB/s at the receiver and server CPU seconds per GB delivered.
+"""
+
+import argparse
+import base64
+import hashlib
+import os
+import shutil
+import socket
+import tempfile
+import time
+
+from _common import HOST, cpu_seconds, free_port, print_table, start_server, stop_server
+from models import BlobStore
+from utils import FRAMING_LENGTH, StreamDecoder, encode_message
+
+
+class Client:
+    def __init__(self, port, username, **login):
+        self.sock = socket.create_connection((HOST, port))
+        self.decoder = StreamDecoder()
+        self.framing = "json"
+        self.send({"type": "LOGIN", "username": username, "display_name": username, **login})
+        ok = self.wait("LOGIN_OK")
+        self.framing = ok.get("framing", "json")
+        self.decoder.mode = self.framing
+
+    def send(self, payload):
+        self.sock.sendall(encode_message(payload, self.framing))
+
+    def messages(self):
+        while True:
+            yield from self.decoder  # whatever a previous wait() left buffered
+            data = self.sock.recv(1024 * 1024)
+            if not data:
+                raise ConnectionError("server closed the connection")
+            self.decoder.feed(data)
+
+    def wait(self, msg_type):
+        for msg in self.messages():
+            if msg.get("type") == msg_type:
+                return msg
+
+    def close(self):
+        self.sock.close()
+
+
+def json_relay(port, payload, rounds):
+    sender = Client(port, "sender")
+    receiver = Client(port, "receiver")
+    b64 = base64.b64encode(payload).decode()
+    for _ in range(rounds):
+        sender.send({"type": "FILE", "to": "receiver", "filename": "f.bin", "data": b64})
+        msg = receiver.wait("FILE")
+        assert len(base64.b64decode(msg["data"])) == len(payload)
+    sender.close()
+    receiver.close()
+
+
+def blob_get(port, sha256, size, rounds, range_size, in_flight):
+    receiver = Client(
+        port, "receiver", framing=[FRAMING_LENGTH], files="chunked", blobs=True
+    )
+    for _ in range(rounds):
+        requested = received = 0
+        while requested < size and requested - received < in_flight * range_size:
+            receiver.send(
+                {"type": "BLOB_GET", "sha256": sha256, "offset": requested, "length": range_size}
+            )
+            requested += range_size
+        for msg in receiver.messages():
+            if msg["type"] != "BLOB_DATA":
+                continue
+            received += len(msg["data"])
+            if received >= size:
+                break
+            if requested < size:
+                receiver.send(
+                    {"type": "BLOB_GET", "sha256": sha256, "offset": requested, "length": range_size}
+                )
+                requested += range_size
+    receiver.close()
+
+
+def measure(mode, blob_dir, run, size, rounds):
+    port = free_port()
+    proc = start_server(port, "--mode", mode, "--blob-dir", blob_dir)
+    try:
+        time.sleep(0.2)
+        cpu0 = cpu_seconds(proc.pid)
+        t0 = time.perf_counter()
+        run(port)
+        elapsed = time.perf_counter() - t0
+        cpu = cpu_seconds(proc.pid) - cpu0
+    finally:
+        stop_server(proc)
+    gb = size * rounds / 1e9
+    return f"{size * rounds / 1e6 / elapsed:.0f}", f"{cpu / gb:.2f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=float, default=32)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--modes", nargs="+", default=["threaded", "asyncio"])
+    args = parser.parse_args()
+
+    size = int(args.size_mb * 1024 * 1024)
+    payload = os.urandom(size)
+    sha256 = hashlib.sha256(payload).hexdigest()
+    blob_dir = tempfile.mkdtemp(prefix="bench-blobs-")
+    path = BlobStore(blob_dir).path(sha256)
+    os.makedirs(os.path.dirname(path))
+    with open(path, "wb") as f:
+        f.write(payload)
+
+    cases = [
+        ("json-relay", lambda port: json_relay(port, payload, args.rounds)),
+        (
+            "blob-get 1MiB x4",
+            lambda port: blob_get(port, sha256, size, args.rounds, 1 << 20, 4),
+        ),
+        (
+            "blob-get 16MiB x2",
+            lambda port: blob_get(port, sha256, size, args.rounds, 16 << 20, 2),
+        ),
+    ]
+    rows = []
+    try:
+        for mode in args.modes:
+            for name, run in cases:
+                rows.append((mode, name, *measure(mode, blob_dir, run, size, args.rounds)))
+    finally:
+        shutil.rmtree(blob_dir, ignore_errors=True)
+    print(f"{args.size_mb:g} MB file, {args.rounds} downloads per case")
+    print_table(["mode", "path", "MB/s", "server CPU s/GB"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""Cross-node hop latency in cluster mode (main.py --cluster-listen).
+
+    python backend/bench/bench_cluster.py --pairs 1 16 --duration 5
+
+Starts two nodes on localhost; node A also hosts the built-in presence
+directory. The same MESSAGE ping-pong as bench_server_modes.py then runs
+with both users on node A ("same node") and with one user on each node
+("cross node"), where every leg crosses a node-to-node link. The
+difference in per-leg latency is the cost of the hop.
+"""
+
+import argparse
+import asyncio
+import time
+
+from _common import free_port, percentile, print_table, start_server, stop_server
+from bench_server_modes import login, ping_pong
+
+
+async def measure(port_a, port_b, pairs, duration, prefix):
+    clients = []
+    for i in range(pairs):
+        clients.append(await login(port_a, f"{prefix}a{i}"))
+        clients.append(await login(port_b, f"{prefix}b{i}"))
+    await asyncio.sleep(0.5)  # joins reach the other node's directory view
+    for r, _, s in clients:
+        while True:
+            try:
+                s.feed(await asyncio.wait_for(r.read(65536), 0.01))
+            except asyncio.TimeoutError:
+                break
+    latencies = []
+    deadline = time.perf_counter() + duration
+    t0 = time.perf_counter()
+    counts = await asyncio.gather(
+        *(
+            ping_pong(
+                clients[2 * i],
+                clients[2 * i + 1],
+                f"{prefix}b{i}",
+                f"{prefix}a{i}",
+                deadline,
+                latencies,
+            )
+            for i in range(pairs)
+        )
+    )
+    elapsed = time.perf_counter() - t0
+    for _, w, _ in clients:
+        w.close()
+    return sum(counts) / elapsed, latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--pairs", nargs="+", type=int, default=[1, 16])
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--mode", default="asyncio")
+    args = parser.parse_args()
+
+    directory = f"builtin://127.0.0.1:{free_port()}"
+    port_a, port_b = free_port(), free_port()
+    common = ["--mode", args.mode, "--directory", directory, "--no-inbox"]
+    node_a = start_server(
+        port_a,
+        *common,
+        "--cluster-listen",
+        f"127.0.0.1:{free_port()}",
+        "--directory-serve",
+    )
+    node_b = None
+    rows = []
+    try:
+        node_b = start_server(
+            port_b, *common, "--cluster-listen", f"127.0.0.1:{free_port()}"
+        )
+        time.sleep(0.5)
+        for pairs in args.pairs:
+            for name, other in (("same node", port_a), ("cross node", port_b)):
+                prefix = f"{name[0]}{pairs}"
+                rate, lat = asyncio.run(
+                    measure(port_a, other, pairs, args.duration, prefix)
+                )
+                rows.append(
+                    (
+                        name,
+                        pairs,
+                        f"{rate:,.0f}",
+                        f"{percentile(lat, 50) * 1000:.3f}",
+                        f"{percentile(lat, 99) * 1000:.3f}",
+                    )
+                )
+    finally:
+        stop_server(node_a)
+        if node_b is not None:
+            stop_server(node_b)
+    print(f"{args.mode} nodes on localhost, latency per relayed MESSAGE leg")
+    print_table(["route", "pairs", "msgs/s", "p50 ms", "p99 ms"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""Bytes on the wire and CPU per message type with each compression codec.
+
+    python backend/bench/bench_compression.py --users 500 --file-kb 256
+
+Encodes and decodes typical frames in-process (length framing, no
+threshold) with no codec and with every codec this install supports
+(zlib, plus zstd when the zstandard package is present):
+- MESSAGE: a short chat line
+- RTC_OFFER: a synthetic SDP offer with audio, video and ICE candidates
+- USERS: a roster of --users users
+- FILE text / FILE random: base64 of --file-kb of source code / urandom
+
+For each link speed in --links (Mbit/s) the last columns estimate the time
+to compress, send and decompress one frame, which is what the threshold
+should be tuned against: compression only pays when it saves more send
+time than it costs in CPU.
+"""
+
+import argparse
+import base64
+import glob
+import os
+import time
+
+from _common import SRC_DIR, print_table
+from utils import FRAMING_LENGTH, SUPPORTED_CODECS, StreamDecoder, encode_message
+from utils import framing
+
+
+def sdp_offer():
+    lines = [
+        "v=0",
+        "o=- 4611731400430051336 2 IN IP4 127.0.0.1",
+        "s=-",
+        "t=0 0",
+        "a=group:BUNDLE 0 1",
+        "a=msid-semantic: WMS stream",
+    ]
+    for mid, kind, codecs in (
+        (0, "audio", ["111 opus/48000/2", "103 ISAC/16000", "9 G722/8000"]),
+        (1, "video", ["96 VP8/90000", "98 VP9/90000", "102 H264/90000"]),
+    ):
+        lines += [
+            f"m={kind} 9 UDP/TLS/RTP/SAVPF " + " ".join(c.split()[0] for c in codecs),
+            "c=IN IP4 0.0.0.0",
+            f"a=mid:{mid}",
+            "a=ice-ufrag:EsAw",
+            "a=ice-pwd:P2uYro0UCOQ4zxjKXaWCBui1",
+            "a=fingerprint:sha-256 " + ":".join(["7B"] * 32),
+            "a=setup:actpass",
+            "a=sendrecv",
+            "a=rtcp-mux",
+        ]
+        for c in codecs:
+            pt, name = c.split()
+            lines += [
+                f"a=rtpmap:{pt} {name}",
+                f"a=rtcp-fb:{pt} nack",
+                f"a=rtcp-fb:{pt} transport-cc",
+            ]
+        for i in range(8):
+            lines.append(
+                f"a=candidate:{842163049 + i} 1 udp {2122260223 - i} "
+                f"192.168.1.{10 + i} {50000 + i} typ host generation 0"
+            )
+    return "\r\n".join(lines) + "\r\n"
+
+
+def sample_messages(users, file_kb):
+    source = b""
+    for path in sorted(glob.glob(os.path.join(SRC_DIR, "*", "*.py"))):
+        with open(path, "rb") as f:
+            source += f.read()
+    text = (source * (file_kb * 1024 // len(source) + 1))[: file_kb * 1024]
+    return [
+        ("MESSAGE", {"type": "MESSAGE", "from": "alice", "message": "see you at 5"}),
+        ("RTC_OFFER", {"type": "RTC_OFFER", "from": "alice", "sdp": sdp_offer()}),
+        (
+            "USERS",
+            {
+                "type": "USERS",
+                "users": [
+                    {"username": f"user{i}", "display_name": f"User Number {i}"}
+                    for i in range(users)
+                ],
+            },
+        ),
+        (
+            "FILE text",
+            {
+                "type": "FILE",
+                "from": "alice",
+                "filename": "a.py",
+                "data": base64.b64encode(text).decode(),
+            },
+        ),
+        (
+            "FILE random",
+            {
+                "type": "FILE",
+                "from": "alice",
+                "filename": "a.bin",
+                "data": base64.b64encode(os.urandom(file_kb * 1024)).decode(),
+            },
+        ),
+    ]
+
+
+def measure(payload, codec, rounds):
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        frame = encode_message(payload, FRAMING_LENGTH, codec)
+    encode = (time.perf_counter() - t0) / rounds
+    decoder = StreamDecoder(FRAMING_LENGTH)
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        decoder.feed(frame)
+        for _ in decoder:
+            pass
+    decode = (time.perf_counter() - t0) / rounds
+    return len(frame), encode, decode
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--file-kb", type=int, default=256)
+    parser.add_argument("--rounds", type=int, default=50)
+    parser.add_argument("--links", nargs="+", type=float, default=[1000, 20])
+    args = parser.parse_args()
+
+    framing.COMPRESS_THRESHOLD = 0
+    rows = []
+    for name, payload in sample_messages(args.users, args.file_kb):
+        for codec in (None, *SUPPORTED_CODECS):
+            size, encode, decode = measure(payload, codec, args.rounds)
+            cpu = encode + decode
+            rows.append(
+                (
+                    name,
+                    codec or "none",
+                    size,
+                    f"{encode * 1e6:.0f}",
+                    f"{decode * 1e6:.0f}",
+                    *(
+                        f"{(cpu + size * 8 / (mbit * 1e6)) * 1000:.3f}"
+                        for mbit in args.links
+                    ),
+                )
+            )
+    print(f"codecs available: {', '.join(SUPPORTED_CODECS)}")
+    print_table(
+        ["message", "codec", "wire bytes", "encode us", "decode us"]
+        + [f"ms @{mbit:g}Mbit" for mbit in args.links],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
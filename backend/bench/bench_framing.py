@@ -0,0 +1,166 @@
+"""Microbenchmark for stream decoding.
+
+    python backend/bench/bench_framing.py --mb 16 --max-chunk 8192
+
+Builds a multi-MB stream of chat messages and base64 FILE payloads, cuts it
+at random boundaries (as recv() would) and feeds it to:
+- parsestream: the old loop (ParseStream + `buffer = new_buffer`)
+- naive-keep: ParseStream-style raw_decode but keeping the remainder
+- decoder-json: StreamDecoder in legacy concatenated-JSON mode
+- decoder-length: StreamDecoder on length-prefixed frames
+"""
+
+import argparse
+import base64
+import json
+import os
+import random
+import time
+
+from _common import print_table
+from utils import (
+    FRAMING_JSON,
+    FRAMING_LENGTH,
+    ParseStream,
+    StreamDecoder,
+    encode_message,
+)
+
+decoder = json.JSONDecoder()
+
+
+def build_messages(total_bytes, file_size, seed):
+    rng = random.Random(seed)
+    messages = []
+    size = 0
+    while size < total_bytes:
+        if rng.random() < 0.02:
+            data = base64.b64encode(os.urandom(file_size)).decode()
+            msg = {"type": "FILE", "to": "bob", "filename": "a.bin", "data": data}
+        else:
+            text = "xin chào " * rng.randint(1, 40)
+            msg = {"type": "MESSAGE", "to": "bob", "from": "alice", "message": text}
+        messages.append(msg)
+        size += len(json.dumps(msg))
+    return messages
+
+
+def split(stream, max_chunk, seed):
+    rng = random.Random(seed)
+    chunks = []
+    pos = 0
+    while pos < len(stream):
+        n = rng.randint(1, max_chunk)
+        chunks.append(stream[pos : pos + n])
+        pos += n
+    return chunks
+
+
+def run_parsestream(chunks):
+    count = 0
+    buffer = ""
+    for raw in chunks:
+        try:
+            buffer += raw.decode()
+        except UnicodeDecodeError:
+            # recv() split a multi-byte character: the old loop dies here
+            buffer = ""
+            continue
+        new_buffer = ""
+        for obj in ParseStream(buffer):
+            # resyncing mid-message can yield stray strings/numbers
+            count += isinstance(obj, dict) and "type" in obj
+        buffer = new_buffer
+    return count
+
+
+def run_naive_keep(chunks):
+    count = 0
+    pending = b""
+    buffer = ""
+    for raw in chunks:
+        try:
+            buffer += (pending + raw).decode()
+            pending = b""
+        except UnicodeDecodeError:
+            pending += raw
+            continue
+        while buffer:
+            try:
+                _, idx = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                break
+            count += 1
+            buffer = buffer[idx:].lstrip()
+    return count
+
+
+def run_decoder(chunks, mode):
+    count = 0
+    stream = StreamDecoder(mode)
+    for raw in chunks:
+        stream.feed(raw)
+        for _ in stream:
+            count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--mb", type=float, default=16)
+    parser.add_argument("--file-kb", type=int, default=512)
+    parser.add_argument("--max-chunk", type=int, default=8192)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument(
+        "--skip-naive",
+        action="store_true",
+        help="naive-keep is quadratic in the size of the largest message",
+    )
+    args = parser.parse_args()
+
+    messages = build_messages(int(args.mb * 1024 * 1024), args.file_kb * 1024, args.seed)
+    json_stream = b"".join(encode_message(m, FRAMING_JSON) for m in messages)
+    length_stream = b"".join(encode_message(m, FRAMING_LENGTH) for m in messages)
+    json_chunks = split(json_stream, args.max_chunk, args.seed)
+    length_chunks = split(length_stream, args.max_chunk, args.seed)
+
+    cases = [("parsestream", run_parsestream, json_chunks, len(json_stream))]
+    if not args.skip_naive:
+        cases.append(("naive-keep", run_naive_keep, json_chunks, len(json_stream)))
+    cases.append(
+        (
+            "decoder-json",
+            lambda c: run_decoder(c, FRAMING_JSON),
+            json_chunks,
+            len(json_stream),
+        )
+    )
+    cases.append(
+        (
+            "decoder-length",
+            lambda c: run_decoder(c, FRAMING_LENGTH),
+            length_chunks,
+            len(length_stream),
+        )
+    )
+
+    rows = []
+    for name, fn, chunks, nbytes in cases:
+        t0 = time.perf_counter()
+        decoded = fn(chunks)
+        elapsed = time.perf_counter() - t0
+        rows.append(
+            [
+                name,
+                f"{nbytes / 1e6:.1f}",
+                len(chunks),
+                f"{decoded}/{len(messages)}",
+                f"{elapsed:.3f}",
+                f"{nbytes / 1e6 / elapsed:.1f}",
+            ]
+        )
+    print_table(["decoder", "MB", "chunks", "messages", "seconds", "MB/s"], rows)
+
+
+if __name__ == "__main__":
+    main()
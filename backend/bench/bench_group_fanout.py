@@ -0,0 +1,120 @@
+"""Microbenchmark for GROUP_MESSAGE fan-out to one large group.
+
+    python backend/bench/bench_group_fanout.py --members 10000 --rounds 20
+
+Runs in-process against chat_server with --members fake connections whose
+send() only counts bytes, so only the server-side cost is measured:
+- per-member: the old loop, send_message() (json.dumps + framing) per member
+- shared: send_to_many(), one EncodedPayload whose bytes every member shares
+It also times building one roster with every member in --groups groups, as
+the old scan over all groups and as the user_groups index lookup.
+"""
+
+import argparse
+import contextlib
+import io
+import time
+
+from _common import print_table
+from services import chat_server
+from services.connection import Connection
+from utils import FRAMING_LENGTH
+
+
+class CountingConnection(Connection):
+    def __init__(self):
+        super().__init__()
+        self.sent = 0
+        self.frames = 0
+
+    @property
+    def queued_bytes(self):
+        return 0
+
+    def send(self, data, lane=None):
+        self.sent += len(data)
+        self.frames += 1
+        return len(data)
+
+
+def setup(members, group_count):
+    chat_server.clients.clear()
+    chat_server.groups.clear()
+    chat_server.user_groups.clear()
+    usernames = [f"user{i}" for i in range(members)]
+    for username in usernames:
+        conn = CountingConnection()
+        conn.set_framing(FRAMING_LENGTH)
+        chat_server.clients[username] = {"conn": conn, "display_name": username}
+    for g in range(group_count):
+        chat_server.add_group_members(f"group{g}", usernames)
+    return usernames
+
+
+def payload(text):
+    return {
+        "type": "GROUP_MESSAGE",
+        "from": "user0",
+        "group_name": "group0",
+        "message": text,
+    }
+
+
+def per_member(usernames, text):
+    for username in usernames:
+        chat_server.clients[username]["conn"].send_message(payload(text))
+
+
+def shared(usernames, text):
+    chat_server.send_to_many(usernames, payload(text))
+
+
+def scan_roster(username):
+    groups = chat_server.groups
+    return [g for g in list(groups) if username in groups[g]["members"]]
+
+
+def indexed_roster(username):
+    return list(chat_server.user_groups.get(username, ()))
+
+
+def timed(fn, rounds, *args):
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        fn(*args)
+    return (time.perf_counter() - t0) / rounds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--members", type=int, default=10000)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--groups", type=int, default=1000)
+    parser.add_argument("--message-size", type=int, default=200)
+    args = parser.parse_args()
+
+    usernames = setup(args.members, args.groups)
+    text = "x" * args.message_size
+    rows = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for name, fn in (("per-member", per_member), ("shared", shared)):
+            seconds = timed(fn, args.rounds, usernames, text)
+            rows.append(
+                (
+                    f"deliver {name}",
+                    f"{seconds * 1000:.2f}",
+                    f"{seconds / args.members * 1e6:.3f}",
+                )
+            )
+    for name, fn in (("scan", scan_roster), ("index", indexed_roster)):
+        seconds = timed(fn, args.rounds, usernames[-1])
+        rows.append((f"roster {name}", f"{seconds * 1000:.3f}", "-"))
+    print(
+        f"{args.members} members, {args.message_size}-char messages, "
+        f"rosters over {args.groups} groups"
+    )
+    print_table(["case", "ms/op", "us/member"], rows)
+
+
+if __name__ == "__main__":
+    main()
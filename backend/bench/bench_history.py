@@ -0,0 +1,130 @@
+"""Benchmark the SQLite message history store (models/history_store.py).
+
+    python backend/bench/bench_history.py --messages 200000 --writers 8
+
+Runs in-process against a temporary database:
+- write throughput: W threads append M messages as fast as they can, once
+  with group commit (max_batch=1000) and once committing every message
+  (max_batch=1), until everything is on disk
+- page latency: random HISTORY pages at random depths, keyset pagination
+  (what the server does) vs. LIMIT/OFFSET for comparison
+"""
+
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+from _common import percentile, print_table
+from models import HistoryStore
+
+
+def write_load(path, messages, writers, conversations, max_batch):
+    store = HistoryStore(path, max_batch=max_batch)
+    per_writer = messages // writers
+
+    def writer(n):
+        rng = random.Random(n)
+        for i in range(per_writer):
+            store.append(
+                f"dm:u{rng.randrange(conversations)}:v{n}",
+                f"v{n}",
+                f"Writer {n}",
+                f"message {i} " + "x" * rng.randrange(20, 200),
+            )
+
+    t0 = time.perf_counter()
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(writers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    store.flush()
+    elapsed = time.perf_counter() - t0
+    commits = store.commits
+    store.close()
+    return per_writer * writers / elapsed, commits
+
+
+def page_latency(store, requests, limit, use_offset):
+    rng = random.Random(1)
+    db = store._connect()
+    sizes = dict(db.execute("SELECT conversation, COUNT(*) FROM messages GROUP BY 1"))
+    names = list(sizes)
+    latencies = []
+    for _ in range(requests):
+        conv = rng.choice(names)
+        depth = rng.randrange(sizes[conv])
+        t0 = time.perf_counter()
+        if use_offset:
+            db.execute(
+                "SELECT id, sender, sender_display, body, created_at FROM messages"
+                " WHERE conversation = ? ORDER BY id DESC LIMIT ? OFFSET ?",
+                (conv, limit, depth),
+            ).fetchall()
+        else:
+            # the before_id a client would hold after paging down to `depth`
+            row = db.execute(
+                "SELECT id FROM messages WHERE conversation = ?"
+                " ORDER BY id DESC LIMIT 1 OFFSET ?",
+                (conv, depth),
+            ).fetchone()
+            t0 = time.perf_counter()
+            store.page(conv, row[0], limit)
+        latencies.append((time.perf_counter() - t0) * 1000)
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--messages", type=int, default=200000)
+    parser.add_argument("--writers", type=int, default=8)
+    parser.add_argument("--conversations", type=int, default=2)
+    parser.add_argument("--pages", type=int, default=2000)
+    parser.add_argument("--limit", type=int, default=50)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="bench-history-")
+    try:
+        rows = []
+        for name, max_batch, messages in (
+            ("group commit", 1000, args.messages),
+            # one transaction per message is far slower; a slice is enough
+            ("commit each", 1, min(args.messages, 20000)),
+        ):
+            path = os.path.join(tmp, f"{max_batch}.db")
+            rate, commits = write_load(
+                path, messages, args.writers, args.conversations, max_batch
+            )
+            rows.append((name, messages, commits, f"{rate:,.0f}"))
+        print(f"write throughput, {args.writers} writer threads")
+        print_table(["mode", "messages", "commits", "msgs/s"], rows)
+        print()
+
+        store = HistoryStore(os.path.join(tmp, "1000.db"))
+        rows = []
+        for name, use_offset in (("keyset", False), ("offset", True)):
+            lat = page_latency(store, args.pages, args.limit, use_offset)
+            rows.append(
+                (
+                    name,
+                    f"{percentile(lat, 50):.3f}",
+                    f"{percentile(lat, 99):.3f}",
+                    f"{max(lat):.3f}",
+                )
+            )
+        store.close()
+        print(
+            f"page fetch ({args.limit} per page, {args.messages} messages"
+            f" in {args.conversations} x {args.writers} conversations)"
+        )
+        print_table(["pagination", "p50 ms", "p99 ms", "max ms"], rows)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""Microbenchmark for presence fan-out: global roster push vs subscriptions.
+
+    python backend/bench/bench_presence.py --users 20000 --churn 10
+
+Runs in-process against chat_server with --users fake connections whose
+send() only counts bytes, and flushes --windows presence windows in which
+--churn users join and --churn others leave. Configurations:
+- legacy: clients without deltas, the full USERS list on every change
+  (slow at this size; try --users 2000)
+- delta: every client gets every PRESENCE_DELTA
+- subscribe: every client watches --contacts random users and its
+  --groups-per-user groups of --group-size, and hears only about those
+Reports bytes and frames sent per window and the time a window takes.
+"""
+
+import argparse
+import contextlib
+import gc
+import io
+import random
+import time
+
+from _common import print_table
+from bench_group_fanout import CountingConnection
+from services import chat_server
+from services.presence import Subscriptions
+from utils import FRAMING_LENGTH
+
+CONFIGS = ("legacy", "delta", "subscribe")
+
+
+def setup(config, args, rng):
+    chat_server.clients.clear()
+    chat_server.groups.clear()
+    chat_server.user_groups.clear()
+    chat_server.subscriptions = Subscriptions()
+    usernames = [f"user{i}" for i in range(args.users)]
+    churners = [f"churn{i}" for i in range(args.churn * 2)]
+    for username in usernames:
+        conn = CountingConnection()
+        conn.set_framing(FRAMING_LENGTH)
+        conn.presence_deltas = config != "legacy"
+        conn.presence_subscribed = config == "subscribe"
+        chat_server.clients[username] = {"conn": conn, "display_name": username}
+    group_count = args.users * args.groups_per_user // args.group_size
+    for g in range(group_count):
+        members = rng.sample(usernames + churners, args.group_size)
+        chat_server.add_group_members(f"group{g}", members)
+    if config == "subscribe":
+        for username in usernames:
+            contacts = rng.sample(usernames + churners, args.contacts)
+            chat_server.subscriptions.subscribe(
+                username, contacts, chat_server.user_groups.get(username, ())
+            )
+    gc.collect()  # or the first windows pay for collecting the setup
+    return usernames, churners
+
+
+def run(config, args):
+    rng = random.Random(1)
+    usernames, churners = setup(config, args, rng)
+    conns = [chat_server.clients[u]["conn"] for u in usernames]
+    sent = frames = 0
+    seconds = 0.0
+    online = set()
+    for window in range(args.windows):
+        # half the churners come online, the other half go
+        joining = churners[: args.churn] if window % 2 == 0 else churners[args.churn :]
+        leaving = [u for u in online if u not in joining]
+        for username in leaving:
+            chat_server.remote_users.pop(username, None)
+        for username in joining:
+            chat_server.remote_users[username] = {"display_name": username}
+        online = set(joining)
+        for conn in conns:
+            conn.sent = conn.frames = 0
+        t0 = time.perf_counter()
+        chat_server.flush_presence(
+            window + 1, {u: u for u in joining}, set(leaving), {}, set()
+        )
+        seconds += time.perf_counter() - t0
+        sent += sum(conn.sent for conn in conns)
+        frames += sum(conn.frames for conn in conns)
+    chat_server.remote_users.clear()
+    return sent / args.windows, frames / args.windows, seconds / args.windows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--configs", nargs="+", choices=CONFIGS, default=["delta", "subscribe"]
+    )
+    parser.add_argument("--users", type=int, default=20000)
+    parser.add_argument("--churn", type=int, default=10, help="joins (and leaves)")
+    parser.add_argument("--windows", type=int, default=10)
+    parser.add_argument("--contacts", type=int, default=50)
+    parser.add_argument("--groups-per-user", type=int, default=5)
+    parser.add_argument("--group-size", type=int, default=20)
+    args = parser.parse_args()
+
+    rows = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for config in args.configs:
+            sent, frames, seconds = run(config, args)
+            rows.append(
+                (
+                    config,
+                    f"{sent / 1e6:.3f}",
+                    f"{sent / args.users:.1f}",
+                    f"{frames:.0f}",
+                    f"{seconds * 1000:.2f}",
+                )
+            )
+    print(
+        f"{args.users} clients, {args.churn} joins + {args.churn} leaves per "
+        f"window; subscribers watch {args.contacts} contacts and "
+        f"{args.groups_per_user} groups of {args.group_size}"
+    )
+    print_table(["config", "MB/window", "bytes/client", "frames", "ms/window"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,199 @@
+"""Signaling latency while a bulk file transfer fills the same connection.
+
+    python backend/bench/bench_priority.py --duration 5 --read-rate 40
+
+A sender streams 256 KiB FILE_CHUNK frames to one receiver, keeping
+--window bytes in flight (as FILE_ACK would), while the receiver reads at
+--read-rate MB/s with a --rcvbuf KiB receive buffer, so the queue builds
+up on the server side of the receiver's connection. Meanwhile a caller
+sends the receiver an RTC_ICE every --ice-interval ms. Each server mode
+runs with priority lanes (signaling before bulk, the default), with lanes
+and a 256 KiB --socket-send-buffer (less bulk waits in the kernel, where
+it cannot be overtaken) and with --no-lanes (arrival order). Reports
+RTC_ICE latency and the bulk throughput the receiver saw.
+"""
+
+import argparse
+import socket
+import threading
+import time
+
+from _common import HOST, free_port, percentile, print_table, start_server, stop_server
+from utils import FRAMING_LENGTH, StreamDecoder, encode_message
+
+CONFIGS = {
+    "lanes": [],
+    "lanes+sndbuf": ["--socket-send-buffer", "256"],
+    "no-lanes": ["--no-lanes"],
+}
+CHUNK = 256 * 1024
+
+
+class Peer:
+    def __init__(self, port, username, rcvbuf=0):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if rcvbuf:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        self.sock.connect((HOST, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.decoder = StreamDecoder()
+        self.sock.sendall(
+            encode_message(
+                {
+                    "type": "LOGIN",
+                    "username": username,
+                    "display_name": username,
+                    "framing": [FRAMING_LENGTH],
+                    "files": "chunked",
+                }
+            )
+        )
+        while not any(m["type"] == "LOGIN_OK" for m in self._read()):
+            pass
+        self.decoder.mode = FRAMING_LENGTH
+
+    def _read(self):
+        self.decoder.feed(self.sock.recv(65536))
+        return list(self.decoder)
+
+    def send(self, payload):
+        self.sock.sendall(encode_message(payload, FRAMING_LENGTH))
+
+
+def run(port, args):
+    receiver = Peer(port, "receiver", args.rcvbuf * 1024)
+    sender = Peer(port, "sender")
+    caller = Peer(port, "caller")
+    stop = threading.Event()
+    received = [0]  # FILE_CHUNK bytes
+    latencies = []
+    chunk = b"x" * CHUNK
+
+    def receive():
+        started = time.perf_counter()
+        got = 0
+        receiver.sock.settimeout(0.5)
+        while not stop.is_set():
+            try:
+                data = receiver.sock.recv(256 * 1024)
+            except socket.timeout:
+                continue
+            if not data:
+                return
+            now = time.perf_counter()
+            got += len(data)
+            receiver.decoder.feed(data)
+            for msg in receiver.decoder:
+                if msg["type"] == "FILE_CHUNK":
+                    received[0] += len(msg["data"])
+                elif msg["type"] == "RTC_ICE":
+                    latencies.append(now - msg["candidate"]["t"])
+            # pace to --read-rate
+            ahead = got / (args.read_rate * 1e6) - (time.perf_counter() - started)
+            if ahead > 0:
+                time.sleep(ahead)
+
+    def stream():
+        offset = 0
+        while not stop.is_set():
+            if offset - received[0] > args.window * 1024 * 1024:
+                time.sleep(0.001)
+                continue
+            sender.send(
+                {
+                    "type": "FILE_CHUNK",
+                    "to": "receiver",
+                    "transfer_id": "bench",
+                    "offset": offset,
+                    "data": chunk,
+                }
+            )
+            offset += CHUNK
+
+    def drain(peer):
+        peer.sock.settimeout(0.5)
+        while not stop.is_set():
+            try:
+                if not peer.sock.recv(65536):
+                    return
+            except socket.timeout:
+                pass
+
+    threads = [
+        threading.Thread(target=receive),
+        threading.Thread(target=stream),
+        threading.Thread(target=drain, args=(caller,)),
+    ]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.warmup)
+    latencies.clear()
+    start_bytes = received[0]
+    t0 = time.perf_counter()
+    while time.perf_counter() - t0 < args.duration:
+        caller.send(
+            {
+                "type": "RTC_ICE",
+                "to": "receiver",
+                "from": "caller",
+                "candidate": {"t": time.perf_counter()},
+            }
+        )
+        time.sleep(args.ice_interval / 1000)
+    elapsed = time.perf_counter() - t0
+    mb_s = (received[0] - start_bytes) / elapsed / 1e6
+    sent = int(args.duration * 1000 / args.ice_interval)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    for peer in (receiver, sender, caller):
+        peer.sock.close()
+    return latencies, sent, mb_s
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modes", nargs="+", default=["threaded", "asyncio"])
+    parser.add_argument("--configs", nargs="+", default=list(CONFIGS))
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--warmup", type=float, default=1.0)
+    parser.add_argument("--read-rate", type=float, default=40.0, help="MB/s")
+    parser.add_argument("--window", type=int, default=12, help="MiB in flight")
+    parser.add_argument("--rcvbuf", type=int, default=256, help="KiB (0: OS)")
+    parser.add_argument("--ice-interval", type=float, default=20.0, help="ms")
+    args = parser.parse_args()
+
+    rows = []
+    for mode in args.modes:
+        for config in args.configs:
+            port = free_port()
+            proc = start_server(
+                port, "--mode", mode, "--no-history", "--no-inbox", *CONFIGS[config]
+            )
+            try:
+                latencies, sent, mb_s = run(port, args)
+            finally:
+                stop_server(proc)
+            rows.append(
+                (
+                    mode,
+                    config,
+                    f"{len(latencies)}/{sent}",
+                    f"{percentile(latencies, 50) * 1000:.1f}",
+                    f"{percentile(latencies, 99) * 1000:.1f}",
+                    f"{max(latencies, default=0) * 1000:.1f}",
+                    f"{mb_s:.1f}",
+                )
+            )
+    print(
+        f"RTC_ICE every {args.ice_interval:g} ms during a FILE_CHUNK stream "
+        f"({args.window} MiB window, receiver reading {args.read_rate:g} MB/s)"
+    )
+    print_table(
+        ["mode", "config", "ICE seen", "p50 ms", "p99 ms", "max ms", "bulk MB/s"],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""Server CPU per MB relayed: full JSON messages vs. FLAG_RELAY frames.
+
+    python backend/bench/bench_relay.py --sizes 64 1024 --mb 64
+
+For each server mode and body size (KiB) a sender streams RTC_OFFER
+messages with an SDP of that size to one receiver, --window in flight:
+- json: length-framed JSON, which the server parses into a dict, rebuilds
+  with the sender's addressing and json.dumps again
+- relay: LOGIN {"relay": true} on both ends; the server parses only the
+  routing header and forwards the body bytes as they arrived
+
+Reported: MB/s at the receiver and server CPU seconds per MB relayed.
+"""
+
+import argparse
+import json
+import time
+
+from _common import cpu_seconds, free_port, print_table, start_server, stop_server
+from bench_blob_download import Client
+from utils import FRAMING_LENGTH, encode_relay
+
+
+def relay_run(port, sdp, count, window, relay):
+    login = {"framing": [FRAMING_LENGTH], "relay": relay}
+    sender = Client(port, "sender", **login)
+    receiver = Client(port, "receiver", **login)
+    header = {"type": "RTC_OFFER", "to": "receiver", "from": "sender"}
+    body = json.dumps({"sdp": sdp}).encode()
+
+    def send():
+        if relay:
+            sender.sock.sendall(encode_relay(header, body))
+        else:
+            sender.send({**header, "sdp": sdp})
+
+    sent = received = 0
+    while sent < min(window, count):
+        send()
+        sent += 1
+    for msg in receiver.messages():
+        if msg["type"] != "RTC_OFFER":
+            continue
+        received += 1
+        if received == count:
+            break
+        if sent < count:
+            send()
+            sent += 1
+    sender.close()
+    receiver.close()
+
+
+def measure(mode, size, args, relay):
+    sdp = "a" * size
+    count = max(1, int(args.mb * 1024 * 1024 / size))
+    port = free_port()
+    proc = start_server(port, "--mode", mode, "--no-history", "--no-inbox")
+    try:
+        time.sleep(0.2)
+        cpu0 = cpu_seconds(proc.pid)
+        t0 = time.perf_counter()
+        relay_run(port, sdp, count, args.window, relay)
+        elapsed = time.perf_counter() - t0
+        cpu = cpu_seconds(proc.pid) - cpu0
+    finally:
+        stop_server(proc)
+    mb = size * count / 1e6
+    return f"{mb / elapsed:.0f}", f"{cpu / mb * 1000:.2f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", nargs="+", type=int, default=[64, 1024])
+    parser.add_argument("--mb", type=float, default=64, help="MB relayed per case")
+    parser.add_argument("--window", type=int, default=8)
+    parser.add_argument("--modes", nargs="+", default=["threaded", "asyncio"])
+    args = parser.parse_args()
+
+    rows = []
+    for mode in args.modes:
+        for kib in args.sizes:
+            for name, relay in (("json", False), ("relay", True)):
+                rows.append((mode, kib, name, *measure(mode, kib * 1024, args, relay)))
+    print(f"{args.mb:g} MB of RTC_OFFER per case, {args.window} in flight")
+    print_table(["mode", "KiB", "path", "MB/s", "server CPU ms/MB"], rows)
+
+
+if __name__ == "__main__":
+    main()
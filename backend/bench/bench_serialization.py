@@ -0,0 +1,77 @@
+"""Encode/decode throughput per message type: JSON vs. MessagePack bodies.
+
+    python backend/bench/bench_serialization.py --users 500 --file-kb 256
+
+Runs in-process on length-prefixed frames, uncompressed, with the same
+sample messages as bench_compression.py. FILE is sent the way each mode
+does it: base64 text in JSON, raw bytes in MessagePack. MessagePack rows
+only appear when the optional msgpack package is installed.
+"""
+
+import argparse
+import base64
+import time
+
+from _common import print_table
+from bench_compression import sample_messages
+from utils import (
+    FRAMING_LENGTH,
+    SERIALIZATION_MSGPACK,
+    SUPPORTED_SERIALIZATIONS,
+    StreamDecoder,
+    encode_message,
+)
+
+
+def as_sent(payload, serialization):
+    if serialization == SERIALIZATION_MSGPACK and payload["type"] == "FILE":
+        return {**payload, "data": base64.b64decode(payload["data"])}
+    return payload
+
+
+def measure(payload, serialization, rounds):
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        frame = encode_message(payload, FRAMING_LENGTH, None, serialization)
+    encode = (time.perf_counter() - t0) / rounds
+    decoder = StreamDecoder(FRAMING_LENGTH)
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        decoder.feed(frame)
+        for _ in decoder:
+            pass
+    decode = (time.perf_counter() - t0) / rounds
+    return len(frame), encode, decode
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--file-kb", type=int, default=256)
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    rows = []
+    for name, payload in sample_messages(args.users, args.file_kb):
+        for serialization in SUPPORTED_SERIALIZATIONS:
+            size, encode, decode = measure(
+                as_sent(payload, serialization), serialization, args.rounds
+            )
+            rows.append(
+                (
+                    name,
+                    serialization,
+                    size,
+                    f"{1 / encode:,.0f}",
+                    f"{1 / decode:,.0f}",
+                    f"{size / encode / 1e6:,.0f}",
+                    f"{size / decode / 1e6:,.0f}",
+                )
+            )
+    print(f"serializations available: {', '.join(SUPPORTED_SERIALIZATIONS)}")
+    headers = ["message", "body", "wire bytes", "enc msg/s", "dec msg/s"]
+    print_table(headers + ["enc MB/s", "dec MB/s"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""Compare the threaded and asyncio server modes.
+
+    python backend/bench/bench_server_modes.py --connections 2000 --pairs 50
+
+Two measurements per mode:
+- connections per GB: RSS growth after opening N idle connections
+  (a thread stack per socket vs. one protocol object per socket)
+- messages/sec: P logged-in pairs ping-pong MESSAGE frames for D seconds
+"""
+
+import argparse
+import asyncio
+import json
+import time
+
+from _common import (
+    HOST,
+    JsonStream,
+    free_port,
+    percentile,
+    print_table,
+    raise_nofile_limit,
+    rss_bytes,
+    start_server,
+    stop_server,
+)
+
+
+async def open_idle(port, n):
+    conns = []
+    for _ in range(n):
+        conns.append(await asyncio.open_connection(HOST, port))
+    return conns
+
+
+async def login(port, username):
+    reader, writer = await asyncio.open_connection(HOST, port)
+    writer.write(
+        json.dumps(
+            {"type": "LOGIN", "username": username, "display_name": username}
+        ).encode()
+    )
+    stream = JsonStream()
+    while True:
+        data = await reader.read(65536)
+        if not data:
+            raise ConnectionError("closed during login")
+        if any(m.get("type") == "LOGIN_OK" for m in stream.feed(data)):
+            return reader, writer, stream
+
+
+async def ping_pong(a, b, b_name, a_name, deadline, latencies):
+    """a sends to b, b echoes back; each leg is one relayed MESSAGE"""
+    ra, wa, sa = a
+    rb, wb, sb = b
+    count = 0
+
+    async def wait_message(reader, stream):
+        while True:
+            for m in stream.feed(await reader.read(65536)):
+                if m.get("type") == "MESSAGE":
+                    return m
+
+    while time.perf_counter() < deadline:
+        t0 = time.perf_counter()
+        wa.write(
+            json.dumps(
+                {"type": "MESSAGE", "to": b_name, "from": a_name, "message": "ping"}
+            ).encode()
+        )
+        await wait_message(rb, sb)
+        t1 = time.perf_counter()
+        wb.write(
+            json.dumps(
+                {"type": "MESSAGE", "to": a_name, "from": b_name, "message": "pong"}
+            ).encode()
+        )
+        await wait_message(ra, sa)
+        t2 = time.perf_counter()
+        latencies.append(t1 - t0)
+        latencies.append(t2 - t1)
+        count += 2
+    return count
+
+
+async def run_mode(mode, args):
+    port = free_port()
+    proc = start_server(port, "--mode", mode)
+    try:
+        await asyncio.sleep(0.3)
+        base_rss = rss_bytes(proc.pid)
+        idle = await open_idle(port, args.connections)
+        await asyncio.sleep(1.0)  # let the server accept everything
+        loaded_rss = rss_bytes(proc.pid)
+        for _, w in idle:
+            w.close()
+
+        per_conn = None
+        if base_rss and loaded_rss:
+            per_conn = max(1, loaded_rss - base_rss) / args.connections
+
+        clients = []
+        for i in range(args.pairs * 2):
+            clients.append(await login(port, f"bench{i}"))
+        # drain presence traffic caused by the logins
+        await asyncio.sleep(0.5)
+        for r, _, s in clients:
+            while True:
+                try:
+                    s.feed(await asyncio.wait_for(r.read(65536), 0.01))
+                except asyncio.TimeoutError:
+                    break
+
+        latencies = []
+        deadline = time.perf_counter() + args.duration
+        t0 = time.perf_counter()
+        counts = await asyncio.gather(
+            *(
+                ping_pong(
+                    clients[2 * i],
+                    clients[2 * i + 1],
+                    f"bench{2 * i + 1}",
+                    f"bench{2 * i}",
+                    deadline,
+                    latencies,
+                )
+                for i in range(args.pairs)
+            )
+        )
+        elapsed = time.perf_counter() - t0
+        for _, w, _ in clients:
+            w.close()
+
+        return [
+            mode,
+            f"{per_conn / 1024:.1f}" if per_conn else "n/a",
+            f"{(1 << 30) / per_conn:,.0f}" if per_conn else "n/a",
+            f"{sum(counts) / elapsed:,.0f}",
+            f"{percentile(latencies, 50) * 1000:.2f}",
+            f"{percentile(latencies, 99) * 1000:.2f}",
+        ]
+    finally:
+        stop_server(proc)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--connections", type=int, default=2000)
+    parser.add_argument("--pairs", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--modes", nargs="+", default=["threaded", "asyncio"])
+    args = parser.parse_args()
+    raise_nofile_limit()
+
+    rows = [asyncio.run(run_mode(mode, args)) for mode in args.modes]
+    print_table(
+        ["mode", "KiB/conn", "conns/GB", "msgs/s", "p50 ms", "p99 ms"], rows
+    )
+
+
+if __name__ == "__main__":
+    main()
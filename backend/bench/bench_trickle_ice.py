@@ -0,0 +1,279 @@
+"""Time to the first remote video frame, with and without trickle ICE.
+
+    python backend/bench/bench_trickle_ice.py --calls 5 --stun-delay 150
+
+Two aiortc peers on this host (pip install aiortc) call each other through
+the server, one call after another, signaling as the desktop client's
+WebRTCClient does. A local STUN responder that answers after --stun-delay
+ms stands in for the public STUN servers, so gathering takes as long as a
+real server-reflexive lookup. Configurations:
+- gather: each side gathers every candidate before sending its SDP, with
+  the candidates inline (the client before trickle ICE)
+- trickle: the SDP goes out at once and the candidates follow as RTC_ICE,
+  batched by the server (the default --ice-batch-window)
+- trickle-unbatched: the same with --ice-batch-window 0
+Reports the time from starting the call to the first video frame on each
+side, and the RTC_ICE frames each side received per call.
+"""
+
+import argparse
+import asyncio
+import time
+
+from aioice import stun
+from aiortc import (
+    RTCConfiguration,
+    RTCIceServer,
+    RTCPeerConnection,
+    RTCSessionDescription,
+    VideoStreamTrack,
+)
+from aiortc.sdp import candidate_from_sdp, candidate_to_sdp
+
+from _common import HOST, free_port, percentile, print_table, start_server, stop_server
+from utils import FRAMING_LENGTH, StreamDecoder, encode_message
+
+CONFIGS = {
+    "gather": (False, []),
+    "trickle": (True, []),
+    "trickle-unbatched": (True, ["--ice-batch-window", "0"]),
+}
+
+
+class SlowStun(asyncio.DatagramProtocol):
+    """Answers STUN binding requests after `delay` seconds"""
+
+    def __init__(self, delay):
+        self.delay = delay
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        request = stun.parse_message(data)
+        response = stun.Message(
+            message_method=stun.Method.BINDING,
+            message_class=stun.Class.RESPONSE,
+            transaction_id=request.transaction_id,
+            attributes={"XOR-MAPPED-ADDRESS": addr},
+        )
+        asyncio.get_running_loop().call_later(
+            self.delay, self.transport.sendto, bytes(response), addr
+        )
+
+
+class Peer:
+    def __init__(self, port, username, config, trickle):
+        self.port = port
+        self.username = username
+        self.config = config
+        self.trickle = trickle
+        self.decoder = StreamDecoder()
+        self.pc = None
+        self.partner = None
+        self.pending_ice = []
+        self.ice_lock = asyncio.Lock()  # candidates go in in order
+        self.ice_frames = 0
+        self.first_frame = None  # future: perf_counter() of the first frame
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(HOST, self.port)
+        self.writer.write(
+            encode_message(
+                {
+                    "type": "LOGIN",
+                    "username": self.username,
+                    "display_name": self.username,
+                    "framing": [FRAMING_LENGTH],
+                    "ice": "batch",
+                }
+            )
+        )
+        while True:
+            self.decoder.feed(await self.reader.read(65536))
+            if any(msg["type"] == "LOGIN_OK" for msg in self.decoder):
+                break
+        self.decoder.mode = FRAMING_LENGTH
+        self.task = asyncio.ensure_future(self.listen())
+
+    def send(self, payload):
+        self.writer.write(encode_message(payload, FRAMING_LENGTH))
+
+    async def listen(self):
+        while True:
+            data = await self.reader.read(65536)
+            if not data:
+                return
+            self.decoder.feed(data)
+            for msg in self.decoder:
+                if msg["type"] == "RTC_OFFER":
+                    self.new_pc(msg["from"])  # before its candidates come in
+                    asyncio.ensure_future(self.accept(msg["sdp"]))
+                elif msg["type"] == "RTC_ANSWER":
+                    asyncio.ensure_future(self.answered(msg["sdp"]))
+                elif msg["type"] == "RTC_ICE":
+                    self.ice_frames += 1
+                    self.pending_ice += msg.get("candidates") or [msg["candidate"]]
+                    if self.pc.remoteDescription is not None:
+                        await self.add_pending_ice()
+
+    def new_pc(self, partner):
+        self.partner = partner
+        self.pending_ice = []
+        self.ice_frames = 0
+        self.first_frame = asyncio.get_running_loop().create_future()
+        self.described = asyncio.Event()
+        self.pc = RTCPeerConnection(self.config)
+        self.pc.addTrack(VideoStreamTrack())
+
+        @self.pc.on("track")
+        def on_track(track):
+            asyncio.ensure_future(self.watch(track))
+
+    async def watch(self, track):
+        await track.recv()
+        if not self.first_frame.done():
+            self.first_frame.set_result(time.perf_counter())
+
+    async def describe(self, description, kind):
+        """Send our SDP: before gathering when trickling, after otherwise"""
+        if self.trickle:
+            self.send({"type": kind, "to": self.partner, "sdp": description.sdp})
+        await self.pc.setLocalDescription(description)
+        self.described.set()
+        if not self.trickle:
+            sdp = self.pc.localDescription.sdp
+            self.send({"type": kind, "to": self.partner, "sdp": sdp})
+            return
+        for index, transceiver in enumerate(self.pc.getTransceivers()):
+            gatherer = transceiver.sender.transport.transport.iceGatherer
+            for candidate in gatherer.getLocalCandidates() + [None]:
+                line = "candidate:" + candidate_to_sdp(candidate) if candidate else ""
+                self.send(
+                    {
+                        "type": "RTC_ICE",
+                        "to": self.partner,
+                        "candidate": {
+                            "candidate": line,
+                            "sdpMid": transceiver.mid,
+                            "sdpMLineIndex": index,
+                        },
+                    }
+                )
+
+    async def call(self, partner):
+        self.new_pc(partner)
+        await self.describe(await self.pc.createOffer(), "RTC_OFFER")
+
+    async def accept(self, sdp):
+        await self.pc.setRemoteDescription(RTCSessionDescription(sdp, "offer"))
+        await self.add_pending_ice()
+        await self.describe(await self.pc.createAnswer(), "RTC_ANSWER")
+
+    async def answered(self, sdp):
+        await self.described.wait()
+        await self.pc.setRemoteDescription(RTCSessionDescription(sdp, "answer"))
+        await self.add_pending_ice()
+
+    async def add_pending_ice(self):
+        async with self.ice_lock:
+            pending, self.pending_ice = self.pending_ice, []
+            for candidate in pending:
+                ice = None  # end-of-candidates
+                if candidate["candidate"]:
+                    ice = candidate_from_sdp(candidate["candidate"].split(":", 1)[1])
+                    ice.sdpMid = candidate["sdpMid"]
+                    ice.sdpMLineIndex = candidate["sdpMLineIndex"]
+                await self.pc.addIceCandidate(ice)
+
+    async def hang_up(self):
+        await self.pc.close()
+
+
+async def run(port, trickle, args):
+    loop = asyncio.get_running_loop()
+    stun_port = free_port()
+    stun_transport, _ = await loop.create_datagram_endpoint(
+        lambda: SlowStun(args.stun_delay / 1000), local_addr=("0.0.0.0", stun_port)
+    )
+    config = RTCConfiguration([RTCIceServer(f"stun:{HOST}:{stun_port}")])
+    caller = Peer(port, "caller", config, trickle)
+    callee = Peer(port, "callee", config, trickle)
+    await caller.connect()
+    await callee.connect()
+    to_callee, to_caller, ice_frames = [], [], []
+    for _ in range(args.calls):
+        started = time.perf_counter()
+        await caller.call("callee")
+        while callee.first_frame is None:
+            await asyncio.sleep(0.001)
+        done = await asyncio.wait_for(
+            asyncio.gather(callee.first_frame, caller.first_frame), args.timeout
+        )
+        to_callee.append(done[0] - started)
+        to_caller.append(done[1] - started)
+        ice_frames.append((caller.ice_frames + callee.ice_frames) / 2)
+        await caller.hang_up()
+        await callee.hang_up()
+        callee.first_frame = None
+        await asyncio.sleep(args.pause)
+    for peer in (caller, callee):
+        peer.task.cancel()
+        peer.writer.close()
+    stun_transport.close()
+    return to_callee, to_caller, ice_frames
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modes", nargs="+", default=["threaded", "asyncio"])
+    parser.add_argument("--configs", nargs="+", default=list(CONFIGS))
+    parser.add_argument("--calls", type=int, default=5)
+    parser.add_argument("--stun-delay", type=float, default=150.0, help="ms")
+    parser.add_argument("--pause", type=float, default=0.5, help="s between calls")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    args = parser.parse_args()
+
+    rows = []
+    for mode in args.modes:
+        for config in args.configs:
+            trickle, server_args = CONFIGS[config]
+            port = free_port()
+            proc = start_server(
+                port, "--mode", mode, "--no-history", "--no-inbox", *server_args
+            )
+            try:
+                to_callee, to_caller, ice_frames = asyncio.run(
+                    run(port, trickle, args)
+                )
+            finally:
+                stop_server(proc)
+            rows.append(
+                (
+                    mode,
+                    config,
+                    f"{percentile(to_callee, 50) * 1000:.0f}",
+                    f"{percentile(to_caller, 50) * 1000:.0f}",
+                    f"{max(to_caller + to_callee) * 1000:.0f}",
+                    f"{sum(ice_frames) / len(ice_frames):.1f}",
+                )
+            )
+    print(
+        f"{args.calls} loopback calls per row, STUN answering after "
+        f"{args.stun_delay:g} ms"
+    )
+    print_table(
+        [
+            "mode",
+            "config",
+            "callee p50 ms",
+            "caller p50 ms",
+            "max ms",
+            "RTC_ICE frames",
+        ],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
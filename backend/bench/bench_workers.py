@@ -0,0 +1,108 @@
+"""Messages/sec as the number of worker processes grows (main.py --workers).
+
+    python backend/bench/bench_workers.py --workers 1 2 4 8 --pairs 64 --procs 4
+
+For each worker count a server is started with that many SO_REUSEPORT
+workers and --procs load generator processes run --pairs ping-pong pairs
+between them (same MESSAGE ping-pong as bench_server_modes.py). Pairs are
+spread over connections at random, so most messages cross the routing bus
+to a sibling worker once workers > 1.
+
+The load generators share the machine with the server, so scaling flattens
+once they run out of cores too; run on a box with cores to spare.
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import time
+
+from _common import free_port, percentile, print_table, start_server, stop_server
+from bench_server_modes import login, ping_pong
+
+
+async def run_pairs(port, first, pairs, duration):
+    clients = []
+    for i in range(first, first + pairs * 2):
+        clients.append(await login(port, f"bench{i}"))
+    await asyncio.sleep(1.0)  # let presence settle across workers
+    for r, _, s in clients:
+        while True:
+            try:
+                s.feed(await asyncio.wait_for(r.read(65536), 0.01))
+            except asyncio.TimeoutError:
+                break
+    latencies = []
+    deadline = time.perf_counter() + duration
+    t0 = time.perf_counter()
+    counts = await asyncio.gather(
+        *(
+            ping_pong(
+                clients[2 * i],
+                clients[2 * i + 1],
+                f"bench{first + 2 * i + 1}",
+                f"bench{first + 2 * i}",
+                deadline,
+                latencies,
+            )
+            for i in range(pairs)
+        )
+    )
+    elapsed = time.perf_counter() - t0
+    for _, w, _ in clients:
+        w.close()
+    return sum(counts) / elapsed, latencies
+
+
+def load_process(port, first, pairs, duration, results):
+    results.put(asyncio.run(run_pairs(port, first, pairs, duration)))
+
+
+def run(workers, mode, args):
+    port = free_port()
+    proc = start_server(port, "--mode", mode, "--workers", str(workers), "--no-inbox")
+    try:
+        time.sleep(0.5 + 0.2 * workers)  # every worker bound and on the bus
+        results = multiprocessing.Queue()
+        per_proc = args.pairs // args.procs
+        loaders = [
+            multiprocessing.Process(
+                target=load_process,
+                args=(port, n * per_proc * 2, per_proc, args.duration, results),
+            )
+            for n in range(args.procs)
+        ]
+        for p in loaders:
+            p.start()
+        outcomes = [results.get() for _ in loaders]
+        for p in loaders:
+            p.join()
+    finally:
+        stop_server(proc)
+    latencies = [lat for _, lats in outcomes for lat in lats]
+    return [
+        mode,
+        workers,
+        f"{sum(rate for rate, _ in outcomes):,.0f}",
+        f"{percentile(latencies, 50) * 1000:.2f}",
+        f"{percentile(latencies, 99) * 1000:.2f}",
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", nargs="+", type=int, default=[1, 2, 4])
+    parser.add_argument("--pairs", type=int, default=64)
+    parser.add_argument("--procs", type=int, default=4, help="load generator processes")
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--modes", nargs="+", default=["asyncio"])
+    args = parser.parse_args()
+
+    rows = [run(w, mode, args) for mode in args.modes for w in args.workers]
+    print(f"{os.cpu_count()} CPUs, {args.pairs} pairs over {args.procs} load processes")
+    print_table(["mode", "workers", "msgs/s", "p50 ms", "p99 ms"], rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""Benchmark for outbound write coalescing and TCP_NODELAY.
+
+    python backend/bench/bench_write_coalescing.py --members 100 --senders 4
+
+Starts the server once per mode and configuration:
+- per-frame: --write-batch 1 --no-nodelay, one write per frame with Nagle on
+- per-frame+nodelay: --write-batch 1
+- coalesced: the defaults, frames queued together go out in one write
+--senders clients each send --burst GROUP_MESSAGEs at once, --rounds times,
+to one group of --members receivers. Reports socket writes per delivered
+frame (from the server's /metrics) and delivery latency. Then one client
+sends --pings MESSAGEs one at a time, waiting for each, to show that
+coalescing does not delay a lone frame.
+"""
+
+import argparse
+import asyncio
+import time
+import urllib.request
+
+from _common import HOST, free_port, percentile, print_table, start_server, stop_server
+from utils import FRAMING_LENGTH, StreamDecoder, encode_message
+
+CONFIGS = {
+    "per-frame": ["--write-batch", "1", "--no-nodelay"],
+    "per-frame+nodelay": ["--write-batch", "1"],
+    "coalesced": [],
+}
+
+
+class BenchClient:
+    def __init__(self, port, username):
+        self.port = port
+        self.username = username
+        self.decoder = StreamDecoder()
+        self.latencies = []
+        self.waiters = []
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(HOST, self.port)
+        self.writer.write(
+            encode_message(
+                {
+                    "type": "LOGIN",
+                    "username": self.username,
+                    "display_name": self.username,
+                    "framing": [FRAMING_LENGTH],
+                    "presence": "delta",
+                },
+                "json",
+            )
+        )
+        await self.writer.drain()
+        while True:
+            self.decoder.feed(await self.reader.read(65536))
+            if any(msg["type"] == "LOGIN_OK" for msg in self.decoder):
+                break
+        self.decoder.mode = FRAMING_LENGTH
+
+    def send(self, payload):
+        self.writer.write(encode_message(payload, FRAMING_LENGTH))
+
+    async def listen(self):
+        while True:
+            data = await self.reader.read(1024 * 1024)
+            if not data:
+                return
+            now = time.perf_counter()
+            self.decoder.feed(data)
+            for msg in self.decoder:
+                if msg["type"] in ("GROUP_MESSAGE", "MESSAGE"):
+                    self.latencies.append(now - float(msg["message"]))
+                    if self.waiters:
+                        self.waiters.pop(0).set_result(None)
+
+
+def scrape(mport):
+    text = urllib.request.urlopen(f"http://{HOST}:{mport}/metrics").read().decode()
+    values = {}
+    for line in text.splitlines():
+        if line.startswith("chat_socket_write"):
+            name, value = line.split()
+            values[name] = float(value)
+    return values
+
+
+async def run(port, mport, args):
+    receivers = [BenchClient(port, f"member{i}") for i in range(args.members)]
+    senders = [BenchClient(port, f"sender{i}") for i in range(args.senders)]
+    for client in receivers + senders:
+        await client.connect()
+    tasks = [asyncio.ensure_future(c.listen()) for c in receivers + senders]
+    senders[0].send(
+        {
+            "type": "CREATE_GROUP",
+            "group_name": "bench",
+            "members": [c.username for c in receivers + senders],
+        }
+    )
+    await asyncio.sleep(args.settle)
+    for client in receivers:
+        client.latencies.clear()
+
+    before = scrape(mport)
+    for _ in range(args.rounds):
+        for sender in senders:
+            for _ in range(args.burst):
+                sender.send(
+                    {
+                        "type": "GROUP_MESSAGE",
+                        "group_name": "bench",
+                        "from": sender.username,
+                        "message": repr(time.perf_counter()),
+                    }
+                )
+        await asyncio.sleep(args.interval)
+    await asyncio.sleep(args.settle)
+    after = scrape(mport)
+    burst = [x for c in receivers for x in c.latencies]
+    writes = after["chat_socket_writes_total"] - before["chat_socket_writes_total"]
+    frames = (
+        after["chat_socket_write_frames_total"]
+        - before["chat_socket_write_frames_total"]
+    )
+
+    pinger, target = senders[0], receivers[0]
+    target.latencies.clear()
+    for _ in range(args.pings):
+        done = asyncio.get_running_loop().create_future()
+        target.waiters.append(done)
+        pinger.send(
+            {
+                "type": "MESSAGE",
+                "to": target.username,
+                "from": pinger.username,
+                "message": repr(time.perf_counter()),
+            }
+        )
+        await asyncio.wait_for(done, 5)
+    pings = list(target.latencies)
+
+    for task in tasks:
+        task.cancel()
+    for client in receivers + senders:
+        client.writer.close()
+    return len(burst), writes, frames, burst, pings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--modes", nargs="+", default=["threaded", "asyncio"])
+    parser.add_argument("--configs", nargs="+", default=list(CONFIGS))
+    parser.add_argument("--members", type=int, default=100)
+    parser.add_argument("--senders", type=int, default=4)
+    parser.add_argument("--burst", type=int, default=10)
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument("--interval", type=float, default=0.1)
+    parser.add_argument("--pings", type=int, default=200)
+    parser.add_argument("--settle", type=float, default=2.0)
+    args = parser.parse_args()
+
+    rows = []
+    for mode in args.modes:
+        for config in args.configs:
+            port, mport = free_port(), free_port()
+            proc = start_server(
+                port,
+                "--mode",
+                mode,
+                "--no-history",
+                "--no-inbox",
+                "--metrics-port",
+                str(mport),
+                *CONFIGS[config],
+            )
+            try:
+                delivered, writes, frames, burst, pings = asyncio.run(
+                    run(port, mport, args)
+                )
+            finally:
+                stop_server(proc)
+            rows.append(
+                (
+                    mode,
+                    config,
+                    delivered,
+                    f"{writes / max(1, frames):.3f}",
+                    f"{percentile(burst, 50) * 1000:.2f}",
+                    f"{percentile(burst, 99) * 1000:.2f}",
+                    f"{percentile(pings, 50) * 1000:.3f}",
+                    f"{percentile(pings, 99) * 1000:.3f}",
+                )
+            )
+    print(
+        f"{args.senders} senders x {args.burst}-message bursts x {args.rounds} "
+        f"rounds to {args.members} members; {args.pings} lone pings"
+    )
+    print_table(
+        [
+            "mode",
+            "config",
+            "delivered",
+            "writes/frame",
+            "burst p50 ms",
+            "burst p99 ms",
+            "ping p50 ms",
+            "ping p99 ms",
+        ],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,327 @@
+"""Load generator: how many users one server carries before p99 degrades.
+
+    python backend/bench/loadgen.py --users 500 1000 2000 --rate 1 --duration 20
+    python backend/bench/loadgen.py --mix MESSAGE=60 GROUP_MESSAGE=20 FILE=5 RTC=15
+
+For every --users step a fresh server, with the default per-user rate
+limits turned on (--rate-limit), is started on localhost (or --port
+points at a running one, with --pid for its RSS/CPU). That many asyncio
+clients log in with the real protocol, --group-size of them share each
+group, and every client then sends --rate messages per second (Poisson)
+for --duration seconds, picking the kind from --mix:
+- MESSAGE: to a random user
+- GROUP_MESSAGE: to one of the client's groups (one delivery per member)
+- FILE: a --file-kb base64 FILE to a random user
+- RTC: RTC_OFFER or RTC_ICE to a random user
+
+Each message carries its send time, so every delivery yields one
+end-to-end latency. Reported per step: messages sent and delivered per
+second, deliveries that never arrived (a GROUP_MESSAGE owes one per other
+member), p50/p99/p999 delivery latency, server RSS and CPU, and errors:
+ERROR replies, connections the server closed, and sends on them. --procs
+spreads the clients over several load processes, which the machine needs
+once one Python process cannot keep up.
+"""
+
+import argparse
+import asyncio
+import base64
+import multiprocessing
+import os
+import random
+import shlex
+import shutil
+import tempfile
+import time
+
+from _common import (
+    HOST,
+    cpu_seconds,
+    free_port,
+    percentile,
+    print_table,
+    raise_nofile_limit,
+    rss_bytes,
+    start_server,
+    stop_server,
+)
+from bench_compression import sdp_offer
+from utils import FRAMING_JSON, FRAMING_LENGTH, StreamDecoder, encode_message
+
+KINDS = ("MESSAGE", "GROUP_MESSAGE", "FILE", "RTC")
+DEFAULT_MIX = ["MESSAGE=70", "GROUP_MESSAGE=15", "FILE=5", "RTC=10"]
+
+
+class LoadClient:
+    def __init__(self, username, framing):
+        self.username = username
+        self.offer = framing
+        self.framing = FRAMING_JSON
+        self.decoder = StreamDecoder()
+        self.groups = []
+        self.reader = self.writer = None
+        self.closed = False
+
+    async def login(self, port):
+        self.reader, self.writer = await asyncio.open_connection(HOST, port)
+        self.send(
+            {
+                "type": "LOGIN",
+                "username": self.username,
+                "display_name": self.username,
+                "framing": [self.offer],
+                "presence": "delta",
+            }
+        )
+        while True:
+            data = await self.reader.read(65536)
+            if not data:
+                raise ConnectionError(f"{self.username}: closed during login")
+            self.decoder.feed(data)
+            for msg in self.decoder:
+                if msg["type"] == "LOGIN_OK":
+                    self.framing = msg.get("framing", FRAMING_JSON)
+                    self.decoder.mode = self.framing
+                    return
+
+    def send(self, payload):
+        self.writer.write(encode_message(payload, self.framing))
+
+    async def receive(self, stats):
+        """Record a latency for every delivery until the connection closes"""
+        try:
+            while True:
+                data = await self.reader.read(1024 * 1024)
+                if not data:
+                    break
+                self.decoder.feed(data)
+                now = time.monotonic()
+                for msg in self.decoder:
+                    sent_at = sent_time(msg)
+                    if sent_at is not None:
+                        stats["latencies"].append(now - sent_at)
+                    elif msg["type"] == "ERROR":
+                        stats["errors"] += 1
+        except ConnectionError:
+            pass
+        except asyncio.CancelledError:
+            return  # the run is over
+        # the server hung up on us: an error, and so is every later send
+        self.closed = True
+        stats["closed"] += 1
+
+
+def sent_time(msg):
+    """The send time a load message carries, or None for other frames"""
+    kind = msg["type"]
+    if kind in ("MESSAGE", "GROUP_MESSAGE"):
+        return float(msg["message"].partition(" ")[0])
+    if kind == "FILE":
+        return float(msg["filename"][: -len(".bin")])
+    if kind == "RTC_OFFER":
+        return float(msg["sdp"].partition("\r\n")[0][len("t=") :])
+    if kind == "RTC_ICE":
+        return msg["candidate"]["t"]
+    return None
+
+
+def make_message(client, kind, usernames, file_data, rng):
+    now = time.monotonic()
+    target = client.username
+    while target == client.username:
+        target = rng.choice(usernames)
+    base = {"to": target, "from": client.username}
+    if kind == "GROUP_MESSAGE" and client.groups:
+        return {
+            "type": "GROUP_MESSAGE",
+            "group_name": rng.choice(client.groups),
+            "from": client.username,
+            "message": f"{now} hello group",
+        }
+    if kind == "FILE":
+        return {"type": "FILE", **base, "filename": f"{now}.bin", "data": file_data}
+    if kind == "RTC":
+        if rng.random() < 0.5:
+            sdp = f"t={now}\r\n" + sdp_offer()
+            return {"type": "RTC_OFFER", **base, "sdp": sdp}
+        return {"type": "RTC_ICE", **base, "candidate": {"t": now, "sdpMid": "0"}}
+    return {"type": "MESSAGE", **base, "message": f"{now} hello"}
+
+
+async def run_clients(port, names, all_names, groups, args, seed):
+    rng = random.Random(seed)
+    stats = {
+        "latencies": [],
+        "errors": 0,
+        "sent": 0,
+        "expected": 0,  # deliveries the sent messages owe
+        "closed": 0,
+        "failed_writes": 0,
+    }
+    clients = [LoadClient(name, args.framing) for name in names]
+    for i in range(0, len(clients), 100):  # log in in batches of 100
+        await asyncio.gather(*(c.login(port) for c in clients[i : i + 100]))
+    by_name = {c.username: c for c in clients}
+    for group_name, members in groups.items():
+        for member in members:
+            if member in by_name:
+                by_name[member].groups.append(group_name)
+        if members[0] in by_name:
+            by_name[members[0]].send(
+                {"type": "CREATE_GROUP", "group_name": group_name, "members": members}
+            )
+    readers = [asyncio.ensure_future(c.receive(stats)) for c in clients]
+    await asyncio.sleep(args.settle)
+
+    kinds = list(args.mix)
+    weights = [args.mix[k] for k in kinds]
+    file_data = base64.b64encode(os.urandom(args.file_kb * 1024)).decode()
+    deadline = time.monotonic() + args.duration
+
+    async def sender(client):
+        while True:
+            await asyncio.sleep(rng.expovariate(args.rate))
+            if time.monotonic() >= deadline:
+                return
+            kind = rng.choices(kinds, weights)[0]
+            msg = make_message(client, kind, all_names, file_data, rng)
+            stats["sent"] += 1
+            if msg["type"] == "GROUP_MESSAGE":
+                stats["expected"] += len(groups[msg["group_name"]]) - 1
+            else:
+                stats["expected"] += 1
+            if client.closed or client.writer.is_closing():
+                stats["failed_writes"] += 1
+                continue
+            client.send(msg)
+
+    stats["latencies"].clear()  # only count the measured window
+    stats["errors"] = 0
+    await asyncio.gather(*(sender(c) for c in clients))
+    await asyncio.sleep(args.drain)
+    for r in readers:
+        r.cancel()
+    for c in clients:
+        c.writer.close()
+    return stats
+
+
+def load_process(port, names, all_names, groups, args, seed, results):
+    raise_nofile_limit()
+    results.put(asyncio.run(run_clients(port, names, all_names, groups, args, seed)))
+
+
+def run_step(users, args, port, pid):
+    names = [f"load{i}" for i in range(users)]
+    groups = {
+        f"loadgroup{g}": names[g * args.group_size : (g + 1) * args.group_size]
+        for g in range(users // args.group_size)
+    }
+    results = multiprocessing.Queue()
+    procs = [
+        multiprocessing.Process(
+            target=load_process,
+            args=(port, names[n :: args.procs], names, groups, args, n, results),
+        )
+        for n in range(args.procs)
+    ]
+    cpu0 = cpu_seconds(pid) if pid else None
+    t0 = time.monotonic()
+    for p in procs:
+        p.start()
+    outcomes = [results.get() for _ in procs]
+    elapsed = time.monotonic() - t0
+    for p in procs:
+        p.join()
+    cpu = cpu_seconds(pid) - cpu0 if cpu0 is not None else None
+    rss = rss_bytes(pid) if pid else None
+
+    latencies = [lat for o in outcomes for lat in o["latencies"]]
+    sent = sum(o["sent"] for o in outcomes)
+    undelivered = sum(o["expected"] for o in outcomes) - len(latencies)
+    errors = sum(o["errors"] + o["closed"] + o["failed_writes"] for o in outcomes)
+    return (
+        users,
+        f"{sent / args.duration:,.0f}",
+        f"{len(latencies) / args.duration:,.0f}",
+        f"{undelivered:,}",
+        f"{percentile(latencies, 50) * 1000:.2f}",
+        f"{percentile(latencies, 99) * 1000:.2f}",
+        f"{percentile(latencies, 99.9) * 1000:.2f}",
+        f"{rss / 1e6:.0f}" if rss else "-",
+        f"{cpu / elapsed * 100:.0f}" if cpu is not None else "-",
+        errors,
+    )
+
+
+def parse_mix(items):
+    mix = {}
+    for item in items:
+        kind, _, weight = item.partition("=")
+        if kind not in KINDS:
+            raise argparse.ArgumentTypeError(f"unknown kind {kind} (one of {KINDS})")
+        mix[kind] = float(weight or 1)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", nargs="+", type=int, default=[250, 500, 1000])
+    parser.add_argument("--rate", type=float, default=1.0, help="msgs/s per client")
+    parser.add_argument("--duration", type=float, default=15.0)
+    parser.add_argument("--mix", nargs="+", default=DEFAULT_MIX)
+    parser.add_argument("--group-size", type=int, default=20)
+    parser.add_argument("--file-kb", type=int, default=16)
+    parser.add_argument("--framing", choices=[FRAMING_JSON, FRAMING_LENGTH])
+    parser.add_argument("--procs", type=int, default=1, help="load processes")
+    parser.add_argument("--mode", default="asyncio", help="server --mode")
+    parser.add_argument("--server-args", default="", help="extra main.py args")
+    parser.add_argument("--port", type=int, help="use a running server")
+    parser.add_argument("--pid", type=int, help="its pid, for RSS/CPU")
+    parser.add_argument("--settle", type=float, default=2.0)
+    parser.add_argument("--drain", type=float, default=2.0)
+    args = parser.parse_args()
+    args.framing = args.framing or FRAMING_LENGTH
+    args.mix = parse_mix(args.mix)
+    raise_nofile_limit()
+
+    rows = []
+    for users in args.users:
+        if args.port:
+            rows.append(run_step(users, args, args.port, args.pid))
+            continue
+        data_dir = tempfile.mkdtemp(prefix="loadgen-")
+        port = free_port()
+        proc = start_server(
+            port,
+            "--mode",
+            args.mode,
+            "--history-db",
+            os.path.join(data_dir, "history.db"),
+            "--inbox-db",
+            os.path.join(data_dir, "inbox.db"),
+            "--blob-dir",
+            os.path.join(data_dir, "blobs"),
+            *shlex.split(args.server_args),
+            rate_limit=True,
+        )
+        try:
+            rows.append(run_step(users, args, port, proc.pid))
+        finally:
+            stop_server(proc)
+            shutil.rmtree(data_dir, ignore_errors=True)
+    mix = " ".join(f"{k}={v:g}" for k, v in args.mix.items())
+    print(
+        f"{args.mode} server, {args.framing} framing, {args.rate:g} msgs/s per "
+        f"client for {args.duration:g}s, mix {mix}"
+    )
+    print_table(
+        ["users", "sent/s", "delivered/s", "undelivered", "p50 ms", "p99 ms"]
+        + ["p999 ms"]
+        + ["RSS MB", "CPU %", "errors"],
+        rows,
+    )
+
+
+if __name__ == "__main__":
+    main()
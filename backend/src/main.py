@@ -1,13 +1,438 @@
 # backend/src/main.py
-from services.chat_server import app
+import argparse
+import os
+import signal
+import sys
+import zlib
+
+from services import chat_server, async_chat_server, cluster, metrics, workers
+from services import ratelimit
+from utils import framing
+from services.connection import Connection
+from services.log import LEVELS, log
+from models import BlobStore, HistoryStore, InboxStore, history_store
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data")
+
+SERVER_MODES = {
+    "threaded": chat_server.app,
+    "asyncio": async_chat_server.app,
+}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Chat App RTC Server")
+    parser.add_argument(
+        "--mode",
+        choices=sorted(SERVER_MODES),
+        default="threaded",
+        help="threaded: one thread per client, asyncio: single event loop",
+    )
+    parser.add_argument("--host", default=None, help="bind address (default: LAN IP)")
+    parser.add_argument("--port", type=int, default=4105)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="worker processes sharing the port (SO_REUSEPORT)",
+    )
+    parser.add_argument(
+        "--cluster-listen",
+        default=None,
+        metavar="HOST:PORT",
+        help="join a cluster: accept node-to-node links on this address",
+    )
+    parser.add_argument(
+        "--directory",
+        default=None,
+        metavar="URL",
+        help="cluster presence directory, e.g. builtin://10.0.0.1:4200",
+    )
+    parser.add_argument(
+        "--directory-serve",
+        action="store_true",
+        help="host the builtin directory named by --directory in this process",
+    )
+    parser.add_argument(
+        "--node-id",
+        default=None,
+        help="name of this node in the cluster (default: --cluster-listen)",
+    )
+    parser.add_argument(
+        "--history-node",
+        type=int,
+        default=None,
+        metavar="N",
+        help="0-255, part of every history message id; give each cluster node"
+        " its own (default: worker number, or derived from the node name)",
+    )
+    # set by the supervisor on the workers it starts
+    parser.add_argument("--bus", default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--worker-id", type=int, default=0, help=argparse.SUPPRESS)
+    parser.add_argument(
+        "--presence-window",
+        type=float,
+        default=50,
+        help="ms to coalesce joins/leaves into one PRESENCE_DELTA",
+    )
+    parser.add_argument(
+        "--ice-batch-window",
+        type=float,
+        default=5,
+        help="ms to coalesce trickled RTC_ICE candidates into one frame (0: off)",
+    )
+    parser.add_argument(
+        "--send-queue-high",
+        type=int,
+        default=Connection.high_watermark // 1024,
+        help="KiB queued before a client counts as congested",
+    )
+    parser.add_argument(
+        "--send-queue-low",
+        type=int,
+        default=Connection.low_watermark // 1024,
+        help="KiB a congested client must drain to",
+    )
+    parser.add_argument(
+        "--send-queue-max",
+        type=int,
+        default=Connection.max_queue_bytes // 1024,
+        help="KiB queued before a client is evicted",
+    )
+    parser.add_argument(
+        "--slow-consumer-timeout",
+        type=float,
+        default=Connection.slow_consumer_timeout,
+        help="seconds a client may stay congested before eviction",
+    )
+    parser.add_argument(
+        "--write-batch",
+        type=int,
+        default=Connection.write_batch,
+        help="frames queued to a client that go out in one write (1: no batching)",
+    )
+    parser.add_argument(
+        "--write-quantum",
+        type=int,
+        default=Connection.write_quantum // 1024,
+        help="KiB of bulk data a signaling frame may wait behind",
+    )
+    parser.add_argument(
+        "--no-lanes",
+        action="store_true",
+        help="send frames in arrival order instead of signaling before bulk",
+    )
+    parser.add_argument(
+        "--socket-send-buffer",
+        type=int,
+        default=0,
+        help="KiB of SO_SNDBUF per client socket (0: kernel default, autotuned)",
+    )
+    parser.add_argument(
+        "--no-nodelay",
+        action="store_true",
+        help="leave Nagle's algorithm on for client sockets",
+    )
+    parser.add_argument(
+        "--blob-dir",
+        default=os.path.join(DATA_DIR, "blobs"),
+        help="attachment blob store directory (shared by every cluster node)",
+    )
+    parser.add_argument(
+        "--no-blobs",
+        action="store_true",
+        help="disable the blob store (files are relayed peer to peer)",
+    )
+    parser.add_argument(
+        "--max-blob-size",
+        type=int,
+        default=chat_server.MAX_BLOB_SIZE // (1024 * 1024),
+        help="MiB a single attachment may take in the blob store",
+    )
+    parser.add_argument(
+        "--blob-ttl",
+        type=float,
+        default=chat_server.BLOB_TTL / 86400,
+        help="days an unused blob is kept (0: forever)",
+    )
+    parser.add_argument(
+        "--blob-max-size",
+        type=int,
+        default=0,
+        help="MiB the blob store may hold; least recently used go (0: no cap)",
+    )
+    parser.add_argument(
+        "--history-db",
+        default=os.path.join(DATA_DIR, "history.db"),
+        help="SQLite file for message history",
+    )
+    parser.add_argument(
+        "--no-history",
+        action="store_true",
+        help="do not store message history",
+    )
+    parser.add_argument(
+        "--inbox-db",
+        default=os.path.join(DATA_DIR, "inbox.db"),
+        help="SQLite file for messages to offline users",
+    )
+    parser.add_argument(
+        "--no-inbox",
+        action="store_true",
+        help="reject messages to offline users instead of queueing them",
+    )
+    parser.add_argument(
+        "--inbox-max-messages",
+        type=int,
+        default=1000,
+        help="messages kept per offline user (oldest dropped first)",
+    )
+    parser.add_argument(
+        "--inbox-max-size",
+        type=int,
+        default=16 * 1024,
+        help="KiB kept per offline user (oldest dropped first)",
+    )
+    parser.add_argument(
+        "--inbox-ttl",
+        type=float,
+        default=7,
+        help="days a queued message is kept",
+    )
+    parser.add_argument(
+        "--stats-interval",
+        type=float,
+        default=0,
+        help="log send queue and compression stats every N seconds (0: off)",
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        default=0,
+        help="serve Prometheus /metrics on this port (0: off; worker N uses +N)",
+    )
+    parser.add_argument(
+        "--metrics-host",
+        default="127.0.0.1",
+        help="admin address for --metrics-port",
+    )
+    parser.add_argument(
+        "--compress-threshold",
+        type=int,
+        default=framing.COMPRESS_THRESHOLD,
+        help="bytes a frame needs before it is compressed",
+    )
+    parser.add_argument(
+        "--no-compression",
+        action="store_true",
+        help="never agree to compress frames at LOGIN",
+    )
+    parser.add_argument(
+        "--no-msgpack",
+        action="store_true",
+        help="never agree to MessagePack frame bodies at LOGIN",
+    )
+    parser.add_argument(
+        "--log-level",
+        choices=sorted(LEVELS, key=LEVELS.get),
+        default="info",
+        help="debug also logs (sampled) traffic; SIGUSR1 toggles debug at runtime",
+    )
+    parser.add_argument(
+        "--log-format", choices=["text", "json"], default="text", help="log lines"
+    )
+    parser.add_argument(
+        "--log-sample",
+        nargs="+",
+        default=[],
+        metavar="TYPE=N",
+        help="log 1 in N debug traffic records of TYPE (0: none)",
+    )
+    parser.add_argument(
+        "--log-truncate",
+        type=int,
+        default=log.truncate,
+        help="characters of each payload field kept in debug records",
+    )
+    parser.add_argument(
+        "--ping-interval",
+        type=float,
+        default=chat_server.PING_INTERVAL,
+        help="seconds of silence before a client is sent a PING",
+    )
+    parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        default=chat_server.IDLE_TIMEOUT,
+        help="seconds of silence before a client is dropped as dead (0: never)",
+    )
+    parser.add_argument(
+        "--resume-grace",
+        type=float,
+        default=chat_server.RESUME_GRACE,
+        help="seconds a dropped client may resume its session (0: never)",
+    )
+    parser.add_argument(
+        "--resume-buffer",
+        type=int,
+        default=chat_server.RESUME_BUFFER_BYTES // 1024,
+        help="KiB of unacknowledged frames kept per session for a resume",
+    )
+    parser.add_argument(
+        "--rate-limit",
+        nargs="*",
+        default=None,
+        metavar="TYPE=RATE[/BURST]",
+        help="turn on per-user rate limits (services.ratelimit.DEFAULT_LIMITS),"
+        " overriding messages/s (and burst) for TYPE; * for unlisted types",
+    )
+    # rate limits are off unless asked for; kept so old command lines work
+    parser.add_argument("--no-rate-limit", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument(
+        "--byte-rate",
+        type=int,
+        default=ratelimit.DEFAULT_BYTE_RATE // 1024,
+        help="KiB/s per user across all message types (delayed, never refused)",
+    )
+    parser.add_argument(
+        "--byte-burst",
+        type=int,
+        default=ratelimit.DEFAULT_BYTE_BURST // 1024,
+        help="KiB a user may send at once before --byte-rate applies",
+    )
+    parser.add_argument(
+        "--rate-max-delay",
+        type=float,
+        default=ratelimit.MAX_DELAY,
+        help="seconds a message over its limit is held before it is refused",
+    )
+    args = parser.parse_args()
+    if args.cluster_listen and not args.directory:
+        parser.error("--cluster-listen needs --directory")
+    if 0 < args.idle_timeout <= args.ping_interval:
+        parser.error("--ping-interval must be shorter than --idle-timeout")
+    if args.cluster_listen and args.workers > 1:
+        parser.error("--workers and --cluster-listen cannot be combined yet")
+    max_node = (1 << history_store.ID_NODE_BITS) - 1
+    if not 1 <= args.workers <= max_node + 1:
+        parser.error(f"--workers must be between 1 and {max_node + 1}")
+    if args.workers > 1 and args.history_node is not None:
+        parser.error("--history-node cannot be combined with --workers")
+    if args.history_node is None:
+        args.history_node = args.worker_id
+        if args.cluster_listen:
+            name = args.node_id or args.cluster_listen
+            args.history_node = zlib.crc32(name.encode()) & max_node
+    if not 0 <= args.history_node <= max_node:
+        parser.error(f"--history-node must be between 0 and {max_node}")
+    return args
+
 
 if __name__ == "__main__":
+    args = parse_args()
+    if args.workers > 1 and args.bus is None:
+        print("🚀 Starting Chat App RTC Server...")
+        workers.supervise(args.workers, sys.argv[1:])
+        sys.exit(0)
+    log.set_level(args.log_level)
+    log.fmt = args.log_format
+    log.truncate = args.log_truncate
+    for item in args.log_sample:
+        msg_type, _, every = item.partition("=")
+        log.sampling[msg_type] = int(every)
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: log.toggle_debug())
+    if args.rate_limit is not None and not args.no_rate_limit:
+        limits = dict(ratelimit.DEFAULT_LIMITS)
+        for item in args.rate_limit:
+            msg_type, _, spec = item.partition("=")
+            rate, _, burst = spec.partition("/")
+            rate = float(rate)
+            limits[msg_type] = (rate, float(burst) if burst else max(1.0, rate))
+        chat_server.limiter = ratelimit.RateLimiter(
+            limits,
+            byte_rate=args.byte_rate * 1024,
+            byte_burst=args.byte_burst * 1024,
+            max_delay=args.rate_max_delay,
+        )
+        chat_server.start_limiter_sweeper()
+    chat_server.resume_grace = args.resume_grace
+    chat_server.resume_buffer = args.resume_buffer * 1024
+    chat_server.presence.flush_interval = args.presence_window / 1000
+    chat_server.ice_batch.window = args.ice_batch_window / 1000
+    Connection.high_watermark = args.send_queue_high * 1024
+    Connection.low_watermark = args.send_queue_low * 1024
+    Connection.max_queue_bytes = args.send_queue_max * 1024
+    Connection.slow_consumer_timeout = args.slow_consumer_timeout
+    Connection.write_batch = max(1, args.write_batch)
+    Connection.write_quantum = max(1, args.write_quantum) * 1024
+    Connection.nodelay = not args.no_nodelay
+    Connection.lanes = not args.no_lanes
+    Connection.send_buffer = args.socket_send_buffer * 1024
+    framing.COMPRESS_THRESHOLD = args.compress_threshold
+    if args.no_compression:
+        framing.SUPPORTED_CODECS = ()
+    if args.no_msgpack:
+        framing.SUPPORTED_SERIALIZATIONS = (framing.SERIALIZATION_JSON,)
+    if not args.no_blobs:
+        chat_server.blob_store = BlobStore(args.blob_dir)
+        chat_server.MAX_BLOB_SIZE = args.max_blob_size * 1024 * 1024
+        chat_server.BLOB_TTL = args.blob_ttl * 86400 if args.blob_ttl else None
+        chat_server.BLOB_MAX_BYTES = args.blob_max_size * 1024 * 1024 or None
+        chat_server.start_blob_collector()
+    if not args.no_history:
+        os.makedirs(os.path.dirname(os.path.abspath(args.history_db)), exist_ok=True)
+        chat_server.history = HistoryStore(args.history_db, node=args.history_node)
+    if not args.no_inbox:
+        os.makedirs(os.path.dirname(os.path.abspath(args.inbox_db)), exist_ok=True)
+        chat_server.inbox = InboxStore(
+            args.inbox_db,
+            max_messages=args.inbox_max_messages,
+            max_bytes=args.inbox_max_size * 1024,
+            ttl=args.inbox_ttl * 86400,
+        )
+        chat_server.start_inbox_purger()
+    if args.bus is not None:
+        chat_server.bus = workers.WorkerBus(
+            args.bus, args.worker_id, chat_server.on_bus_op
+        )
+    if args.cluster_listen:
+        if args.directory_serve:
+            directory = cluster.urlsplit(args.directory)
+            cluster.serve_directory((directory.hostname, directory.port))
+        chat_server.bus = cluster.ClusterBus(
+            args.node_id or args.cluster_listen,
+            cluster.parse_address(args.cluster_listen),
+            args.directory,
+            chat_server.on_bus_op,
+            shared_dir=None if args.no_blobs else args.blob_dir,
+        )
+    if args.idle_timeout > 0:
+        chat_server.start_keepalive(args.ping_interval, args.idle_timeout)
+    if args.stats_interval > 0:
+        chat_server.start_stats_reporter(args.stats_interval)
+    if args.metrics_port:
+        metrics_port = args.metrics_port + args.worker_id
+        metrics.serve(chat_server.metrics, args.metrics_host, metrics_port)
     print("🚀 Starting Chat App RTC Server...")
+    print(f"Mode: {args.mode}")
+    if args.bus is not None:
+        print(f"Worker: {args.worker_id + 1} of {args.workers}")
+    if args.cluster_listen:
+        print(f"Cluster node: {args.node_id or args.cluster_listen}")
+    if args.metrics_port:
+        print(f"Metrics: http://{args.metrics_host}:{metrics_port}/metrics")
     print("Press Ctrl+C to stop")
     print("-" * 50)
     try:
-        app()
+        SERVER_MODES[args.mode](
+            port=args.port, host=args.host, reuse_port=args.bus is not None
+        )
     except KeyboardInterrupt:
         print("\n✅ Server stopped successfully!")
     except Exception as e:
         print(f"❌ Server error: {e}")
+    finally:
+        log.flush()
+        if chat_server.history is not None:
+            chat_server.history.close()  # commit what is still queued
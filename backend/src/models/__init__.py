@@ -0,0 +1,3 @@
+from .blob_store import BlobStore
+from .history_store import HistoryStore, direct_conversation, group_conversation
+from .inbox_store import InboxStore
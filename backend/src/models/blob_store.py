@@ -0,0 +1,157 @@
+import hashlib
+import os
+import re
+import time
+
+SHA256_HEX = re.compile(r"[0-9a-f]{64}")
+PARTIAL_TTL = 24 * 3600  # seconds an untouched partial upload is kept
+
+
+class BlobUpload:
+    """One client's upload of one blob into <root>/partial.
+
+    The partial file is named after the blob and the uploader, so the same
+    user offering the same blob again resumes at `offset` while the file is
+    there. abort() removes it; one left behind by a crash is collected once
+    it is PARTIAL_TTL old.
+    """
+
+    def __init__(self, store, sha256, size, owner):
+        self.store = store
+        self.sha256 = sha256
+        self.size = size
+        owner_key = hashlib.sha256(owner.encode()).hexdigest()[:16]
+        self.partial_path = os.path.join(store.root, "partial", f"{sha256}.{owner_key}")
+        self._hash = hashlib.sha256()
+        self.offset = 0
+        if os.path.exists(self.partial_path):
+            with open(self.partial_path, "rb") as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""):
+                    self._hash.update(block)
+                    self.offset += len(block)
+        if self.offset > size:
+            self._hash, self.offset = hashlib.sha256(), 0
+        self._file = open(self.partial_path, "r+b" if self.offset else "wb")
+        self._file.truncate(self.offset)
+        self._file.seek(self.offset)
+
+    def write(self, offset, data):
+        """Append one chunk; False if it is not the one expected"""
+        if offset != self.offset or self.offset + len(data) > self.size:
+            return False
+        self._file.write(data)
+        self._hash.update(data)
+        self.offset += len(data)
+        return True
+
+    def commit(self):
+        """Move the blob into place if complete and the hash matches"""
+        self._file.close()
+        if self.offset != self.size or self._hash.hexdigest() != self.sha256:
+            os.remove(self.partial_path)
+            return False
+        path = self.store.path(self.sha256)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(self.partial_path, path)
+        return True
+
+    def abort(self):
+        """Give up on the upload and remove what it wrote"""
+        self._file.close()
+        try:
+            os.remove(self.partial_path)
+        except FileNotFoundError:
+            pass
+
+
+class BlobStore:
+    """Content-addressed attachment store on local disk.
+
+    Blobs live at <root>/ab/cd/<sha256>; two levels of sharding keep each
+    directory small. A blob is only visible once fully uploaded and
+    verified, so has() never returns a partial file.
+
+    A blob's mtime is when it was last used (stored, offered again or
+    read); collect() removes the ones unused for `ttl` seconds, then the
+    least recently used while the store holds more than `max_bytes`.
+    """
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        os.makedirs(os.path.join(self.root, "partial"), exist_ok=True)
+
+    @staticmethod
+    def valid(sha256):
+        return isinstance(sha256, str) and bool(SHA256_HEX.fullmatch(sha256))
+
+    def path(self, sha256):
+        if not self.valid(sha256):
+            raise ValueError(f"not a sha256 hex digest: {sha256!r}")
+        return os.path.join(self.root, sha256[:2], sha256[2:4], sha256)
+
+    def size(self, sha256):
+        """Size of a stored blob, or None if the store does not have it.
+
+        Asking counts as a use: the caller is about to hand it out again.
+        """
+        path = self.path(sha256)
+        try:
+            os.utime(path)
+            return os.path.getsize(path)
+        except OSError:
+            return None
+
+    def open_upload(self, sha256, size, owner):
+        self.path(sha256)  # validates the digest before it names a file
+        return BlobUpload(self, sha256, size, owner)
+
+    def open(self, sha256):
+        """The stored blob opened for reading (raises OSError if missing)"""
+        f = open(self.path(sha256), "rb")
+        os.utime(f.fileno())
+        return f
+
+    def read(self, sha256, offset, length):
+        with self.open(sha256) as f:
+            f.seek(offset)
+            return f.read(length)
+
+    def collect(self, ttl=None, max_bytes=None, now=None):
+        """Remove stale partial uploads and blobs past the retention policy.
+
+        Returns the number of blobs removed.
+        """
+        now = time.time() if now is None else now
+        partial_dir = os.path.join(self.root, "partial")
+        for entry in os.scandir(partial_dir):
+            try:
+                if entry.stat().st_mtime < now - PARTIAL_TTL:
+                    os.remove(entry.path)
+            except FileNotFoundError:
+                pass  # finished or collected meanwhile
+        blobs = []  # (last used, size, path)
+        for dirpath, _, filenames in os.walk(self.root):
+            if dirpath == partial_dir:
+                continue
+            for name in filenames:
+                if self.valid(name):
+                    path = os.path.join(dirpath, name)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    blobs.append((st.st_mtime, st.st_size, path))
+        blobs.sort()
+        total = sum(size for _, size, _ in blobs)
+        removed = 0
+        for used, size, path in blobs:
+            expired = ttl is not None and used < now - ttl
+            if not expired and (max_bytes is None or total <= max_bytes):
+                break  # the rest are newer
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        return removed
@@ -0,0 +1,190 @@
+import sqlite3
+import threading
+import time
+
+from services.log import log
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    conversation TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    sender_display TEXT NOT NULL,
+    body TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_by_conversation ON messages (conversation, id);
+"""
+
+MAX_PAGE = 200
+
+# Message ids: milliseconds, then the writer's node number (0 unless
+# several worker processes share the file), then a sequence number within
+# the millisecond. Ids from every node sort in time order, which is what
+# history pages are ordered by.
+ID_NODE_BITS = 8
+ID_SEQ_BITS = 12
+ID_TIME_SHIFT = ID_NODE_BITS + ID_SEQ_BITS
+NEWEST = (1 << 63) - 1  # before_id of the first page
+
+# A batch that fails to commit (say "database is locked" while another
+# process holds the file) is retried, backing off up to the max delay.
+WRITE_BUSY_TIMEOUT = 5.0
+WRITE_RETRY_DELAY = 0.05
+WRITE_RETRY_MAX_DELAY = 5.0
+
+
+def direct_conversation(a, b):
+    """The same key whichever side of a direct chat asks"""
+    return "dm:" + ":".join(sorted((a, b)))
+
+
+def group_conversation(group_name):
+    return f"group:{group_name}"
+
+
+class HistoryStore:
+    """Message history in SQLite (WAL mode), written with group commit.
+
+    append() only assigns the message id and queues the row; one writer
+    thread inserts everything queued since its last transaction in a single
+    commit, so under load many messages share one fsync. Readers use their
+    own per-thread connections and, thanks to WAL, never wait for the writer.
+
+    Pages are keyset-paginated on the (conversation, id) index: "the newest
+    `limit` messages with id < before_id", which costs the same at any depth
+    (OFFSET would scan every skipped row).
+    """
+
+    def __init__(self, path, max_batch=1000, node=0):
+        self.path = path
+        self.max_batch = max_batch
+        self.node = node
+        self.commits = 0
+        self._local = threading.local()
+        db = self._connect()
+        db.executescript(SCHEMA)
+        (last_id,) = db.execute("SELECT COALESCE(MAX(id), 0) FROM messages").fetchone()
+        # carry on after the last id, even if the clock now reads earlier
+        self._last_ms = last_id >> ID_TIME_SHIFT
+        self._seq = last_id & ((1 << ID_SEQ_BITS) - 1)
+        self._cond = threading.Condition()
+        self._pending = []
+        self._queued = last_id  # highest id handed to the writer
+        self._committed = last_id  # highest id on disk
+        self._closed = False
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def _connect(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            # WAL + NORMAL: a commit is one WAL append, fsync at checkpoints
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def append(self, conversation, sender, sender_display, body):
+        """Queue one message; returns its id right away"""
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("history store is closed")
+            message_id = self._next_id()
+            self._pending.append(
+                (message_id, conversation, sender, sender_display, body, time.time())
+            )
+            self._queued = message_id
+            self._cond.notify_all()
+        return message_id
+
+    def _next_id(self):
+        ms = max(int(time.time() * 1000), self._last_ms)
+        if ms == self._last_ms:
+            self._seq += 1
+            if self._seq >> ID_SEQ_BITS:
+                ms, self._seq = ms + 1, 0  # borrow the next millisecond
+        else:
+            self._seq = 0
+        self._last_ms = ms
+        return (ms << ID_TIME_SHIFT) | (self.node << ID_SEQ_BITS) | self._seq
+
+    def _write_loop(self):
+        db = sqlite3.connect(
+            self.path, isolation_level=None, timeout=WRITE_BUSY_TIMEOUT
+        )
+        db.execute("PRAGMA synchronous=NORMAL")
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if not self._pending:
+                    db.close()
+                    return
+                batch = self._pending[: self.max_batch]
+                del self._pending[: self.max_batch]
+            committed = self._insert(db, batch)
+            with self._cond:
+                self.commits += committed
+                self._committed = batch[-1][0]
+                self._cond.notify_all()
+
+    def _insert(self, db, batch):
+        """Commit one batch, retrying until it lands or the store is closed"""
+        delay = WRITE_RETRY_DELAY
+        while True:
+            try:
+                db.execute("BEGIN")
+                db.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?)", batch)
+                db.execute("COMMIT")
+                return True
+            except sqlite3.Error as exc:
+                if db.in_transaction:
+                    db.execute("ROLLBACK")
+                log.warning("history_write_failed", error=str(exc), messages=len(batch))
+            with self._cond:
+                if self._cond.wait_for(lambda: self._closed, delay):
+                    log.error("history_batch_dropped", messages=len(batch))
+                    return False
+            delay = min(delay * 2, WRITE_RETRY_MAX_DELAY)
+
+    def flush(self, timeout=None):
+        """Wait until everything appended so far is committed"""
+        with self._cond:
+            target = self._queued
+            return self._cond.wait_for(lambda: self._committed >= target, timeout)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._writer.join()
+
+    def page(self, conversation, before_id=None, limit=50):
+        """Up to `limit` messages older than `before_id`, oldest first.
+
+        Returns (messages, next_before_id); next_before_id is None once the
+        start of the conversation is reached.
+        """
+        limit = max(1, min(limit, MAX_PAGE))
+        if before_id is None:
+            before_id = NEWEST
+        rows = self._connect().execute(
+            "SELECT id, sender, sender_display, body, created_at FROM messages"
+            " WHERE conversation = ? AND id < ? ORDER BY id DESC LIMIT ?",
+            (conversation, before_id, limit + 1),
+        ).fetchall()
+        more = len(rows) > limit
+        rows = rows[:limit]
+        messages = [
+            {
+                "id": message_id,
+                "from": sender,
+                "from_display": sender_display,
+                "message": body,
+                "time": created_at,
+            }
+            for message_id, sender, sender_display, body, created_at in reversed(rows)
+        ]
+        return messages, (rows[-1][0] if more else None)
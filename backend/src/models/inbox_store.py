@@ -0,0 +1,130 @@
+import json
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS inbox (
+    id INTEGER PRIMARY KEY,
+    recipient TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS inbox_by_recipient ON inbox (recipient, id);
+CREATE INDEX IF NOT EXISTS inbox_by_expiry ON inbox (expires_at);
+"""
+
+
+class InboxStore:
+    """Durable store-and-forward inboxes for users who are offline.
+
+    Only users who have logged in before (remember()) get an inbox, so a
+    typo in "to" cannot create one. Each inbox keeps at most `max_messages`
+    messages and `max_bytes` of payload, dropping the oldest first, and
+    messages expire after `ttl` seconds.
+
+    Delivery is at-least-once: drain() reads an inbox without emptying it,
+    and ack() deletes what was read once the client has it.
+    """
+
+    def __init__(
+        self, path, max_messages=1000, max_bytes=16 * 1024 * 1024, ttl=7 * 86400
+    ):
+        self.path = path
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+        self._known = {u for (u,) in self._db.execute("SELECT username FROM users")}
+
+    def remember(self, username):
+        if username not in self._known:
+            with self._lock:
+                self._db.execute("INSERT OR IGNORE INTO users VALUES (?)", (username,))
+            self._known.add(username)
+
+    def known(self, username):
+        if username not in self._known:
+            # another worker process may have met them since
+            with self._lock:
+                row = self._db.execute(
+                    "SELECT 1 FROM users WHERE username = ?", (username,)
+                ).fetchone()
+            if row is None:
+                return False
+            self._known.add(username)
+        return True
+
+    def deposit(self, recipient, payload):
+        """Queue `payload` (a dict) for `recipient`; False if it cannot be"""
+        if not self.known(recipient):
+            return False
+        data = json.dumps(payload)
+        if len(data) > self.max_bytes:
+            return False
+        now = time.time()
+        with self._lock:
+            db = self._db
+            db.execute("BEGIN")
+            db.execute(
+                "INSERT INTO inbox (recipient, payload, size, expires_at)"
+                " VALUES (?, ?, ?, ?)",
+                (recipient, data, len(data), now + self.ttl),
+            )
+            # trim from the oldest end: expired first, then over the caps
+            rows = db.execute(
+                "SELECT id, size, expires_at FROM inbox WHERE recipient = ?"
+                " ORDER BY id DESC",
+                (recipient,),
+            ).fetchall()
+            count = total = 0
+            cut = None
+            for message_id, size, expires_at in rows:
+                count += 1
+                total += size
+                if (
+                    expires_at <= now
+                    or count > self.max_messages
+                    or total > self.max_bytes
+                ):
+                    cut = message_id
+                    break
+            if cut is not None:
+                db.execute(
+                    "DELETE FROM inbox WHERE recipient = ? AND id <= ?", (recipient, cut)
+                )
+            db.execute("COMMIT")
+        return True
+
+    def drain(self, recipient):
+        """(payloads oldest first, last id) still waiting for `recipient`"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, payload FROM inbox WHERE recipient = ? AND expires_at > ?"
+                " ORDER BY id",
+                (recipient, time.time()),
+            ).fetchall()
+        if not rows:
+            return [], None
+        return [json.loads(payload) for _, payload in rows], rows[-1][0]
+
+    def ack(self, recipient, last_id):
+        """Delete what drain() returned, now that it has been delivered"""
+        with self._lock:
+            self._db.execute(
+                "DELETE FROM inbox WHERE recipient = ? AND id <= ?", (recipient, last_id)
+            )
+
+    def purge_expired(self):
+        with self._lock:
+            return self._db.execute(
+                "DELETE FROM inbox WHERE expires_at <= ?", (time.time(),)
+            ).rowcount
@@ -0,0 +1,332 @@
+import asyncio
+import threading
+import time
+import sys
+from collections import deque
+
+from utils import get_lan_ip
+from services.connection import (
+    LANE_BULK,
+    LANE_CHAT,
+    LANE_PRELUDE,
+    PICK_ORDER,
+    Connection,
+    FileRange,
+    SlowConsumerError,
+    tune_socket,
+)
+from services.log import log
+from services.chat_server import (
+    SCHEDULING_QUANTUM,
+    admit,
+    clients,
+    metrics,
+    new_state,
+    handle_message,
+    handle_disconnect,
+    watch_idle,
+)
+
+
+class ChatProtocol(asyncio.Protocol, Connection):
+    """One client connection served on the event loop.
+
+    Implements Connection on top of the transport so the handlers in
+    chat_server.py work unchanged. No thread or StreamReader per connection:
+    idle sessions only cost this object and the transport. Frames wait in
+    per-lane queues and are handed to the transport together at the end of
+    a pass of the loop, highest priority lane first, so a burst of relays
+    costs one send() per socket. Bulk frames are only handed over while the
+    transport holds less than write_quantum bytes (its pause/resume
+    callbacks say when), so signaling never queues behind more than that.
+    While a FileRange is being sent with loop.sendfile() the transport
+    refuses writes; everything waits in the lanes until it is done.
+    """
+
+    def __init__(self, loop):
+        Connection.__init__(self)
+        self.loop = loop
+        self.loop_thread = threading.get_ident()  # factory runs on the loop
+        self.transport = None
+        self.state = new_state()
+        self._lanes = [deque() for _ in PICK_ORDER]
+        self._lanes_bytes = 0
+        self._flush_scheduled = False
+        self._sending_file = False  # loop.sendfile() running
+        self._reading_paused = False  # while a backlog waits its turn
+        self._blocking = 0  # run_blocking() jobs in the executor
+
+    @property
+    def queued_bytes(self):
+        if self.transport is None:
+            return 0
+        return self.transport.get_write_buffer_size() + self._lanes_bytes
+
+    @property
+    def socket(self):
+        return self.transport.get_extra_info("socket")
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(
+            high=self.write_quantum, low=self.write_quantum // 4
+        )
+        sock = transport.get_extra_info("socket")
+        if sock is not None:
+            tune_socket(sock, self.nodelay, self.send_buffer)
+        watch_idle(self)
+
+    def pause_writing(self):
+        pass  # bulk is held back by _flush() until resume_writing()
+
+    def resume_writing(self):
+        self._flush()
+
+    def data_received(self, data):
+        self.received_at = time.perf_counter()
+        # parse every complete message; partial ones stay buffered
+        self.decoder.feed(data)
+        self._process()
+
+    def _process(self, held=None):
+        """Handle buffered messages, at most SCHEDULING_QUANTUM bytes a turn.
+
+        The rest waits (reading paused) behind the callbacks of every other
+        connection, so busy senders are served round-robin. A message over
+        a rate limit is `held` until call_later brings it back here; one that
+        ran blocking I/O (run_blocking) holds the rest until it is done.
+        """
+        if self.transport is None or self.transport.is_closing():
+            return
+        if self._blocking:
+            return  # _unblock() comes back here
+        budget = SCHEDULING_QUANTUM
+        try:
+            if held is not None:
+                handle_message(self, held, self.state)
+                if self._blocking:
+                    self._pause_reading()
+                    return
+            for msg in self.decoder:
+                wait = admit(self, msg, self.state)
+                if wait:
+                    self._pause_reading()
+                    self.loop.call_later(wait, self._process, msg)
+                    return
+                if wait is not None:
+                    handle_message(self, msg, self.state)
+                if self._blocking:
+                    self._pause_reading()
+                    return
+                budget -= self.decoder.last_size
+                if budget <= 0 and self.decoder.buffered():
+                    self._pause_reading()
+                    self.loop.call_soon(self._process)
+                    return
+        except Exception as e:
+            self._failed(e)
+            return
+        if self._reading_paused:
+            self._reading_paused = False
+            self.transport.resume_reading()
+
+    def _failed(self, e):
+        if isinstance(e, (ConnectionResetError, BrokenPipeError)):
+            log.info("connection_lost", error=repr(e))  # not a handler bug
+        else:
+            log.error("handler_failed", error=repr(e))
+            metrics.inc("chat_errors_total", ("handler",))
+        self.close()
+
+    def run_blocking(self, fn, *args, then=None):
+        if threading.get_ident() != self.loop_thread:
+            Connection.run_blocking(self, fn, *args, then=then)
+            return
+        self._blocking += 1
+        future = self.loop.run_in_executor(None, fn, *args)
+        future.add_done_callback(lambda future: self._unblock(future, then))
+
+    def _unblock(self, future, then):
+        self._blocking -= 1
+        try:
+            result = future.result()
+            if then is not None:
+                then(result)
+        except Exception as e:
+            if self.transport.is_closing():
+                return  # gone meanwhile (its uploads closed under fn)
+            self._failed(e)
+            return
+        self._process()
+
+    def _pause_reading(self):
+        if not self._reading_paused:
+            self._reading_paused = True
+            self.transport.pause_reading()
+
+    def connection_lost(self, exc):
+        handle_disconnect(self, self.state)  # a session takes what is queued
+        self._discard()
+
+    def send(self, data, lane=LANE_CHAT):
+        """Queue in `lane`; safe to call from other threads"""
+        if self.transport is None or self.transport.is_closing():
+            raise ConnectionError("connection closed")
+        if threading.get_ident() == self.loop_thread:
+            self._write(data, lane)
+        else:
+            self.loop.call_soon_threadsafe(self._write_threadsafe, data, lane)
+        return len(data)
+
+    def _write(self, data, lane):
+        try:
+            self._admit(len(data))
+        except SlowConsumerError:
+            if isinstance(data, FileRange):
+                data.file.close()
+            raise
+        self._lanes[lane].append(data)
+        self._lanes_bytes += len(data)
+        if self.congested_since is None and self.queued_bytes > self.high_watermark:
+            self.congested_since = time.monotonic()
+        if self.write_batch <= 1:
+            self._flush()
+        elif not self._flush_scheduled:
+            self._flush_scheduled = True
+            self.loop.call_soon(self._flush)
+
+    def _flush(self, drain=False):
+        """Hand queued frames to the transport, highest priority first.
+
+        Bulk frames stop once the transport is full, unless `drain`; a
+        FileRange starts a sendfile and the rest waits until it is done.
+        """
+        self._flush_scheduled = False
+        if self.transport.is_closing() or self._sending_file:
+            return
+        out, numbered = [], []
+        room = self.write_quantum - self.transport.get_write_buffer_size()
+        for lane in PICK_ORDER:
+            queue = self._lanes[lane]
+            while queue:
+                if lane == LANE_BULK and room <= 0 and not drain:
+                    break
+                data = queue.popleft()
+                room -= len(data)
+                self._lanes_bytes -= len(data)
+                if lane != LANE_PRELUDE:
+                    numbered.append(data)
+                if isinstance(data, FileRange):
+                    self._write_out(out, numbered)
+                    self._sending_file = True
+                    self.loop.create_task(self._send_file(data))
+                    return
+                out.append(data)
+                if len(out) >= self.write_batch:
+                    self._write_out(out, numbered)
+                    out, numbered = [], []
+        self._write_out(out, numbered)
+        if (
+            self.congested_since is not None
+            and self.queued_bytes <= self.low_watermark
+        ):
+            self.congested_since = None
+
+    def _write_out(self, frames, numbered):
+        self._wrote(numbered)
+        if frames:
+            self._count_writes(len(frames))
+            self.transport.writelines(frames)
+            self._written(frames)
+
+    async def _send_file(self, rng):
+        try:
+            self._count_writes(1)
+            self.transport.write(rng.prefix)
+            # os.sendfile on plain TCP, read()+write() otherwise
+            await self.loop.sendfile(self.transport, rng.file, rng.offset, rng.length)
+        except Exception as e:
+            log.error("write_failed", error=repr(e))
+            self.abort()
+        finally:
+            rng.file.close()
+            self._sending_file = False
+        self._flush()
+
+    def _write_threadsafe(self, data, lane):
+        if self.transport.is_closing():
+            session = self.session
+            if session is not None:
+                session.send(data, lane)  # kept, or sent where it resumed
+            elif isinstance(data, FileRange):
+                data.file.close()
+            return
+        try:
+            self._write(data, lane)
+        except SlowConsumerError:
+            pass
+
+    def take_unsent(self):
+        # popleft() one by one: a session may call this off the loop
+        frames = []
+        for lane in PICK_ORDER[1:]:
+            queue = self._lanes[lane]
+            while queue:
+                frames.append(queue.popleft())
+        self._lanes_bytes -= sum(map(len, frames))
+        return frames
+
+    def _discard(self):
+        for queue in self._lanes:
+            for data in queue:
+                if isinstance(data, FileRange):
+                    data.file.close()
+            queue.clear()
+        self._lanes_bytes = 0
+
+    def close(self):
+        if self.transport is not None and not self.transport.is_closing():
+            if threading.get_ident() == self.loop_thread:
+                self._close()
+            else:
+                self.loop.call_soon_threadsafe(self._close)
+
+    def _close(self):
+        self._flush(drain=True)  # close() lets queued frames drain; these too
+        self.transport.close()
+
+    def abort(self):
+        # transport.close() would keep the write buffer until it drains
+        if self.transport is not None:
+            if threading.get_ident() == self.loop_thread:
+                self.transport.abort()
+            else:
+                self.loop.call_soon_threadsafe(self.transport.abort)
+
+
+async def serve(port=4105, host=None, reuse_port=False):
+    loop = asyncio.get_running_loop()
+    ip_lan = host or get_lan_ip()
+    server = await loop.create_server(
+        lambda: ChatProtocol(loop),
+        ip_lan,
+        port,
+        reuse_address=True,
+        reuse_port=reuse_port,
+        backlog=1024,
+    )
+    print(f"Server listening on {ip_lan}:{port} (asyncio)")
+    print(f"Clients in LAN use this IP to connect")
+    async with server:
+        await server.serve_forever()
+
+
+def app(port=4105, host=None, reuse_port=False):
+    try:
+        asyncio.run(serve(port, host, reuse_port))
+    except KeyboardInterrupt:
+        print("\nStopping server...")
+    finally:
+        for u, info in list(clients.items()):
+            info["conn"].close()
+        sys.exit(0)
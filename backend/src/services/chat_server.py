@@ -2,281 +2,1732 @@ import socket
 import threading
 import json
 import sys
+import time
+import base64
+import hmac
+import os
 
-from utils import ParseStream, get_lan_ip
+from utils import (
+    FRAMING_LENGTH,
+    SERIALIZATION_JSON,
+    SERIALIZATION_MSGPACK,
+    EncodedPayload,
+    StreamDecoder,
+    compression_stats,
+    expand_relay,
+    get_lan_ip,
+    negotiate_compression,
+    negotiate_framing,
+    negotiate_serialization,
+)
+from services.connection import Connection, SocketConnection, tcp_keepalive
+from services.ice_batch import IceBatcher
+from services.log import log
+from services.metrics import Metrics
+from services.presence import Presence, Subscriptions
+from services.ratelimit import RateLimited
+from services.session import RESUME_BUFFER_BYTES, RESUME_GRACE, Session
+from services.timer_wheel import TimerWheel
+from models import BlobStore, direct_conversation, group_conversation
 
-clients = {}  # username -> {"conn": socket, "display_name": str}
-groups = {}  # group_name -> {"members": [usernames]}
+clients = {}  # username -> {"conn": Connection, "display_name": str}
+groups = {}  # group_name -> {"members": {usernames}}
+user_groups = {}  # username -> {group_names}, the reverse of groups
 decoder = json.JSONDecoder()
 
+# Chunked file transfer, relayed peer to peer (the server keeps no state):
+# FILE_BEGIN -> FILE_ACCEPT {offset} -> FILE_CHUNK... / FILE_ACK -> FILE_END
+# -> FILE_DONE, or FILE_CANCEL from either side. Chunks are binary frames,
+# so both ends must have negotiated length framing.
+FILE_TRANSFER_TYPES = {
+    "FILE_BEGIN",
+    "FILE_ACCEPT",
+    "FILE_CHUNK",
+    "FILE_ACK",
+    "FILE_END",
+    "FILE_DONE",
+    "FILE_CANCEL",
+}
+MAX_FILE_CHUNK = 1024 * 1024
+
+# Messages a client may send as a routing header plus an opaque body
+# (FLAG_RELAY, after LOGIN {"relay": true}). Only the header is parsed; the
+# body bytes reach relay-capable recipients exactly as they arrived.
+RELAY_TYPES = {"MESSAGE", "FILE", "RTC_OFFER", "RTC_ANSWER", "RTC_ICE", "RTC_END"}
+
+# Every type handle_message() knows; anything else is counted as "other" so
+# clients cannot create metric series at will.
+MESSAGE_TYPES = RELAY_TYPES | FILE_TRANSFER_TYPES | {
+    "LOGIN",
+    "BLOB_OFFER",
+    "BLOB_CHUNK",
+    "BLOB_END",
+    "BLOB_GET",
+    "BROADCAST",
+    "GET_USERS",
+    "HISTORY",
+    "GET_PRESENCE",
+    "PRESENCE_SUBSCRIBE",
+    "PRESENCE_UNSUBSCRIBE",
+    "JOIN_GROUP",
+    "CREATE_GROUP",
+    "GROUP_MESSAGE",
+    "PING",
+    "PONG",
+    "ACK",
+    "INBOX_ACK",
+    "LOGOUT",
+}
+
+# Attachment blob store (set by main.py; None turns BLOB_* off). Clients
+# BLOB_OFFER a SHA-256 and only upload (BLOB_CHUNK... BLOB_END) when the
+# store lacks it; recipients get a FILE_REF and pull it with BLOB_GET.
+# The digest doubles as the read capability. An upload the connection
+# drops is removed; start_blob_collector() applies the retention policy.
+blob_store = None
+BLOB_ACK_EVERY = 4  # chunks
+MAX_BLOB_SIZE = 1024 * 1024 * 1024  # per BLOB_OFFER; main.py --max-blob-size
+BLOB_TTL = 30 * 86400  # seconds unused before a blob goes; None keeps them
+BLOB_MAX_BYTES = None  # least recently used go first above this
+BLOB_GC_INTERVAL = 3600  # seconds between collections
+MAX_BLOB_READ = 64 * 1024 * 1024  # per BLOB_GET; sent with sendfile
+LEGACY_INLINE_LIMIT = 8 * 1024 * 1024  # FILE fallback for clients w/o blobs
+
+# Message history (a models.HistoryStore set by main.py; None keeps nothing).
+# Delivered MESSAGE and GROUP_MESSAGE frames carry the stored "id", which
+# clients pass back as HISTORY's before_id to page further back.
+history = None
+
+# Offline inboxes (a models.InboxStore set by main.py; None: offline users
+# get "not online" as before). MESSAGE and FILE to a known user who is not
+# connected wait there and are handed over right after their next LOGIN.
+inbox = None
+INBOX_PURGE_INTERVAL = 3600  # seconds between sweeps for expired messages
+
+# Sibling worker processes (main.py --workers N) or cluster nodes (main.py
+# --cluster-listen): a services.workers.WorkerBus or services.cluster.ClusterBus
+# set by main.py, and the users connected elsewhere, as announced on the bus.
+# A single-process server leaves both empty.
+bus = None
+remote_users = {}  # username -> {"display_name", "blobs", "file_chunks", ...}
+
+# Per-user token buckets (a services.ratelimit.RateLimiter set by main.py
+# when run with --rate-limit; None admits everything). admit() charges each
+# message before it is handled; the server loops hold it back or drop it as
+# told. Buckets outlive a login, until start_limiter_sweeper() finds them
+# refilled.
+limiter = None
+LIMITER_SWEEP_INTERVAL = 60.0
+
+# Bytes of one sender's messages handled in a row. The asyncio server then
+# serves every other ready connection before this one again, so a client
+# streaming FILE_CHUNKs cannot hold up everyone's chat; the threaded server
+# only yields the GIL (time.sleep(0)), which gives other threads a chance to
+# run but no turn order.
+SCHEDULING_QUANTUM = 64 * 1024
+
+# Keepalive (started by main.py with start_keepalive()). A client that said
+# {"keepalive": true} at LOGIN and sent nothing for ping_interval seconds
+# gets a PING, which it answers with PONG; one silent for idle_timeout is
+# reaped as a dead peer and shows up in the next PRESENCE_DELTA's
+# "timed_out". So is a connection that never logs in. Older clients do not
+# answer PINGs, so they leave the wheel at LOGIN and are left to the
+# kernel's TCP keepalive instead. Connections wait on a timer wheel, so a
+# tick costs O(1) however many are open, and traffic only updates
+# conn.received_at.
+PING_INTERVAL = 30.0
+IDLE_TIMEOUT = 90.0
+ping_interval = PING_INTERVAL
+idle_timeout = IDLE_TIMEOUT
+idle_wheel = None  # TimerWheel of Connections, once keepalive runs
+idle_lock = threading.Lock()
+
+# Session resumption. A LOGIN with "resume" gets a token in LOGIN_OK, and
+# every frame after it is numbered (implicitly: both ends count) and kept
+# until the client ACKs it. A connection that drops is detached rather
+# than logged out for resume_grace seconds: frames for the user are kept,
+# presence does not hear of it, and a LOGIN presenting the token and the
+# last seq it saw gets just the frames after it. LOGOUT ends it at once;
+# a peer reaped by the keepalive is not kept. resume_grace 0 turns it off.
+sessions = {}  # username -> Session
+resume_grace = RESUME_GRACE
+resume_buffer = RESUME_BUFFER_BYTES
+
+# Telemetry, served in Prometheus format when main.py --metrics-port is set.
+# Connection counts what it sends; handle_message() what it receives.
+metrics = Metrics()
+metrics.counter(
+    "chat_messages_received_total", "Client messages received", ("type",)
+)
+metrics.counter(
+    "chat_received_bytes_total", "Bytes of client messages received", ("type",)
+)
+metrics.counter("chat_messages_sent_total", "Frames queued to clients", ("type",))
+metrics.counter("chat_sent_bytes_total", "Bytes queued to clients", ("type",))
+metrics.histogram(
+    "chat_relay_latency_seconds",
+    "From recv() of a client message until its replies and relays are queued",
+    ("type",),
+)
+metrics.counter(
+    "chat_socket_writes_total", "Writes handed to client sockets (send syscalls)"
+)
+metrics.counter(
+    "chat_socket_write_frames_total", "Frames in those writes, coalesced or not"
+)
+metrics.counter("chat_errors_total", "Failed handlers and sends", ("kind",))
+metrics.counter("chat_evictions_total", "Slow consumers evicted")
+metrics.counter("chat_reaped_total", "Silent connections closed by the keepalive")
+metrics.counter(
+    "chat_rate_limited_total",
+    "Messages over a rate limit, delayed or refused",
+    ("type", "action"),
+)
+metrics.gauge("chat_sessions", "Clients logged in here", lambda: {(): len(clients)})
+metrics.gauge(
+    "chat_remote_sessions",
+    "Clients logged in on sibling workers or nodes",
+    lambda: {(): len(remote_users)},
+)
+metrics.gauge(
+    "chat_send_queue_bytes",
+    "Bytes queued to clients but not yet written",
+    lambda: {(): send_queue_stats()["queued_bytes"]},
+)
+metrics.gauge(
+    "chat_send_queue_max_bytes",
+    "Deepest send queue of any client",
+    lambda: {(): send_queue_stats()["max_queued_bytes"]},
+)
+metrics.gauge(
+    "chat_congested_sessions",
+    "Clients above the send queue high watermark",
+    lambda: {(): send_queue_stats()["congested"]},
+)
+metrics.gauge(
+    "chat_presence_subscriptions",
+    "Users and groups watched by clients on interest-based presence",
+    lambda: {(): len(subscriptions)},
+)
+metrics.gauge(
+    "chat_log_dropped_records",
+    "Log records dropped because the log writer fell behind",
+    lambda: {(): log.dropped},
+)
+Connection.metrics = metrics
+
+
+def group_entry(group_name):
+    return {"username": group_name, "display_name": f"#{group_name}", "type": "group"}
+
+
+def add_group_members(group_name, usernames):
+    """Add `usernames` to a group (created if new); returns who was new"""
+    members = groups.setdefault(group_name, {"members": set()})["members"]
+    added = [u for u in usernames if u not in members]
+    members.update(added)
+    for username in added:
+        user_groups.setdefault(username, set()).add(group_name)
+    return added
+
+
+def online(username):
+    """Connected to this server or to a sibling worker"""
+    return username in clients or username in remote_users
+
+
+def capabilities(username):
+    """What `username`'s client negotiated at LOGIN, or None if offline"""
+    info = clients.get(username)
+    if info is not None:
+        conn = info["conn"]
+        return {
+            "blobs": conn.blobs,
+            "file_chunks": conn.file_chunks,
+            "ice_batch": conn.ice_batch,
+        }
+    return remote_users.get(username)
+
+
+def online_users(username):
+    """Everyone online except `username`, as roster entries"""
+    users = {
+        u: {"username": u, "display_name": e["display_name"]}
+        for u, e in list(remote_users.items())
+    }
+    for u, c in list(clients.items()):
+        users[u] = {"username": u, "display_name": c["display_name"]}
+    users.pop(username, None)
+    return list(users.values())
+
+
+def user_list(username):
+    """Online users and the groups `username` belongs to, as one roster"""
+    users = online_users(username)
+    group_list = [group_entry(g) for g in list(user_groups.get(username, ()))]
+    return users + group_list
+
 
 def broadcast_user_list():
-    """Send list of online users to all clients"""
+    """Send the full list of online users to clients without presence deltas"""
+    for username, info in list(clients.items()):
+        if info["conn"].presence_deltas:
+            continue
+        payload = {"type": "USERS", "users": user_list(username)}
+        try:
+            info["conn"].send_message(payload)
+        except ConnectionError:
+            pass  # closed or evicted; its handler cleans up
+
+
+def flush_presence(version, joined, left, group_adds, timed_out):
+    """Fan one coalesced presence window out to every client.
+
+    The common PRESENCE_DELTA is serialized once; only users who gained a
+    group in this window get their own copy with a "groups" field.
+    """
+    delta = {
+        "type": "PRESENCE_DELTA",
+        "version": version,
+        "joined": [{"username": u, "display_name": d} for u, d in joined.items()],
+        "left": sorted(left),
+    }
+    if timed_out:
+        delta["timed_out"] = sorted(timed_out)
+    shared = EncodedPayload(delta)
+    has_legacy = False
     for username, info in list(clients.items()):
-        users = [
-            {"username": u, "display_name": c["display_name"]}
-            for u, c in clients.items()
-            if u != username
-        ]
-        group_list = [
-            {"username": g, "display_name": f"#{g}", "type": "group"}
-            for g in groups.keys()
-            if username in groups[g]["members"]
-        ]
-        payload = json.dumps({"type": "USERS", "users": users + group_list})
+        conn = info["conn"]
+        if not conn.presence_deltas:
+            has_legacy = True
+            continue
+        if conn.presence_subscribed:
+            continue  # flush_subscribed() has theirs
+        try:
+            if username in group_adds:
+                conn.send_message(
+                    {**delta, "groups": [group_entry(g) for g in group_adds[username]]}
+                )
+            else:
+                conn.send_shared(shared)
+        except ConnectionError:
+            pass  # closed or evicted; its handler cleans up
+    flush_subscribed(version, joined, left, group_adds, timed_out)
+    if has_legacy:
+        broadcast_user_list()
+
+
+def flush_subscribed(version, joined, left, group_adds, timed_out):
+    """Send each interest-based client the part of a window it watches.
+
+    The watchers of every changed user are looked up in `subscriptions`,
+    so the work grows with the changes and their watchers, not with the
+    number of clients. What a subscriber hears is kept as a bitmask over
+    the window's changes; subscribers with the same mask share one encoded
+    PRESENCE_DELTA, and clients with nothing to hear get no frame.
+    """
+    changes = []  # (username, roster entry, or None for a leave)
+    masks = {}  # subscriber -> bits of `changes` it hears about
+
+    def change(username, entry, subscribers):
+        bit = 1 << len(changes)
+        changes.append((username, entry))
+        for subscriber in subscribers:
+            masks[subscriber] = masks.get(subscriber, 0) | bit
+
+    for username, display_name in joined.items():
+        entry = {"username": username, "display_name": display_name}
+        groups_of = list(user_groups.get(username, ()))
+        subscribers = subscriptions.watchers(username, groups_of)
+        # lists with rows to spare take newcomers in
+        change(username, entry, subscribers | subscriptions.newcomer(username))
+    for username in sorted(left):
+        groups_of = list(user_groups.get(username, ()))
+        change(username, None, subscriptions.watchers(username, groups_of))
+        subscriptions.gone(username)  # its rows go to the next newcomers
+    for username, group_names in group_adds.items():
+        # new members of a watched group, already online
+        entries = watched_roster(None, [username], ())
+        if entries and username not in joined:
+            change(username, entries[0], subscriptions.watchers(None, group_names))
+    own = {}  # nobody hears about themselves
+    for i, (username, _) in enumerate(changes):
+        own[username] = own.get(username, 0) | 1 << i
+
+    def delta_for(mask):
+        delta = {"type": "PRESENCE_DELTA", "version": version, "joined": [], "left": []}
+        for i, (username, entry) in enumerate(changes):
+            if mask >> i & 1:
+                if entry is not None:
+                    delta["joined"].append(entry)
+                else:
+                    delta["left"].append(username)
+        gone = [u for u in delta["left"] if u in timed_out]
+        if gone:
+            delta["timed_out"] = gone
+        return delta
+
+    shared = {}  # mask -> EncodedPayload
+    for subscriber in set(masks) | set(group_adds):
+        info = clients.get(subscriber)
+        if info is None or not info["conn"].presence_subscribed:
+            continue  # on another worker, or not interest-based
+        conn = info["conn"]
+        mask = masks.get(subscriber, 0) & ~own.get(subscriber, 0)
         try:
-            info["conn"].send(payload.encode())
-        except:
-            pass
+            if subscriber in group_adds:
+                delta = delta_for(mask)
+                delta["groups"] = [group_entry(g) for g in group_adds[subscriber]]
+                conn.send_message(delta)
+            elif mask:
+                if mask not in shared:
+                    shared[mask] = EncodedPayload(delta_for(mask))
+                conn.send_shared(shared[mask])
+        except ConnectionError:
+            pass  # closed or evicted; its handler cleans up
+
+
+presence = Presence(flush_presence)
+
+# Interest-based presence (LOGIN {"presence": "subscribe"}): such clients get
+# no global roster. They PRESENCE_SUBSCRIBE to the users they care about
+# (contacts, the rows a list shows) and to their groups, and hear only
+# about those, plus newcomers while their list has rows to fill.
+subscriptions = Subscriptions()
+
+
+def flush_ice(sender, target, candidates):
+    """Deliver one window of trickled candidates from `sender` to `target`.
+
+    Clients that logged in with {"ice": "batch"} get one RTC_ICE with a
+    "candidates" list; the others get one RTC_ICE per candidate.
+    """
+    caps = capabilities(target) or {}
+    if caps.get("ice_batch"):
+        send_to_client(
+            target, {"type": "RTC_ICE", "from": sender, "candidates": candidates}
+        )
+        return
+    for candidate in candidates:
+        send_to_client(
+            target, {"type": "RTC_ICE", "from": sender, "candidate": candidate}
+        )
+
+
+# main.py --ice-batch-window sets its window; 0 relays each candidate at once
+ice_batch = IceBatcher(flush_ice)
+
+
+def watched_roster(username, users, group_names):
+    """Who is online among `users` and `group_names`' members, as roster entries.
+
+    `username` itself is left out.
+    """
+    names = set(users)
+    for group_name in group_names:
+        group = groups.get(group_name)
+        if group is not None:
+            names.update(list(group["members"]))
+    names.discard(username)
+    entries = []
+    for name in names:
+        info = clients.get(name) or remote_users.get(name)
+        if info is not None:
+            entries.append({"username": name, "display_name": info["display_name"]})
+    return entries
+
+
+def send_presence_snapshot(conn, username, known_version=None):
+    if conn.presence_subscribed:
+        # everything the client watches, and its groups
+        users, group_names = subscriptions.watched(username)
+        group_list = [group_entry(g) for g in list(user_groups.get(username, ()))]
+        conn.send_message(
+            {
+                "type": "PRESENCE_SNAPSHOT",
+                "version": presence.version,
+                "users": watched_roster(username, users, group_names) + group_list,
+            }
+        )
+        return
+    if known_version is not None and known_version == presence.version:
+        conn.send_message(
+            {"type": "PRESENCE_SNAPSHOT", "version": presence.version, "unchanged": True}
+        )
+        return
+    conn.send_message(
+        {
+            "type": "PRESENCE_SNAPSHOT",
+            "version": presence.version,
+            "users": user_list(username),
+        }
+    )
 
 
 def send_to_client(target_username, payload):
-    print("server: ", payload)
-    """Send JSON payload to a client"""
-    if target_username in clients:
+    """Queue a JSON payload for a client; never blocks on the receiver"""
+    log.traffic("send", payload, to=target_username)
+    info = clients.get(target_username)
+    if info is None:
+        if target_username in remote_users:
+            op = {"op": "deliver", "to": [target_username], "payload": to_bus(payload)}
+            return not bus.publish(op)  # False: its node is unreachable
+        return False
+    try:
+        info["conn"].send_message(payload)
+    except ConnectionError as e:
+        # closed or evicted as a slow consumer; its handler cleans up
+        log.warning("send_failed", to=target_username, error=str(e))
+        metrics.inc("chat_errors_total", ("send",))
+        return False
+    return True
+
+
+def relay_to_client(target_username, header, body):
+    """send_to_client() for a relayed header + opaque body"""
+    log.traffic("relay", header, to=target_username, body_bytes=len(body))
+    info = clients.get(target_username)
+    if info is None:
+        if target_username in remote_users:
+            payload = expand_relay(header, body)
+            op = {"op": "deliver", "to": [target_username], "payload": payload}
+            return not bus.publish(op)
+        return False
+    try:
+        info["conn"].send_relay(header, body)
+    except ConnectionError as e:
+        # closed or evicted as a slow consumer; its handler cleans up
+        log.warning("send_failed", to=target_username, error=str(e))
+        metrics.inc("chat_errors_total", ("send",))
+        return False
+    return True
+
+
+def to_bus(payload):
+    """`payload` made fit for a JSON bus op: raw bytes "data" as base64"""
+    data = payload.get("data")
+    if not isinstance(data, (bytes, bytearray, memoryview)):
+        return payload
+    payload = {k: v for k, v in payload.items() if k != "data"}
+    payload["data_b64"] = base64.b64encode(data).decode()
+    return payload
+
+
+def from_bus(payload):
+    """The payload to_bus() was given"""
+    if "data_b64" not in payload:
+        return payload
+    payload = dict(payload)
+    payload["data"] = base64.b64decode(payload.pop("data_b64"))
+    return payload
+
+
+def send_local(usernames, shared):
+    """Queue one EncodedPayload for every local client in `usernames`.
+
+    Returns the usernames that are not connected here.
+    """
+    missed = []
+    for username in usernames:
+        info = clients.get(username)
+        if info is None:
+            missed.append(username)
+            continue
+        try:
+            info["conn"].send_shared(shared)
+        except ConnectionError as e:
+            # closed or evicted as a slow consumer; its handler cleans up
+            log.warning("send_failed", to=username, error=str(e))
+            metrics.inc("chat_errors_total", ("send",))
+    return missed
+
+
+def send_to_many(usernames, payload):
+    """send_to_client() for a group.
+
+    The payload is serialized once and the same bytes are queued for every
+    local member; one bus op covers every remote member.
+    """
+    log.traffic("send", payload, recipients=len(usernames))
+    missed = send_local(usernames, EncodedPayload(payload))
+    remote = [u for u in missed if u in remote_users]
+    if remote:
+        bus.publish({"op": "deliver", "to": remote, "payload": to_bus(payload)})
+
+
+def publish(op):
+    """Tell sibling workers (if any) about a local change"""
+    if bus is not None:
+        bus.publish(op)
+
+
+def on_bus_op(op):
+    """Apply an op from the routing bus (called on the bus reader thread)"""
+    kind = op["op"]
+    if kind == "sync":
+        for username, entry in op["users"].items():
+            remote_users[username] = entry
+            presence.user_joined(username, entry["display_name"])
+        for name, members in op["groups"].items():
+            presence.group_added(name, add_group_members(name, members))
+    elif kind == "join":
+        drop_detached(op["username"])
+        remote_users[op["username"]] = op["entry"]
+        presence.user_joined(op["username"], op["entry"]["display_name"])
+    elif kind == "leave":
+        if remote_users.pop(op["username"], None) and op["username"] not in clients:
+            presence.user_left(op["username"], op.get("timed_out", False))
+    elif kind == "group":
+        add_group_members(op["name"], op["members"])
+        presence.group_added(op["name"], op["added"])
+    elif kind in ("deliver", "undelivered"):
+        # "undelivered": ours, bounced by the hub since no worker had them
+        payload = op["payload"]
+        missed = send_local(op["to"], EncodedPayload(from_bus(payload)))
+        if inbox is not None and payload.get("type") not in FILE_TRANSFER_TYPES:
+            for username in missed:
+                inbox.deposit(username, payload)  # left meanwhile
+    elif kind == "broadcast":
+        send_local(
+            [u for u in list(clients) if u != op["exclude"]],
+            EncodedPayload(op["payload"]),
+        )
+
+
+def send_or_queue(conn, target_username, payload):
+    """Deliver now, or keep it in the target's inbox while they are offline"""
+    if not send_to_client(target_username, payload):
+        queue_offline(conn, target_username, payload)
+
+
+def queue_offline(conn, target_username, payload):
+    """Keep `payload` in an offline user's inbox; tells `conn` if it cannot.
+
+    The inbox write is disk I/O, so it goes through conn.run_blocking().
+    """
+    if inbox is None:
+        send_not_online(conn, target_username)
+        return
+    conn.run_blocking(
+        inbox.deposit,
+        target_username,
+        payload,
+        then=lambda ok: ok or send_not_online(conn, target_username),
+    )
+
+
+def send_not_online(conn, target_username):
+    conn.send_message({
+        "type": "ERROR",
+        "message": f"User {target_username} not online",
+    })
+
+
+def when_reachable(conn, target_username, then):
+    """then(True) if `target_username` is online or has an inbox to be
+    queued in, then(False) otherwise; the inbox lookup goes through
+    conn.run_blocking()"""
+    if online(target_username):
+        then(True)
+    elif inbox is None:
+        then(False)
+    else:
+        conn.run_blocking(inbox.known, target_username, then=then)
+
+
+def deliver_inbox(conn, username, batched):
+    """Hand a user who just logged in everything queued while they were away.
+
+    Clients that asked for it get one INBOX frame with all of it and
+    INBOX_ACK its "id"; older clients get the original frames one by one,
+    acked once the last of them is on the wire. Until then the messages
+    stay in the inbox, to be delivered again at the next login.
+    """
+    conn.run_blocking(
+        inbox.drain,
+        username,
+        then=lambda drained: send_inbox(conn, username, batched, *drained),
+    )
+
+
+def send_inbox(conn, username, batched, messages, last_id):
+    if not messages:
+        return
+    try:
+        if batched:
+            conn.send_message({"type": "INBOX", "messages": messages, "id": last_id})
+        else:
+            for payload in messages[:-1]:
+                conn.send_message(payload)
+            conn.send_message(
+                messages[-1],
+                written=lambda: conn.run_blocking(inbox.ack, username, last_id),
+            )
+    except ConnectionError:
+        return  # still in the inbox for next time
+    log.info("inbox_delivered", user=username, messages=len(messages))
+
+
+def start_inbox_purger(interval=INBOX_PURGE_INTERVAL):
+    """Delete expired inbox messages every `interval` seconds"""
+
+    def purge():
+        while True:
+            removed = inbox.purge_expired()
+            if removed:
+                log.info("inbox_purged", messages=removed)
+            time.sleep(interval)
+
+    threading.Thread(target=purge, daemon=True).start()
+
+
+def start_blob_collector(interval=BLOB_GC_INTERVAL):
+    """Apply the blob retention policy every `interval` seconds"""
+
+    def collect():
+        while True:
+            try:
+                removed = blob_store.collect(BLOB_TTL, BLOB_MAX_BYTES)
+            except OSError as e:
+                log.warning("blob_gc_failed", error=str(e))
+            else:
+                if removed:
+                    log.info("blobs_collected", blobs=removed)
+            time.sleep(interval)
+
+    threading.Thread(target=collect, daemon=True).start()
+
+
+def start_limiter_sweeper(interval=LIMITER_SWEEP_INTERVAL):
+    """Drop refilled rate-limit buckets every `interval` seconds"""
+
+    def sweep():
+        while True:
+            time.sleep(interval)
+            limiter.sweep(time.perf_counter())
+
+    threading.Thread(target=sweep, daemon=True).start()
+
+
+def watch_idle(conn):
+    """Put a new connection on the keepalive wheel (if keepalive runs)"""
+    if idle_wheel is None:
+        return
+    conn.received_at = time.perf_counter()
+    with idle_lock:
+        conn.idle_watch = True
+        idle_wheel.schedule(conn, ping_interval)
+
+
+def unwatch_idle(conn):
+    with idle_lock:
+        conn.idle_watch = False
+        if idle_wheel is not None:
+            idle_wheel.cancel(conn)
+
+
+def check_idle(conn, now):
+    """A connection's keepalive timer fired: PING it, reap it or wait on"""
+    idle = now - conn.received_at
+    if idle >= idle_timeout:
+        conn.timed_out = True
+        metrics.inc("chat_reaped_total")
+        log.info("reaped", idle=round(idle, 1))
+        conn.abort()  # its handler cleans up and reports the leave
+        return
+    if idle >= ping_interval and conn.keepalive:
+        try:
+            conn.send_message({"type": "PING"})
+        except ConnectionError:
+            return  # closed or evicted; its handler cleans up
+        delay = min(ping_interval, idle_timeout - idle)
+    elif idle >= ping_interval:
+        delay = idle_timeout - idle  # not logged in yet: no PING
+    else:
+        delay = ping_interval - idle
+    with idle_lock:
+        if conn.idle_watch:
+            idle_wheel.schedule(conn, delay)
+
+
+def start_keepalive(ping_every=PING_INTERVAL, timeout=IDLE_TIMEOUT, tick=1.0):
+    """PING silent connections and reap dead ones, checked every `tick`"""
+    global idle_wheel, ping_interval, idle_timeout
+    ping_interval, idle_timeout = ping_every, timeout
+    idle_wheel = TimerWheel(tick, now=time.perf_counter())
+
+    def run():
+        while True:
+            time.sleep(tick)
+            now = time.perf_counter()
+            with idle_lock:
+                due = idle_wheel.advance(now)
+            for conn in due:
+                check_idle(conn, now)
+
+    threading.Thread(target=run, daemon=True).start()
+
+
+def send_queue_stats():
+    """Outbound queue depth across sessions"""
+    depths = [info["conn"].queued_bytes for info in list(clients.values())]
+    congested = [info["conn"].congested for info in list(clients.values())]
+    return {
+        "sessions": len(depths),
+        "queued_bytes": sum(depths),
+        "max_queued_bytes": max(depths, default=0),
+        "congested": sum(congested),
+        "evicted": Connection.evictions,
+    }
+
+
+def start_stats_reporter(interval):
+    """Log send_queue_stats() and compression_stats every `interval` seconds"""
+
+    def report():
+        while True:
+            time.sleep(interval)
+            stats = send_queue_stats()
+            log.info("stats", **stats, log_dropped=log.dropped)
+            for msg_type, c in sorted(compression_stats.snapshot().items(), key=str):
+                log.info(
+                    "compression",
+                    type=msg_type,
+                    frames=c["frames"],
+                    compressed=c["compressed"],
+                    raw_bytes=c["raw_bytes"],
+                    wire_bytes=c["wire_bytes"],
+                    cpu_ms=round(c["cpu_seconds"] * 1000, 1),
+                )
+
+    threading.Thread(target=report, daemon=True).start()
+
+
+def new_state():
+    """Per-connection state shared by the threaded and asyncio servers"""
+    return {"username": None, "display_name": None}
+
+
+def admit(conn, msg, state):
+    """Charge `msg` to its sender's rate limits.
+
+    Returns the seconds to hold it back before handle_message() (0: now),
+    or None if it was refused; the sender then has an ERROR. Call right
+    after the decoder produced `msg`.
+    """
+    if limiter is None or state["username"] is None:
+        return 0
+    msg_type = msg.get("type")
+    if msg_type not in MESSAGE_TYPES:
+        msg_type = "other"
+    arrived = conn.received_at or time.perf_counter()
+    try:
+        wait = limiter.charge(
+            state["username"], msg_type, conn.decoder.last_size, arrived
+        )
+    except RateLimited as e:
+        metrics.inc("chat_rate_limited_total", (msg_type, "refused"))
+        error = {
+            "type": "ERROR",
+            "message": f"Too many {msg_type} messages, retry in {e.retry_after:.1f}s",
+            "retry_after": round(e.retry_after, 3),
+        }
+        # let the client tie it to the transfer that failed
+        for key in ("transfer_id", "sha256"):
+            if key in msg:
+                error[key] = msg[key]
+        conn.send_message(error)
+        return None
+    if not wait:
+        return 0
+    metrics.inc("chat_rate_limited_total", (msg_type, "delayed"))
+    return max(0.0, arrived + wait - time.perf_counter())
+
+
+def handle_message(conn, msg, state):
+    """Dispatch one decoded client message, recording it in `metrics`.
+
+    `conn` is a Connection (services/connection.py), so the same handlers
+    serve a raw socket (threaded mode) and an asyncio transport (asyncio
+    mode).
+    """
+    msg_type = msg.get("type")
+    if msg_type not in MESSAGE_TYPES:
+        msg_type = "other"
+    labels = (msg_type,)
+    metrics.inc("chat_messages_received_total", labels)
+    metrics.inc("chat_received_bytes_total", labels, conn.decoder.last_size)
+    try:
+        dispatch_message(conn, msg, state)
+    finally:
+        if conn.received_at is not None:
+            metrics.observe(
+                "chat_relay_latency_seconds",
+                labels,
+                time.perf_counter() - conn.received_at,
+            )
+
+
+def dispatch_message(conn, msg, state):
+    username = state["username"]
+    display_name = state["display_name"]
+
+    if msg.get("type") == "LOGIN":
+        username = msg["username"]
+        display_name = msg["display_name"]
+        state["username"] = username
+        state["display_name"] = display_name
+
+        # LOGIN_OK still goes out in the framing the LOGIN arrived in;
+        # everything after uses the new one.
+        framing = negotiate_framing(msg.get("framing"))
+        login_ok = {"type": "LOGIN_OK"}
+        if msg.get("framing"):
+            login_ok["framing"] = framing
+        if msg.get("presence") == "delta":
+            login_ok["presence"] = "delta"
+            conn.presence_deltas = True
+        elif msg.get("presence") == "subscribe":
+            login_ok["presence"] = "subscribe"
+            conn.presence_deltas = True
+            conn.presence_subscribed = True
+        if msg.get("files") == "chunked" and framing == FRAMING_LENGTH:
+            login_ok["files"] = "chunked"
+            conn.file_chunks = True
+        if msg.get("inbox") == "batch" and inbox is not None:
+            login_ok["inbox"] = "batch"
+        if msg.get("blobs") and blob_store is not None and framing == FRAMING_LENGTH:
+            login_ok["blobs"] = True
+            conn.blobs = True
+        if msg.get("relay") and framing == FRAMING_LENGTH:
+            login_ok["relay"] = True
+            conn.relay = True
+        if msg.get("ice") == "batch":
+            login_ok["ice"] = "batch"
+            conn.ice_batch = True
+        if idle_wheel is not None and msg.get("keepalive"):
+            login_ok["ping_interval"] = ping_interval
+            conn.keepalive = True
+        elif idle_wheel is not None:
+            # would be reaped for not answering PINGs it does not know
+            unwatch_idle(conn)
+            tcp_keepalive(conn.socket, ping_interval, idle_timeout)
+        codec = None
+        serialization = SERIALIZATION_JSON
+        if framing == FRAMING_LENGTH:
+            codec = negotiate_compression(msg.get("compression"))
+            if codec is not None:
+                login_ok["compression"] = codec
+            serialization = negotiate_serialization(msg.get("serialization"))
+            if msg.get("serialization"):
+                login_ok["serialization"] = serialization
+
+        def greet(resumed=False):
+            if resumed:
+                login_ok["resumed"] = True
+            conn.send_message(login_ok)
+            conn.set_framing(framing)
+            conn.compression = codec
+            conn.serialization = serialization
+
+        # kept frames are only replayed to a connection that decodes them
+        settings = (
+            framing,
+            codec,
+            serialization,
+            conn.relay,
+            conn.presence_deltas,
+            conn.presence_subscribed,
+            conn.file_chunks,
+            conn.blobs,
+            conn.ice_batch,
+        )
+        resume = msg.get("resume")
+        session = sessions.get(username)
+        resumed = False
+        if (
+            isinstance(resume, dict)
+            and session is not None
+            and session.settings == settings
+            and hmac.compare_digest(str(resume.get("token")), session.token)
+        ):
+            login_ok["resume_token"] = session.token
+            resumed = session.attach(conn, resume.get("seq"), lambda: greet(True))
+        if not resumed:
+            login_ok.pop("resume_token", None)
+            if session is not None:
+                sessions.pop(username, None)
+                session.close()
+            if resume and resume_grace > 0:
+                session = sessions[username] = Session(
+                    username, settings, max_bytes=resume_buffer
+                )
+                login_ok["resume_token"] = session.token
+                session.attach(conn, greet=greet)
+            else:
+                greet()
+
+        replaced = clients.get(username)
+        clients[username] = {"conn": conn, "display_name": display_name}
+        if resumed:
+            # the gap was replayed; nobody saw the user leave
+            if replaced is not None and replaced["conn"] is not conn:
+                replaced["conn"].abort()  # died without us noticing
+            log.info("resumed", user=username)
+            return
+        log.info("joined", user=username, display_name=display_name)
+        subscriptions.forget(username)  # a new login subscribes afresh
+
+        # Tell others in the next presence window
+        presence.user_joined(username, display_name)
+        publish(
+            {
+                "op": "join",
+                "username": username,
+                "entry": {"display_name": display_name, **capabilities(username)},
+            }
+        )
+
+        if inbox is not None:
+            batched = msg.get("inbox") == "batch"
+            conn.run_blocking(
+                inbox.remember,
+                username,
+                then=lambda _: deliver_inbox(conn, username, batched),
+            )
+
+    elif msg.get("type") in RELAY_TYPES and "body" in msg:
+        handle_relay(conn, msg, username, display_name)
+
+    elif msg.get("type") == "MESSAGE":
+        target = msg.get("to")
+        text = msg.get("message")
+        from_username = msg.get("from")
+
+        def reachable(ok):
+            if not ok:
+                send_not_online(conn, target)
+                return
+            payload = {
+                "type": "MESSAGE",
+                "from": display_name,
+                "message": text,
+                "from_username": from_username,
+            }
+            if history is not None:
+                payload["id"] = history.append(
+                    direct_conversation(username, target), username, display_name, text
+                )
+            send_or_queue(conn, target, payload)
+
+        when_reachable(conn, target, reachable)
+
+    elif msg.get("type") == "FILE":
+        target = msg.get("to")
+        filename = msg.get("filename")
+        b64data = msg.get("data")
+        if isinstance(b64data, bytes):
+            # raw bytes from a MessagePack client: kept for a local
+            # recipient that speaks MessagePack too, base64 for everyone
+            # else (bus ops and the inbox are JSON)
+            info = clients.get(target)
+            if info is None or info["conn"].serialization != SERIALIZATION_MSGPACK:
+                b64data = base64.b64encode(b64data).decode()
+        payload = {
+            "type": "FILE",
+            "from": display_name,
+            "filename": filename,
+            "data": b64data,
+        }
+        if target == username:
+            send_not_online(conn, target)
+        else:
+            send_or_queue(conn, target, payload)
+
+    elif msg.get("type") in FILE_TRANSFER_TYPES:
+        target = msg.get("to")
+        caps = capabilities(target)
+        data = msg.get("data")
+        if caps is None or target == username:
+            error = f"User {target} not online"
+        elif not caps["file_chunks"]:
+            error = f"User {target} cannot receive chunked files"
+        elif data is not None and len(data) > MAX_FILE_CHUNK:
+            error = f"File chunk larger than {MAX_FILE_CHUNK} bytes"
+        else:
+            error = None
+            payload = dict(msg)
+            payload["from"] = username
+            send_to_client(target, payload)
+        if error:
+            conn.send_message({
+                "type": "ERROR",
+                "message": error,
+                "transfer_id": msg.get("transfer_id"),
+            })
+
+    elif msg.get("type") == "BLOB_OFFER":
+        handle_blob_offer(conn, msg, username, display_name)
+
+    elif msg.get("type") == "BLOB_CHUNK":
+        handle_blob_chunk(conn, msg)
+
+    elif msg.get("type") == "BLOB_END":
+        handle_blob_end(conn, msg, username, display_name)
+
+    elif msg.get("type") == "BLOB_GET":
+        handle_blob_get(conn, msg)
+
+    elif msg.get("type") == "BROADCAST":
+        text = msg.get("message")
+        payload = {
+            "type": "BROADCAST",
+            "from": display_name,
+            "message": text,
+        }
+        send_local(
+            [u for u in list(clients) if u != username], EncodedPayload(payload)
+        )
+        publish({"op": "broadcast", "payload": payload, "exclude": username})
+
+    elif msg.get("type") == "GET_USERS":
+        users = online_users(username)
+        limit = msg.get("limit")
+        if isinstance(limit, int) and limit > 0:
+            # one page, by username, for a list that shows a few rows
+            offset = msg.get("offset")
+            offset = offset if isinstance(offset, int) and offset > 0 else 0
+            users.sort(key=lambda u: u["username"])
+            conn.send_message(
+                {
+                    "type": "USERS",
+                    "users": users[offset : offset + limit],
+                    "offset": offset,
+                    "total": len(users),
+                }
+            )
+        else:
+            conn.send_message({"type": "USERS", "users": users})
+
+    elif msg.get("type") == "HISTORY":
+        handle_history(conn, msg, username)
+
+    elif msg.get("type") == "GET_PRESENCE":
+        # full roster, unless the client's version is already current
+        send_presence_snapshot(conn, username, msg.get("version"))
+
+    elif msg.get("type") == "PRESENCE_SUBSCRIBE" and username:
+        # watch more users and groups (only one's own); answered with the
+        # presence of what was added, to merge into the roster. With "fill",
+        # also watch online users up to that many, and whoever comes online
+        # while there is room (the rows of a list).
+        users = [u for u in msg.get("users") or () if isinstance(u, str)]
+        mine = user_groups.get(username, ())
+        group_names = [g for g in msg.get("groups") or () if g in mine]
+        subscriptions.subscribe(username, users, group_names)
+        fill = msg.get("fill")
+        if isinstance(fill, int) and fill >= 0:
+            online_now = sorted(u["username"] for u in online_users(username))
+            users += subscriptions.fill(username, fill, online_now)
+        conn.send_message(
+            {
+                "type": "PRESENCE_SNAPSHOT",
+                "version": presence.version,
+                "partial": True,
+                "users": watched_roster(username, users, group_names),
+            }
+        )
+
+    elif msg.get("type") == "PRESENCE_UNSUBSCRIBE" and username:
+        subscriptions.unsubscribe(
+            username,
+            [u for u in msg.get("users") or () if isinstance(u, str)],
+            [g for g in msg.get("groups") or () if isinstance(g, str)],
+        )
+
+    elif msg.get("type") == "PING":
+        # a client checking on the server; "id" lets it match the PONG
+        pong = {"type": "PONG"}
+        if "id" in msg:
+            pong["id"] = msg["id"]
+        conn.send_message(pong)
+
+    elif msg.get("type") == "PONG":
+        pass  # answers our PING; arriving at all resets the idle timer
+
+    elif msg.get("type") == "ACK":
+        # the client has every frame up to "seq"; the session can drop them
+        seq = msg.get("seq")
+        if conn.session is not None and isinstance(seq, int):
+            conn.session.ack(seq)
+
+    elif msg.get("type") == "INBOX_ACK":
+        # the client has the INBOX frame with this "id": drop its messages
+        last_id = msg.get("id")
+        if inbox is not None and isinstance(last_id, int):
+            conn.run_blocking(inbox.ack, username, last_id)
+
+    elif msg.get("type") == "LOGOUT":
+        # leaving for good: no grace period, presence hears of it now
+        session = conn.session
+        if session is not None:
+            if sessions.get(username) is session:
+                del sessions[username]
+            session.close()
+        conn.close()
+
+    # ==== WebRTC signaling relay ====
+    elif msg.get("type") == "RTC_OFFER":
+        target = msg.get("to")
+        if online(target) and target != username:
+            payload = {
+                "type": "RTC_OFFER",
+                "from": username,
+                "from_display": display_name,
+                "sdp": msg.get("sdp"),
+            }
+            send_to_client(target, payload)
+        else:
+            conn.send_message({
+                "type": "ERROR",
+                "message": f"User {target} not online",
+            })
+
+    elif msg.get("type") == "RTC_ANSWER":
+        target = msg.get("to")
+        if online(target) and target != username:
+            payload = {
+                "type": "RTC_ANSWER",
+                "from": username,
+                "from_display": display_name,
+                "sdp": msg.get("sdp"),
+            }
+            send_to_client(target, payload)
+        else:
+            conn.send_message({
+                "type": "ERROR",
+                "message": f"User {target} not online",
+            })
+
+    elif msg.get("type") == "RTC_ICE":
+        target = msg.get("to")
+        if online(target) and target != username:
+            ice_batch.add(username, target, msg.get("candidate"))
+        else:
+            conn.send_message({
+                "type": "ERROR",
+                "message": f"User {target} not online",
+            })
+
+    elif msg.get("type") == "RTC_END":
+        target = msg.get("to")
+        if online(target) and target != username:
+            payload = {
+                "type": "RTC_END",
+                "from": username,
+            }
+            send_to_client(target, payload)
+        else:
+            conn.send_message({
+                "type": "ERROR",
+                "message": f"User {target} not online",
+            })
+
+    elif msg.get("type") == "JOIN_GROUP":
+        group_name = msg.get("group_name")
+        username = msg.get("username")
+
+        if group_name not in groups:
+            conn.send_message({
+                "type": "ERROR",
+                "message": f"Group '{group_name}' does not exist."
+            })
+        else:
+            if add_group_members(group_name, [username]):
+                log.info("group_joined", user=username, group=group_name)
+                presence.group_added(group_name, [username])
+                publish(
+                    {
+                        "op": "group",
+                        "name": group_name,
+                        "members": sorted(groups[group_name]["members"]),
+                        "added": [username],
+                    }
+                )
+                conn.send_message({
+                    "type": "SUCCESS",
+                    "message": f"Joined group '{group_name}' successfully!"
+                })
+            else:
+                conn.send_message({
+                    "type": "INFO",
+                    "message": f"You are already in group '{group_name}'."
+                })
+
+    elif msg.get("type") == "CREATE_GROUP":
+        group_name = msg.get("group_name")
+        members = msg.get("members", [])
+        if group_name not in groups:
+            members = add_group_members(group_name, members)
+            log.info("group_created", group=group_name, members=len(members))
+            presence.group_added(group_name, members)
+            publish(
+                {"op": "group", "name": group_name, "members": members, "added": members}
+            )
+        else:
+            conn.send_message({
+                "type": "ERROR",
+                "message": f"Group {group_name} already exists"
+            })
+
+    elif msg.get("type") == "GROUP_MESSAGE":
+        group_name = msg.get("group_name")
+        text = msg.get("message")
+        from_username = msg.get("from")
+
+        if group_name in groups:
+            members = groups[group_name]["members"]
+            payload = {
+                "type": "GROUP_MESSAGE",
+                "from": from_username,
+                "group_name": group_name,
+                "message": text,
+            }
+            if history is not None:
+                payload["id"] = history.append(
+                    group_conversation(group_name), username, display_name, text
+                )
+            send_to_many([m for m in list(members) if m != from_username], payload)
+
+
+def handle_relay(conn, msg, username, display_name):
+    """MESSAGE, FILE or RTC_* sent as a FLAG_RELAY routing header + body.
+
+    Same checks and addressing as the plain handlers, but the reply header
+    is built from the routing header alone and the body is passed through.
+    It is merged back into one JSON message only for recipients that did
+    not negotiate relay, for sibling workers and for the inbox.
+    """
+    kind = msg["type"]
+    target = msg.get("to")
+    body = msg["body"]
+
+    def reachable(ok):
+        if ok and kind == "RTC_ICE":
+            # candidates are batched per window, so this small body is parsed
+            ice_batch.add(username, target, json.loads(body).get("candidate"))
+            return
+        if ok and kind == "MESSAGE" and history is not None:
+            # the store keeps the text, so this body is parsed after all
+            text = json.loads(body).get("message")
+            header["id"] = history.append(
+                direct_conversation(username, target), username, display_name, text
+            )
+        if ok and kind in ("MESSAGE", "FILE"):
+            if not relay_to_client(target, header, body):
+                queue_offline(conn, target, expand_relay(header, body))
+            return
+        if not ok or not relay_to_client(target, header, body):
+            send_not_online(conn, target)
+
+    if kind == "MESSAGE":
+        header = {"type": kind, "from": display_name, "from_username": msg.get("from")}
+        when_reachable(conn, target, reachable)
+        return
+    if kind == "FILE":
+        header = {"type": kind, "from": display_name}
+        reachable(target != username)
+        return
+    header = {"type": kind, "from": username}
+    if kind in ("RTC_OFFER", "RTC_ANSWER"):
+        header["from_display"] = display_name
+    reachable(online(target) and target != username)
+
+
+def handle_history(conn, msg, username):
+    """HISTORY {conversation: "user:<name>" | "group:<name>", before_id, limit}
+
+    Answers one HISTORY_PAGE, oldest message first; `before_id` in the
+    reply asks for the page before it (None: nothing older).
+    """
+    conversation = msg.get("conversation") or ""
+    kind, _, name = conversation.partition(":")
+    if kind == "user" and name:
+        key = direct_conversation(username, name)
+    elif kind == "group" and username in groups.get(name, {}).get("members", ()):
+        key = group_conversation(name)
+    else:
+        key = None
+    before_id = msg.get("before_id")
+    limit = msg.get("limit", 50)
+    if (
+        history is None
+        or key is None
+        or not isinstance(limit, int)
+        or not (before_id is None or isinstance(before_id, int))
+    ):
+        conn.send_message({
+            "type": "ERROR",
+            "message": f"No history for {conversation}",
+            "conversation": conversation,
+        })
+        return
+
+    def paged(page):
+        messages, next_before_id = page
+        conn.send_message(
+            {
+                "type": "HISTORY_PAGE",
+                "conversation": conversation,
+                "messages": messages,
+                "before_id": next_before_id,
+            }
+        )
+
+    conn.run_blocking(history.page, key, before_id, limit, then=paged)
+
+
+def deliver_file_ref(conn, sender, display_name, target, sha256, size, filename):
+    """Hand `target` a stored blob; tells `conn` (the sender) if it cannot"""
+    caps = capabilities(target)
+    if caps is None:
+        send_not_online(conn, target)
+    elif caps["blobs"]:
+        payload = {
+            "type": "FILE_REF",
+            "from": sender,
+            "from_display": display_name,
+            "sha256": sha256,
+            "size": size,
+            "filename": filename,
+        }
+        if not send_to_client(target, payload):
+            send_not_online(conn, target)
+    elif size <= LEGACY_INLINE_LIMIT:
+        # old client: inline it the way FILE always worked
+        def send_inline(data):
+            payload = {
+                "type": "FILE",
+                "from": display_name,
+                "filename": filename,
+                "data": base64.b64encode(data).decode(),
+            }
+            if not send_to_client(target, payload):
+                send_not_online(conn, target)
+
+        conn.run_blocking(blob_store.read, sha256, 0, size, then=send_inline)
+    else:
+        send_not_online(conn, target)
+
+
+def handle_blob_offer(conn, msg, username, display_name):
+    sha256 = msg.get("sha256")
+    size = msg.get("size")
+    target = msg.get("to")
+    filename = msg.get("filename")
+    if not conn.blobs or not BlobStore.valid(sha256) or not isinstance(size, int) or size < 0:
+        conn.send_message({
+            "type": "ERROR",
+            "message": "Invalid BLOB_OFFER",
+            "sha256": sha256,
+        })
+        return
+    if size > MAX_BLOB_SIZE:
+        conn.send_message({
+            "type": "ERROR",
+            "message": f"Blob larger than {MAX_BLOB_SIZE} bytes",
+            "sha256": sha256,
+        })
+        return
+    if not online(target) or target == username:
+        conn.send_message({
+            "type": "ERROR",
+            "message": f"User {target} not online",
+            "sha256": sha256,
+        })
+        return
+
+    def sized(stored_size):
+        if stored_size == size:
+            # already stored: no upload, just the reference
+            conn.send_message({"type": "BLOB_HAVE", "sha256": sha256})
+            deliver_file_ref(
+                conn, username, display_name, target, sha256, size, filename
+            )
+            return
+        entry = conn.uploads.get(sha256)
+        if entry is not None:
+            # same blob already on its way from this client
+            entry["deliveries"].append((target, filename))
+            return
+        # a resumed upload rehashes what is already there
+        conn.run_blocking(blob_store.open_upload, sha256, size, username, then=opened)
+
+    def opened(upload):
         try:
-            clients[target_username]["conn"].send(json.dumps(payload).encode())
-        except:
-            pass
+            conn.send_message(
+                {"type": "BLOB_UPLOAD", "sha256": sha256, "offset": upload.offset}
+            )
+        except ConnectionError:
+            upload.abort()  # gone while it was opened
+            raise
+        conn.uploads[sha256] = {
+            "upload": upload,
+            "deliveries": [(target, filename)],
+            "chunks": 0,
+            "rewound_at": None,
+        }
+
+    conn.run_blocking(blob_store.size, sha256, then=sized)
+
 
+def handle_blob_chunk(conn, msg):
+    sha256 = msg.get("sha256")
+    entry = conn.uploads.get(sha256)
+    data = msg.get("data")
+    if entry is None or not isinstance(data, bytes) or len(data) > MAX_FILE_CHUNK:
+        conn.send_message({
+            "type": "ERROR",
+            "message": "Unexpected BLOB_CHUNK",
+            "sha256": sha256,
+        })
+        return
+    upload = entry["upload"]
 
-def handle_client(conn, addr):
-    username = None
-    buffer = ""
+    def written(ok):
+        if not ok:
+            # out of order: ask the client to rewind, once per offset
+            if entry["rewound_at"] != upload.offset:
+                entry["rewound_at"] = upload.offset
+                conn.send_message(
+                    {"type": "BLOB_UPLOAD", "sha256": sha256, "offset": upload.offset}
+                )
+            return
+        entry["chunks"] += 1
+        if entry["chunks"] % BLOB_ACK_EVERY == 0:
+            conn.send_message(
+                {"type": "BLOB_ACK", "sha256": sha256, "offset": upload.offset}
+            )
+
+    conn.run_blocking(upload.write, msg.get("offset"), data, then=written)
+
+
+def handle_blob_end(conn, msg, username, display_name):
+    sha256 = msg.get("sha256")
+    entry = conn.uploads.pop(sha256, None)
+    if entry is None:
+        return
+    upload = entry["upload"]
+
+    def committed(ok):
+        if not ok:
+            conn.send_message({
+                "type": "BLOB_STORED",
+                "sha256": sha256,
+                "ok": False,
+                "error": "checksum mismatch",
+            })
+            return
+        conn.send_message({"type": "BLOB_STORED", "sha256": sha256, "ok": True})
+        for target, filename in entry["deliveries"]:
+            deliver_file_ref(
+                conn, username, display_name, target, sha256, upload.size, filename
+            )
+
+    conn.run_blocking(upload.commit, then=committed)
+
+
+def handle_blob_get(conn, msg):
+    """Serve a byte range of a stored blob as one BLOB_DATA binary frame.
+
+    Like an HTTP range request: `offset` and `length` (default: to the end,
+    capped at MAX_BLOB_READ), and the reply says the blob's full `size`, so
+    clients can keep several ranges in flight and resume anywhere. The
+    bytes go from the file to the socket via sendfile, never through Python.
+    """
+    sha256 = msg.get("sha256")
+    if conn.blobs:
+        conn.run_blocking(open_blob, sha256, then=lambda f: serve_blob(conn, msg, f))
+    else:
+        serve_blob(conn, msg, None)
+
+
+def open_blob(sha256):
+    """blob_store.open(), or None for a blob it does not have"""
+    try:
+        return blob_store.open(sha256)
+    except (OSError, ValueError):
+        return None
+
+
+def serve_blob(conn, msg, f):
+    sha256 = msg.get("sha256")
+    if f is None:
+        conn.send_message({
+            "type": "ERROR",
+            "message": "Unknown blob",
+            "sha256": sha256,
+        })
+        return
+    size = os.fstat(f.fileno()).st_size
+    offset = msg.get("offset", 0)
+    length = msg.get("length", size)
+    if (
+        not isinstance(offset, int)
+        or not isinstance(length, int)
+        or not 0 <= offset <= size
+        or length < 0
+    ):
+        f.close()
+        conn.send_message({
+            "type": "ERROR",
+            "message": "Range not satisfiable",
+            "sha256": sha256,
+            "size": size,
+        })
+        return
+    length = min(length, size - offset, MAX_BLOB_READ)
+    conn.send_file_range(
+        {
+            "type": "BLOB_DATA",
+            "sha256": sha256,
+            "offset": offset,
+            "length": length,
+            "size": size,
+        },
+        f,
+        offset,
+        length,
+    )
+
+
+def handle_disconnect(conn, state):
+    unwatch_idle(conn)
+    for entry in conn.uploads.values():
+        entry["upload"].abort()  # dropped mid-upload: free the disk
+    conn.uploads.clear()
+    username = state["username"]
+    info = clients.get(username) if username else None
+    if info is None or info["conn"] is not conn:
+        return  # never logged in, or a newer connection took over
+    session = conn.session
+    if session is not None and not conn.timed_out and resume_grace > 0:
+        session.detach(conn)
+        session.timer = threading.Timer(resume_grace, expire_session, (session, conn))
+        session.timer.daemon = True
+        session.timer.start()
+        log.info("detached", user=username)
+        return
+    end_login(conn, username)
+
+
+def end_login(conn, username):
+    """Log `username` (connected as `conn`) out and tell everyone"""
+    log.info("disconnected", user=username, timed_out=conn.timed_out)
+    del clients[username]
+    session = conn.session
+    if session is not None:
+        if sessions.get(username) is session:
+            del sessions[username]
+        session.close()
+    subscriptions.forget(username)
+    presence.user_left(username, conn.timed_out)
+    publish({"op": "leave", "username": username, "timed_out": conn.timed_out})
+
+
+def expire_session(session, conn):
+    """The grace period of a detached session ran out without a resume.
+
+    What the client never acknowledged goes to its inbox, as far as the
+    inbox takes it (MESSAGE and FILE), for the next login.
+    """
+    unacked = session.expire()
+    if unacked is None:
+        return  # resumed or replaced meanwhile
+    username = session.username
+    if sessions.get(username) is session:
+        del sessions[username]
+    if inbox is not None and unacked:
+        deposit_frames(username, session.settings[0], unacked)
+    info = clients.get(username)
+    if info is not None and info["conn"] is conn:
+        end_login(conn, username)
+
+
+def deposit_frames(username, framing, frames):
+    """Put the MESSAGEs and FILEs among encoded `frames` in an inbox"""
+    decoder = StreamDecoder(framing)
+    for frame in frames:
+        decoder.feed(frame)
+    deposited = 0
+    for payload in decoder:
+        if isinstance(payload.get("body"), bytes):
+            body = payload.pop("body")
+            payload = expand_relay(payload, body)
+        if payload.get("type") not in ("MESSAGE", "FILE"):
+            continue
+        if isinstance(payload.get("data"), bytes):
+            payload["data"] = base64.b64encode(payload["data"]).decode()
+        deposited += inbox.deposit(username, payload)
+    if deposited:
+        log.info("unacked_to_inbox", user=username, messages=deposited)
+
+
+def drop_detached(username):
+    """`username` logged in elsewhere: forget a session waiting here quietly"""
+    session = sessions.get(username)
+    if session is None or session.expire() is None:
+        return
+    del sessions[username]
+    info = clients.get(username)
+    if info is not None and info["conn"].session is session:
+        del clients[username]  # presence already counts the new login
+        subscriptions.forget(username)
+
+
+def handle_client(sock, addr):
+    conn = SocketConnection(sock)
+    state = new_state()
+    watch_idle(conn)
     try:
         while True:
-            raw = conn.recv(4096).decode()
+            raw = conn.recv()
             if not raw:
                 break
 
-            buffer += raw
-            # parse multiple JSON objects in buffer
-            new_buffer = ""
-            for msg in ParseStream(buffer):
-                if msg.get("type") == "LOGIN":
-                    username = msg["username"]
-                    display_name = msg["display_name"]
-                    clients[username] = {"conn": conn, "display_name": display_name}
-                    print(f"{display_name} ({username}) joined")
-
-                    # Send LOGIN_OK confirmation to client
-                    conn.send(json.dumps({"type": "LOGIN_OK"}).encode())
-
-                    # Broadcast to others
-                    broadcast_user_list()
-
-                elif msg.get("type") == "MESSAGE":
-                    target = msg.get("to")
-                    text = msg.get("message")
-                    from_username = msg.get("from")
-                    if target in clients:
-                        payload = {
-                            "type": "MESSAGE",
-                            "from": display_name,
-                            "message": text,
-                            "from_username": from_username,
-                        }
-                        send_to_client(target, payload)
-                    else:
-                        conn.send(
-                            json.dumps(
-                                {
-                                    "type": "ERROR",
-                                    "message": f"User {target} not online",
-                                }
-                            ).encode()
-                        )
-
-                elif msg.get("type") == "FILE":
-                    target = msg.get("to")
-                    filename = msg.get("filename")
-                    b64data = msg.get("data")
-                    if target in clients and target != username:
-                        payload = {
-                            "type": "FILE",
-                            "from": display_name,
-                            "filename": filename,
-                            "data": b64data,
-                        }
-                        send_to_client(target, payload)
-                    else:
-                        conn.send(
-                            json.dumps(
-                                {
-                                    "type": "ERROR",
-                                    "message": f"User {target} not online",
-                                }
-                            ).encode()
-                        )
-
-                elif msg.get("type") == "BROADCAST":
-                    text = msg.get("message")
-                    payload = {
-                        "type": "BROADCAST",
-                        "from": display_name,
-                        "message": text,
-                    }
-                    for u in list(clients.keys()):
-                        if u != username:
-                            send_to_client(u, payload)
-
-                elif msg.get("type") == "GET_USERS":
-                    users = [
-                        {"username": u, "display_name": c["display_name"]}
-                        for u, c in clients.items()
-                        if u != username
-                    ]
-                    conn.send(json.dumps({"type": "USERS", "users": users}).encode())
-
-                # ==== WebRTC signaling relay ====
-                elif msg.get("type") == "RTC_OFFER":
-                    target = msg.get("to")
-                    if target in clients and target != username:
-                        payload = {
-                            "type": "RTC_OFFER",
-                            "from": username,
-                            "from_display": clients[username]["display_name"],
-                            "sdp": msg.get("sdp"),
-                        }
-                        send_to_client(target, payload)
-                    else:
-                        conn.send(
-                            json.dumps(
-                                {
-                                    "type": "ERROR",
-                                    "message": f"User {target} not online",
-                                }
-                            ).encode()
-                        )
-
-                elif msg.get("type") == "RTC_ANSWER":
-                    target = msg.get("to")
-                    if target in clients and target != username:
-                        payload = {
-                            "type": "RTC_ANSWER",
-                            "from": username,
-                            "from_display": clients[username]["display_name"],
-                            "sdp": msg.get("sdp"),
-                        }
-                        send_to_client(target, payload)
-                    else:
-                        conn.send(
-                            json.dumps(
-                                {
-                                    "type": "ERROR",
-                                    "message": f"User {target} not online",
-                                }
-                            ).encode()
-                        )
-
-                elif msg.get("type") == "RTC_ICE":
-                    target = msg.get("to")
-                    if target in clients and target != username:
-                        payload = {
-                            "type": "RTC_ICE",
-                            "from": username,
-                            "candidate": msg.get("candidate"),
-                        }
-                        send_to_client(target, payload)
-                    else:
-                        conn.send(
-                            json.dumps(
-                                {
-                                    "type": "ERROR",
-                                    "message": f"User {target} not online",
-                                }
-                            ).encode()
-                        )
-
-                elif msg.get("type") == "RTC_END":
-                    target = msg.get("to")
-                    if target in clients and target != username:
-                        payload = {
-                            "type": "RTC_END",
-                            "from": username,
-                        }
-                        send_to_client(target, payload)
-                    else:
-                        conn.send(
-                            json.dumps(
-                                {
-                                    "type": "ERROR",
-                                    "message": f"User {target} not online",
-                                }
-                            ).encode()
-                        )
-
-                elif msg.get("type") == "JOIN_GROUP":
-                    group_name = msg.get("group_name")
-                    username = msg.get("username")
-
-                    if group_name not in groups:
-                        conn.send(json.dumps({
-                            "type": "ERROR",
-                            "message": f"Group '{group_name}' does not exist."
-                        }).encode())
-                    else:
-                        members = groups[group_name]["members"]
-                        if username not in members:
-                            members.append(username)
-                            print(f"{username} joined group {group_name}")
-                            broadcast_user_list()  # cập nhật danh sách cho tất cả
-                            conn.send(json.dumps({
-                                "type": "SUCCESS",
-                                "message": f"Joined group '{group_name}' successfully!"
-                            }).encode())
-                        else:
-                            conn.send(json.dumps({
-                                "type": "INFO",
-                                "message": f"You are already in group '{group_name}'."
-                            }).encode())
-
-                elif msg.get("type") == "CREATE_GROUP":
-                    group_name = msg.get("group_name")
-                    members = msg.get("members", [])
-                    if group_name not in groups:
-                        groups[group_name] = {"members": members}
-                        print(f"Group created: {group_name} -> {members}")
-                        broadcast_user_list()
-                    else:
-                        conn.send(json.dumps({
-                            "type": "ERROR",
-                            "message": f"Group {group_name} already exists"
-                        }).encode())
-
-                elif msg.get("type") == "GROUP_MESSAGE":
-                    group_name = msg.get("group_name")
-                    text = msg.get("message")
-                    from_username = msg.get("from")
-
-                    if group_name in groups:
-                        members = groups[group_name]["members"]
-                        payload = {
-                            "type": "GROUP_MESSAGE",
-                            "from": from_username,
-                            "group_name": group_name,
-                            "message": text,
-                        }
-                        for member in members:
-                            if member in clients and member != from_username:
-                                send_to_client(member, payload)
-
-            buffer = new_buffer
+            # parse every complete message; partial ones stay buffered
+            conn.decoder.feed(raw)
+            budget = SCHEDULING_QUANTUM
+            for msg in conn.decoder:
+                wait = admit(conn, msg, state)
+                if wait:
+                    time.sleep(wait)  # over a limit: stop reading meanwhile
+                if wait is not None:
+                    handle_message(conn, msg, state)
+                budget -= conn.decoder.last_size
+                if budget <= 0:
+                    # let the other client threads take the GIL (no turns)
+                    budget = SCHEDULING_QUANTUM
+                    time.sleep(0)
 
+    except (ConnectionResetError, BrokenPipeError) as e:
+        # the client went away without closing: a disconnect like any other
+        log.info("connection_lost", error=repr(e))
     except Exception as e:
-        print("Error:", e)
+        log.error("handler_failed", error=repr(e))
+        metrics.inc("chat_errors_total", ("handler",))
     finally:
-        if username and username in clients:
-            print(f"{clients[username]['display_name']} ({username}) disconnected")
-            del clients[username]
-            broadcast_user_list()
+        handle_disconnect(conn, state)
         conn.close()
 
 
-def app(port=4105):
-    ip_lan = get_lan_ip()
+def app(port=4105, host=None, reuse_port=False):
+    ip_lan = host or get_lan_ip()
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        # sibling workers bind the same port; the kernel balances accepts
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
     server.bind((ip_lan, port))
 
@@ -0,0 +1,278 @@
+import hashlib
+import os
+import socket
+import threading
+import time
+from urllib.parse import urlsplit
+
+from utils import FRAMING_LENGTH, StreamDecoder, encode_message
+from services.workers import BusHub, WorkerBus
+from services.log import log
+
+
+LINK_TIMEOUT = 5.0  # seconds to connect to a peer node, or to write to it
+LINK_RETRY_DELAY = 1.0  # seconds a link refuses ops after failing
+
+
+def parse_address(text):
+    """"host:port" -> (host, port)"""
+    host, _, port = text.rpartition(":")
+    return host or "0.0.0.0", int(port)
+
+
+class BuiltinDirectory:
+    """The built-in presence directory backend: a BusHub over TCP.
+
+    One node hosts the hub in its own process (main.py --directory-serve),
+    every node (that one included) connects to it as a client. Good for
+    development and for checking multi-node behaviour on one machine; the
+    hub is a single point of failure, so production clusters should plug in
+    a replicated store instead (see DIRECTORY_BACKENDS).
+
+    A backend receives the node's id, its link address and `on_op`, and
+    must:
+    - publish(op) "join" / "leave" / "group" ops to every other node
+    - call on_op with the same ops from other nodes ("join" carrying the
+      owning node as "worker"), "node" / "node_down" when nodes come and
+      go, and first a "sync" with everything already known
+    """
+
+    def __init__(self, url, node_id, link_address, on_op):
+        location = urlsplit(url)
+        self._bus = WorkerBus(
+            (location.hostname, location.port),
+            node_id,
+            on_op,
+            node_address=link_address,
+        )
+
+    def publish(self, op):
+        self._bus.publish(op)
+
+
+DIRECTORY_BACKENDS = {"builtin": BuiltinDirectory}
+
+
+def serve_directory(address):
+    """Host the built-in directory in this process (a daemon thread)"""
+    hub = BusHub(address)
+    threading.Thread(target=hub.serve_forever, daemon=True).start()
+    return hub
+
+
+def node_marker(shared_dir, node_id):
+    """The file a node leaves in `shared_dir` to show it uses it"""
+    key = hashlib.sha256(node_id.encode()).hexdigest()[:16]
+    return os.path.join(shared_dir, "nodes", key)
+
+
+def mark_node(shared_dir, node_id):
+    path = node_marker(shared_dir, node_id)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(node_id)
+
+
+def unshared_nodes(shared_dir, node_ids):
+    """The nodes among `node_ids` whose marker is not in `shared_dir`"""
+    return [n for n in node_ids if not os.path.exists(node_marker(shared_dir, n))]
+
+
+class NodeLink:
+    """Persistent TCP link to one peer node.
+
+    send() only queues an op. The link's own thread connects (and
+    reconnects) with LINK_TIMEOUT and writes everything queued in one go,
+    so a dead peer never blocks the caller, which may be the event loop.
+    Ops it could not write are handed to `on_failed`; for LINK_RETRY_DELAY
+    after that, send() refuses new ones at once.
+    """
+
+    def __init__(self, address, on_failed=None):
+        self.address = tuple(address)
+        self.on_failed = on_failed
+        self._sock = None
+        self._cond = threading.Condition()
+        self._pending = []  # (op, encoded)
+        self._down_until = 0.0
+        self._closed = False
+        threading.Thread(target=self._write_loop, daemon=True).start()
+
+    def send(self, op):
+        """Queue `op`; False if the peer is known to be unreachable"""
+        data = encode_message(op, FRAMING_LENGTH)
+        with self._cond:
+            if self._closed or time.monotonic() < self._down_until:
+                return False
+            self._pending.append((op, data))
+            self._cond.notify()
+        return True
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                batch, self._pending = self._pending, []
+                closed = self._closed
+            if closed:
+                break
+            if not self._write(b"".join(data for _, data in batch)):
+                with self._cond:
+                    self._down_until = time.monotonic() + LINK_RETRY_DELAY
+                self._failed(batch)
+        self._close_socket()
+        self._failed(batch)
+
+    def _write(self, data):
+        for _ in range(2):  # a stale connection gets one reconnect
+            try:
+                if self._sock is None:
+                    self._sock = socket.create_connection(
+                        self.address, timeout=LINK_TIMEOUT
+                    )
+                    self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self._sock.sendall(data)
+                return True
+            except OSError:
+                self._close_socket()
+        return False
+
+    def _close_socket(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def _failed(self, batch):
+        if batch and self.on_failed is not None:
+            self.on_failed([op for op, _ in batch])
+
+
+class ClusterBus:
+    """Cross-node routing with the same publish()/on_op interface as WorkerBus.
+
+    Presence ("join", "leave", "group") goes through the directory backend,
+    which keeps every node's view of who is connected where. Messages
+    ("deliver", "broadcast") go straight to the owning node over a
+    persistent NodeLink, never through the directory. Ops arriving on
+    links are handed to `on_op` like bus ops, and so is a "deliver" a link
+    failed to write, as "undelivered" (see WorkerBus).
+
+    A FILE_REF names a blob that a client then fetches from its own node,
+    so every node must store blobs in the same (shared) directory. With
+    `shared_dir` set, each node leaves a marker file in it, and a node
+    joining a cluster whose members' markers it cannot see exits at once.
+    """
+
+    def __init__(self, node_id, link_address, directory_url, on_op, shared_dir=None):
+        self.node_id = node_id
+        self.on_op = on_op
+        self.shared_dir = shared_dir
+        self.owners = {}  # username -> node_id
+        self.links = {}  # node_id -> NodeLink
+        if shared_dir is not None:
+            mark_node(shared_dir, node_id)
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(link_address)
+        self._server.listen()
+        threading.Thread(target=self._accept_loop, daemon=True).start()
+        backend = DIRECTORY_BACKENDS[urlsplit(directory_url).scheme]
+        self.directory = backend(
+            directory_url, node_id, list(link_address), self._on_directory_op
+        )
+
+    def _on_directory_op(self, op):
+        kind = op["op"]
+        if kind == "sync":
+            if self.shared_dir is not None:
+                others = [n for n in op["nodes"] if n != self.node_id]
+                unshared = unshared_nodes(self.shared_dir, others)
+                if unshared:
+                    log.error(
+                        "blob_dir_not_shared", dir=self.shared_dir, nodes=unshared
+                    )
+                    log.flush()
+                    os._exit(1)
+            for node_id, address in op["nodes"].items():
+                if node_id != self.node_id:
+                    self.links[node_id] = self._link(node_id, address)
+            self.owners.update(op["owners"])
+        elif kind == "node":
+            self.links[op["worker"]] = self._link(op["worker"], op["address"])
+            return
+        elif kind == "node_down":
+            link = self.links.pop(op["worker"], None)
+            if link:
+                link.close()
+            return
+        elif kind == "join":
+            self.owners[op["username"]] = op["worker"]
+        elif kind == "leave":
+            self.owners.pop(op["username"], None)
+        self.on_op(op)
+
+    def _link(self, node_id, address):
+        return NodeLink(address, lambda ops: self._undelivered(node_id, ops))
+
+    def _undelivered(self, node_id, ops):
+        for op in ops:
+            if op["op"] == "deliver":
+                log.warning("node_unreachable", node=node_id)
+                self.on_op({**op, "op": "undelivered"})
+
+    def publish(self, op):
+        """Send `op` on; for "deliver", the recipients it could not reach.
+
+        Those are the ones with no node, or behind a link that is down;
+        a write that fails later comes back through on_op as "undelivered".
+        """
+        kind = op["op"]
+        missed = []
+        if kind == "deliver":
+            by_node = {}
+            for username in op["to"]:
+                node_id = self.owners.get(username)
+                if node_id in self.links:
+                    by_node.setdefault(node_id, []).append(username)
+                else:
+                    missed.append(username)
+            for node_id, usernames in by_node.items():
+                link = self.links.get(node_id)
+                if link is None or not link.send({**op, "to": usernames}):
+                    log.warning("node_unreachable", node=node_id)
+                    missed += usernames
+        elif kind == "broadcast":
+            for link in list(self.links.values()):
+                link.send(op)
+        else:
+            self.directory.publish(op)
+        return missed
+
+    def _accept_loop(self):
+        while True:
+            sock, _ = self._server.accept()
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(
+                target=self._read_link, args=(sock,), daemon=True
+            ).start()
+
+    def _read_link(self, sock):
+        decoder = StreamDecoder(FRAMING_LENGTH)
+        try:
+            while True:
+                data = sock.recv(1024 * 1024)
+                if not data:
+                    break
+                decoder.feed(data)
+                for op in decoder:
+                    self.on_op(op)
+        except Exception as e:
+            log.error("node_link_failed", error=repr(e))
+        finally:
+            sock.close()
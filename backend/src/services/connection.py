@@ -0,0 +1,460 @@
+import socket
+import threading
+import time
+from collections import deque
+
+from utils import (
+    FRAMING_JSON,
+    LANE_BULK,
+    LANE_CHAT,
+    LANE_SIGNAL,
+    LOGIN_MAX_FRAME_SIZE,
+    MAX_FRAME_SIZE,
+    SERIALIZATION_JSON,
+    StreamDecoder,
+    binary_frame_prefix,
+    encode_message,
+    encode_relay,
+    expand_relay,
+    lane_for,
+)
+from services.log import log
+
+# A lane ahead of the others for LOGIN_OK and the frames a resumed session
+# replays. They go out before anything new and are not numbered (again).
+LANE_PRELUDE = LANE_BULK + 1
+PICK_ORDER = (LANE_PRELUDE, LANE_SIGNAL, LANE_CHAT, LANE_BULK)
+
+
+class SlowConsumerError(ConnectionError):
+    pass
+
+
+def tune_socket(sock, nodelay, send_buffer=0):
+    """Set TCP_NODELAY (and SO_SNDBUF, unless 0) on a client socket.
+
+    The writers coalesce the frames queued together themselves, so the
+    kernel need not hold small frames back waiting for an ACK. A smaller
+    send buffer keeps bulk data in the writer's lanes, where signaling can
+    still overtake it, instead of in the kernel's queue, where it cannot.
+    """
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, int(nodelay))
+        if send_buffer:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, send_buffer)
+    except OSError:
+        pass  # not TCP (e.g. a socketpair in tests)
+
+
+def tcp_keepalive(sock, idle, timeout, probes=3):
+    """Have the kernel probe `sock`'s peer after `idle` silent seconds and
+    drop it if `probes` probes spread over the rest of `timeout` go
+    unanswered. For clients that cannot answer a PING.
+    """
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, "TCP_KEEPIDLE"):  # else the system's defaults
+            interval = max(1, int((timeout - idle) / probes))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(1, int(idle)))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, interval)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, probes)
+    except OSError:
+        pass  # not TCP (e.g. a socketpair in tests)
+
+
+class FileRange:
+    """A binary frame whose data is `length` bytes of an open file.
+
+    Queued in place of bytes: the transport writes `prefix`, then hands the
+    file range to the kernel (os.sendfile) so it is never read into Python.
+    len() is what it holds in memory, which is what the watermarks limit.
+    """
+
+    __slots__ = ("prefix", "file", "offset", "length")
+
+    def __init__(self, prefix, file, offset, length):
+        self.prefix = prefix
+        self.file = file
+        self.offset = offset
+        self.length = length
+
+    def __len__(self):
+        return len(self.prefix)
+
+
+class Connection:
+    """Transport-independent half of a client connection.
+
+    Holds what was negotiated at LOGIN (wire format, capabilities) and
+    the incremental decoder for the inbound stream. Subclasses provide
+    send(bytes, lane) and close(); handlers reply with send_message(dict),
+    send_shared(EncodedPayload) or send_relay(header, body) and never encode
+    payloads themselves. Frames wait in per-lane queues (see lane_for), and
+    the writers report each frame they put on the wire to the session, if
+    any, with _wrote(), since that is the order the client sees.
+    """
+
+    # Outbound queue limits, in bytes (main.py may override them). Above
+    # high_watermark a connection is congested until it drains below
+    # low_watermark; congested for longer than slow_consumer_timeout, or
+    # holding more than max_queue_bytes, and it is evicted.
+    high_watermark = 1024 * 1024
+    low_watermark = 256 * 1024
+    max_queue_bytes = 16 * 1024 * 1024
+    slow_consumer_timeout = 10.0
+
+    # Frames queued together are written with one syscall, up to
+    # write_batch of them (1: a write per frame) and write_quantum bytes,
+    # which bounds how long a signaling frame waits behind bulk data.
+    # nodelay sets TCP_NODELAY; lanes=False queues every frame in one lane.
+    write_batch = 256
+    write_quantum = 256 * 1024
+    nodelay = True
+    send_buffer = 0  # SO_SNDBUF; 0 leaves it to the kernel
+    lanes = True
+
+    evictions = 0  # across all connections
+    metrics = None  # services.metrics.Metrics, set by chat_server
+
+    def __init__(self):
+        self.framing = FRAMING_JSON
+        self.decoder = StreamDecoder(max_frame_size=LOGIN_MAX_FRAME_SIZE)
+        self.presence_deltas = False  # False: full USERS lists (old clients)
+        self.presence_subscribed = False  # only what it PRESENCE_SUBSCRIBEd to
+        self.file_chunks = False  # can receive FILE_BEGIN/FILE_CHUNK/...
+        self.blobs = False  # can use the blob store (BLOB_*, FILE_REF)
+        self.relay = False  # can receive FLAG_RELAY frames
+        self.ice_batch = False  # can receive RTC_ICE with a "candidates" list
+        self.compression = None  # codec for large frames (FRAMING_LENGTH only)
+        self.serialization = SERIALIZATION_JSON  # frame bodies (FRAMING_LENGTH only)
+        self.uploads = {}  # sha256 -> blob upload in progress
+        self.congested_since = None
+        self.evicted = False
+        self.received_at = None  # perf_counter() of the last recv
+        self.idle_watch = False  # on the keepalive timer wheel
+        self.keepalive = False  # answers PING (said so at LOGIN)
+        self.timed_out = False  # reaped by the keepalive as a dead peer
+        self.session = None  # services.session.Session, if resumable
+        self._on_written = {}  # id(frame) -> (frame, callback)
+
+    @property
+    def queued_bytes(self):
+        """Bytes accepted by send() but not yet written to the socket"""
+        raise NotImplementedError
+
+    @property
+    def congested(self):
+        return self.congested_since is not None
+
+    def _admit(self, size):
+        """Evict instead of queueing `size` more bytes if over the limits.
+
+        A frame is always accepted into an empty queue, so one large FILE
+        does not evict an otherwise healthy receiver.
+        """
+        queued = self.queued_bytes
+        if queued and queued + size > self.max_queue_bytes:
+            self.evict(f"send queue over {self.max_queue_bytes} bytes")
+        if (
+            self.congested_since is not None
+            and time.monotonic() - self.congested_since > self.slow_consumer_timeout
+        ):
+            self.evict(f"congested for over {self.slow_consumer_timeout}s")
+
+    def evict(self, reason):
+        if not self.evicted:
+            self.evicted = True
+            Connection.evictions += 1
+            if self.metrics is not None:
+                self.metrics.inc("chat_evictions_total")
+            log.warning("evicted", reason=reason)
+            self.abort()
+        raise SlowConsumerError(reason)
+
+    def set_framing(self, framing):
+        """Switch both directions to `framing` (after LOGIN_OK is sent).
+
+        Only then may the client send frames larger than a LOGIN.
+        """
+        self.framing = framing
+        self.decoder.mode = framing
+        self.decoder.max_frame_size = MAX_FRAME_SIZE
+
+    def encode(self, payload):
+        return encode_message(
+            payload, self.framing, self.compression, self.serialization
+        )
+
+    def _count_writes(self, frames):
+        if self.metrics is not None:
+            self.metrics.inc("chat_socket_writes_total")
+            self.metrics.inc("chat_socket_write_frames_total", (), frames)
+
+    def _count_sent(self, msg_type, size):
+        if self.metrics is not None:
+            self.metrics.inc("chat_messages_sent_total", (msg_type,))
+            self.metrics.inc("chat_sent_bytes_total", (msg_type,), size)
+
+    def _send_frame(self, frame, msg_type):
+        """send() in `msg_type`'s lane, through the session if there is one"""
+        if msg_type == "LOGIN_OK":
+            lane = LANE_PRELUDE
+        else:
+            lane = lane_for(msg_type) if self.lanes else LANE_CHAT
+        session = self.session
+        if session is None:
+            return self.send(frame, lane)
+        return session.send(frame, lane)
+
+    def send_message(self, payload, written=None):
+        """Queue `payload`; `written()` is called once it is on the wire"""
+        msg_type = payload.get("type")
+        frame = self.encode(payload)
+        if written is not None:
+            self._on_written[id(frame)] = (frame, written)
+        size = self._send_frame(frame, msg_type)
+        self._count_sent(msg_type, size)
+        return size
+
+    def send_shared(self, shared):
+        """Send an EncodedPayload built once for many recipients"""
+        msg_type = shared.payload.get("type")
+        size = self._send_frame(
+            shared.encode(self.framing, self.compression, self.serialization),
+            msg_type,
+        )
+        self._count_sent(msg_type, size)
+        return size
+
+    def send_relay(self, header, body):
+        """Forward a relayed message; `body` is only parsed for old clients"""
+        if not self.relay:
+            return self.send_message(expand_relay(header, body))
+        size = self._send_frame(
+            encode_relay(header, body, self.compression), header["type"]
+        )
+        self._count_sent(header["type"], size)
+        return size
+
+    def send_file_range(self, payload, file, offset, length):
+        """Send `payload` with `length` bytes of `file` at `offset` as its data.
+
+        Takes ownership of `file` (closed once sent). Needs FRAMING_LENGTH,
+        since the bytes go out as a FLAG_BINARY frame.
+        """
+        try:
+            prefix = binary_frame_prefix(payload, length)
+            self._send_frame(
+                FileRange(prefix, file, offset, length), payload.get("type")
+            )
+        except ConnectionError:
+            file.close()
+            raise
+        self._count_sent(payload.get("type"), len(prefix) + length)
+        return len(prefix)
+
+    def _wrote(self, frames):
+        """`frames` went on the wire (or were handed to the kernel)"""
+        session = self.session
+        if session is not None and frames:
+            session.wrote(self, frames)
+
+    def _written(self, frames):
+        """The writer has written `frames` to the socket"""
+        if self._on_written:
+            for frame in frames:
+                entry = self._on_written.pop(id(frame), None)
+                if entry is not None:
+                    entry[1]()
+
+    def run_blocking(self, fn, *args, then=None):
+        """Run `fn(*args)` (disk I/O for a handler), then `then(result)`.
+
+        Here, on the connection's own thread, right away. The asyncio server
+        runs `fn` in the loop's executor instead and holds this connection's
+        later messages until `then` has run, so they stay in order.
+        """
+        result = fn(*args)
+        if then is not None:
+            then(result)
+
+    def send(self, data, lane=LANE_CHAT):
+        raise NotImplementedError
+
+    def take_unsent(self):
+        """Remove and return the frames still queued, except the prelude"""
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def abort(self):
+        """Close without flushing what is still queued"""
+        self.close()
+
+    @property
+    def socket(self):
+        """The client's socket, for setsockopt()"""
+        raise NotImplementedError
+
+
+class SocketConnection(Connection):
+    """Blocking socket used by the threaded server.
+
+    send() only appends to a queue; a writer thread per connection drains
+    it, so a relaying handler never blocks on (or interleaves with) a slow
+    receiver. Whatever queued up while the writer was busy goes out in a
+    single sendmsg(), highest priority lane first. A connection closed
+    while it has a session keeps its queue for take_unsent().
+    """
+
+    def __init__(self, sock):
+        super().__init__()
+        self.sock = sock
+        tune_socket(sock, self.nodelay, self.send_buffer)
+        self._lanes = [deque() for _ in PICK_ORDER]
+        self._queued_frames = 0
+        self._queued_bytes = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    @property
+    def queued_bytes(self):
+        return self._queued_bytes
+
+    @property
+    def socket(self):
+        return self.sock
+
+    def recv(self, size=65536):
+        data = self.sock.recv(size)
+        self.received_at = time.perf_counter()
+        return data
+
+    def send(self, data, lane=LANE_CHAT):
+        with self._cond:
+            if self._closed:
+                raise ConnectionError("connection closed")
+            self._admit(len(data))
+            self._lanes[lane].append(data)
+            self._queued_frames += 1
+            self._queued_bytes += len(data)
+            if (
+                self.congested_since is None
+                and self._queued_bytes > self.high_watermark
+            ):
+                self.congested_since = time.monotonic()
+            self._cond.notify()
+        return len(data)
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                while not self._queued_frames and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                batch, prelude = self._take_batch()
+                self._queued_frames -= len(batch)
+            self._wrote(batch[prelude:])
+            size = sum(map(len, batch))
+            try:
+                if isinstance(batch[0], FileRange):
+                    self._sendfile(batch[0])
+                else:
+                    self._sendmsg(batch)
+            except OSError:
+                self.close()
+                return
+            self._written(batch)
+            with self._cond:
+                self._queued_bytes -= size
+                if (
+                    self.congested_since is not None
+                    and self._queued_bytes <= self.low_watermark
+                ):
+                    self.congested_since = None
+
+    def _take_batch(self):
+        """The next write: frames in lane order, or one FileRange alone.
+
+        Returns the frames and how many of them (at the front) are from
+        the prelude lane.
+        """
+        batch, size, prelude = [], 0, 0
+        for lane in PICK_ORDER:
+            queue = self._lanes[lane]
+            while queue:
+                if isinstance(queue[0], FileRange):
+                    if not batch:
+                        batch.append(queue.popleft())
+                        prelude = int(lane == LANE_PRELUDE)
+                    return batch, prelude
+                if len(batch) >= self.write_batch or size >= self.write_quantum:
+                    return batch, prelude
+                data = queue.popleft()
+                batch.append(data)
+                size += len(data)
+                if lane == LANE_PRELUDE:
+                    prelude += 1
+        return batch, prelude
+
+    def take_unsent(self):
+        with self._cond:
+            frames = []
+            for lane in PICK_ORDER[1:]:
+                frames.extend(self._lanes[lane])
+                self._lanes[lane].clear()
+            self._queued_frames -= len(frames)
+            self._queued_bytes -= sum(map(len, frames))
+            return frames
+
+    def _sendmsg(self, buffers):
+        """Write all of `buffers` with as few syscalls as the socket allows"""
+        self._count_writes(len(buffers))
+        if len(buffers) == 1 or not hasattr(self.sock, "sendmsg"):
+            self.sock.sendall(b"".join(buffers))  # no sendmsg on Windows
+            return
+        while buffers:
+            sent = self.sock.sendmsg(buffers)
+            done = 0
+            while done < len(buffers) and sent >= len(buffers[done]):
+                sent -= len(buffers[done])
+                done += 1
+            buffers = buffers[done:]
+            if sent:
+                buffers[0] = memoryview(buffers[0])[sent:]
+
+    def _sendfile(self, rng):
+        self._count_writes(1)
+        try:
+            self.sock.sendall(rng.prefix)
+            # os.sendfile where the platform has it, read()+send() otherwise
+            sent = self.sock.sendfile(rng.file, rng.offset, rng.length)
+            if sent != rng.length:
+                raise OSError("file shorter than the frame announced")
+        finally:
+            rng.file.close()
+
+    def close(self):
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            if self.session is None:
+                for queue in self._lanes:
+                    for data in queue:
+                        if isinstance(data, FileRange):
+                            data.file.close()
+                    queue.clear()
+                self._queued_frames = 0
+                self._queued_bytes = 0
+            self._cond.notify()
+        try:
+            # wakes the handler thread blocked in recv()
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
@@ -0,0 +1,42 @@
+import threading
+
+
+class IceBatcher:
+    """Trickled RTC_ICE candidates, coalesced into short flush windows.
+
+    A client trickling ICE sends each candidate as soon as it is gathered,
+    usually several within a few milliseconds. The first candidate arms a
+    timer; when it fires, everything recorded in the window is handed to
+    `on_flush(sender, target, candidates)`, once per caller and callee, with
+    the candidates in the order they arrived. A `window` of 0 hands each
+    candidate over right away.
+    """
+
+    def __init__(self, on_flush, window=0.005):
+        self.on_flush = on_flush
+        self.window = window
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # keeps windows in order
+        self._pending = {}  # (sender, target) -> [candidate]
+        self._timer = None
+
+    def add(self, sender, target, candidate):
+        if self.window <= 0:
+            self.on_flush(sender, target, [candidate])
+            return
+        with self._lock:
+            self._pending.setdefault((sender, target), []).append(candidate)
+            if self._timer is None:
+                self._timer = threading.Timer(self.window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                pending, self._pending = self._pending, {}
+            for (sender, target), candidates in pending.items():
+                self.on_flush(sender, target, candidates)
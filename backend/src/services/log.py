@@ -0,0 +1,148 @@
+import itertools
+import json
+import queue
+import sys
+import threading
+import time
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVELS = {"debug": DEBUG, "info": INFO, "warning": WARNING, "error": ERROR}
+LEVEL_NAMES = {v: k.upper() for k, v in LEVELS.items()}
+
+# Debug traffic records kept per message type: 1 in N. Chatty types are
+# thinned out by default; 0 drops a type entirely.
+DEFAULT_SAMPLING = {
+    "RTC_ICE": 20,
+    "FILE_CHUNK": 100,
+    "FILE_ACK": 100,
+    "BLOB_CHUNK": 100,
+}
+
+
+class Log:
+    """Structured event log that never blocks the caller.
+
+    Records are (time, level, event, fields) tuples put on a bounded
+    queue and formatted and written by one background thread. When the
+    queue is full the record is dropped and counted, so a slow terminal
+    or log pipe costs log lines instead of relay throughput.
+
+    traffic() records whole messages at DEBUG level, sampled per type
+    and with long strings cut to `truncate` characters; at the default
+    INFO level it returns after one comparison. set_level() and
+    toggle_debug() take effect immediately (main.py wires SIGUSR1).
+    """
+
+    def __init__(self, level=INFO, queue_size=10000, truncate=200, fmt="text"):
+        self.level = level
+        self.truncate = truncate
+        self.fmt = fmt
+        self.stream = None  # None: sys.stdout at write time
+        self.sampling = dict(DEFAULT_SAMPLING)
+        self.dropped = 0
+        self._seen = {}  # msg type -> itertools.count
+        self._queue = queue.Queue(queue_size)
+        self._writer = None
+        self._lock = threading.Lock()
+
+    def set_level(self, level):
+        self.level = LEVELS[level] if isinstance(level, str) else level
+
+    def toggle_debug(self):
+        self.level = INFO if self.level == DEBUG else DEBUG
+        self.info("log_level", now=LEVEL_NAMES[self.level].lower())
+
+    def log(self, level, event, /, **fields):
+        if level < self.level:
+            return
+        if self._writer is None:
+            self._start()
+        try:
+            self._queue.put_nowait((time.time(), level, event, fields))
+        except queue.Full:
+            self.dropped += 1
+
+    def debug(self, event, /, **fields):
+        self.log(DEBUG, event, **fields)
+
+    def info(self, event, /, **fields):
+        self.log(INFO, event, **fields)
+
+    def warning(self, event, /, **fields):
+        self.log(WARNING, event, **fields)
+
+    def error(self, event, /, **fields):
+        self.log(ERROR, event, **fields)
+
+    def traffic(self, event, payload, /, **fields):
+        """A DEBUG record of one message, subject to per-type sampling"""
+        if self.level > DEBUG:
+            return
+        msg_type = payload.get("type")
+        every = self.sampling.get(msg_type, 1)
+        if every <= 0:
+            return
+        seen = self._seen.get(msg_type)
+        if seen is None:
+            seen = self._seen.setdefault(msg_type, itertools.count())
+        if next(seen) % every:
+            return
+        if every > 1:
+            fields["sampled"] = every
+        self.log(DEBUG, event, payload=self._cut(payload), **fields)
+
+    def _cut(self, payload):
+        """Shallow copy with long strings and lists shortened"""
+        out = {}
+        cut = self.truncate
+        for key, value in payload.items():
+            if isinstance(value, (str, bytes)) and len(value) > cut:
+                value = f"{value[:cut]!s}...(+{len(value) - cut})"
+            elif isinstance(value, list) and len(value) > 10:
+                value = f"<{len(value)} items>"
+            out[key] = value
+        return out
+
+    def flush(self, timeout=2.0):
+        """Wait (up to `timeout`) until queued records are written"""
+        deadline = time.monotonic() + timeout
+        while self._queue.unfinished_tasks and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def _start(self):
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write, daemon=True)
+                self._writer.start()
+
+    def _write(self):
+        while True:
+            record = self._queue.get()
+            stream = self.stream or sys.stdout
+            try:
+                stream.write(self._format(*record))
+                if self._queue.empty():
+                    stream.flush()
+            except (OSError, ValueError):
+                pass  # stdout closed or gone; keep draining
+            self._queue.task_done()
+
+    def _format(self, at, level, event, fields):
+        if self.fmt == "json":
+            record = {"ts": round(at, 3), "level": LEVEL_NAMES[level].lower()}
+            record["event"] = event
+            record.update(fields)
+            return json.dumps(record, default=str) + "\n"
+        stamp = time.strftime("%H:%M:%S", time.localtime(at))
+        millis = int(at % 1 * 1000)
+        parts = [f"{stamp}.{millis:03d}", f"{LEVEL_NAMES[level]:<7}", event]
+        for key, value in fields.items():
+            if not isinstance(value, (int, float)) and not (
+                isinstance(value, str) and value and " " not in value
+            ):
+                value = json.dumps(value, default=str)
+            parts.append(f"{key}={value}")
+        return " ".join(parts) + "\n"
+
+
+log = Log()
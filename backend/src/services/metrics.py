@@ -0,0 +1,158 @@
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# seconds; relay latency is dominated by queueing, so the top end is wide
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1.0, 2.5,
+)
+
+
+class Metrics:
+    """Counters and histograms, cheap enough to leave on.
+
+    Every thread records into its own shard (a plain dict only it
+    writes), so inc() and observe() take no lock. A scrape sums the
+    shards; shards of threads that have exited are folded into one, so
+    the thread-per-connection server does not grow a shard per client.
+
+    Gauges are callables read at scrape time. Label values are passed as
+    a tuple matching the metric's label names.
+    """
+
+    def __init__(self):
+        self._meta = {}  # name -> (kind, help, label names)
+        self._gauges = {}  # name -> callable returning {labels: value}
+        self._local = threading.local()
+        self._lock = threading.Lock()  # guards the shard list, not records
+        self._shards = []  # (thread, shard)
+        self._retired = {}  # folded shards of exited threads
+
+    def counter(self, name, help, labels=()):
+        self._meta[name] = ("counter", help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self._meta[name] = ("histogram", help, labels, buckets)
+
+    def gauge(self, name, help, read, labels=()):
+        self._meta[name] = ("gauge", help, labels)
+        self._gauges[name] = read
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    def inc(self, name, labels=(), value=1):
+        shard = self._shard()
+        key = (name, labels)
+        shard[key] = shard.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        shard = self._shard()
+        key = (name, labels)
+        buckets = self._meta[name][3]
+        counts = shard.get(key)
+        if counts is None:
+            # one slot per bucket, one for +Inf, then the sum
+            counts = shard[key] = [0] * (len(buckets) + 1) + [0.0]
+        counts[bisect_left(buckets, value)] += 1
+        counts[-1] += value
+
+    def _collect(self):
+        """Sum of all shards: {(name, labels): int or histogram list}"""
+        with self._lock:
+            live = []
+            for thread, shard in self._shards:
+                if thread.is_alive():
+                    live.append((thread, shard))
+                else:
+                    _merge(self._retired, shard)
+            self._shards = live
+            total = {}
+            _merge(total, self._retired)
+            for _, shard in live:
+                _merge(total, shard)
+        return total
+
+    def render(self):
+        """Everything in the Prometheus text exposition format"""
+        values = self._collect()
+        by_name = {}
+        for (name, labels), value in values.items():
+            by_name.setdefault(name, []).append((labels, value))
+        for name, read in self._gauges.items():
+            by_name[name] = list(read().items())
+        lines = []
+        for name, (kind, help, label_names, *rest) in self._meta.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in sorted(by_name.get(name, ()), key=_sort_key):
+                pairs = list(zip(label_names, labels))
+                if kind != "histogram":
+                    lines.append(f"{name}{_labels(pairs)} {value}")
+                    continue
+                cumulative = 0
+                for le, count in zip((*rest[0], "+Inf"), value):
+                    cumulative += count
+                    bucket = _labels(pairs + [("le", le if le == "+Inf" else repr(le))])
+                    lines.append(f"{name}_bucket{bucket} {cumulative}")
+                lines.append(f"{name}_sum{_labels(pairs)} {value[-1]}")
+                lines.append(f"{name}_count{_labels(pairs)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+def _merge(into, shard):
+    for key, value in list(shard.items()):
+        if isinstance(value, list):
+            have = into.get(key)
+            if have is None:
+                into[key] = list(value)
+            else:
+                for i in range(len(have)):
+                    have[i] += value[i]
+        else:
+            into[key] = into.get(key, 0) + value
+
+
+def _sort_key(item):
+    return tuple(str(v) for v in item[0])
+
+
+def _labels(pairs):
+    if not pairs:
+        return ""
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in pairs
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def serve(metrics, host, port):
+    """Serve GET /metrics on (host, port) from a daemon thread"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # scrapes every few seconds would flood the log
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
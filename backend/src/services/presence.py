@@ -0,0 +1,207 @@
+import threading
+
+
+class Presence:
+    """Versioned presence changes, coalesced into flush windows.
+
+    Handlers record joins, leaves and group additions as they happen. The
+    first change arms a timer; when it fires, everything recorded in the
+    window is handed to `on_flush(version, joined, left, groups, timed_out)`
+    as one delta with the next version number:
+
+    - joined: {username: display_name}
+    - left: {username}
+    - groups: {username: {group_name}} groups that became visible to a user
+    - timed_out: {username} the part of `left` reaped as dead connections
+
+    A user who joins and leaves inside one window is reported as left only,
+    which is harmless for clients that never saw them.
+    """
+
+    def __init__(self, on_flush, flush_interval=0.05):
+        self.on_flush = on_flush
+        self.flush_interval = flush_interval
+        self.version = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # keeps versions in order
+        self._joined = {}
+        self._left = set()
+        self._groups = {}
+        self._timed_out = set()
+        self._timer = None
+
+    def user_joined(self, username, display_name):
+        with self._lock:
+            self._left.discard(username)
+            self._timed_out.discard(username)
+            self._joined[username] = display_name
+            self._schedule()
+
+    def user_left(self, username, timed_out=False):
+        with self._lock:
+            self._joined.pop(username, None)
+            self._groups.pop(username, None)
+            self._left.add(username)
+            if timed_out:
+                self._timed_out.add(username)
+            self._schedule()
+
+    def group_added(self, group_name, usernames):
+        with self._lock:
+            for username in usernames:
+                self._groups.setdefault(username, set()).add(group_name)
+            self._schedule()
+
+    def _schedule(self):
+        if self._timer is None:
+            self._timer = threading.Timer(self.flush_interval, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                if not (self._joined or self._left or self._groups):
+                    return
+                joined, left, groups = self._joined, self._left, self._groups
+                timed_out = self._timed_out
+                self._joined, self._left, self._groups = {}, set(), {}
+                self._timed_out = set()
+                self.version += 1
+                version = self.version
+            self.on_flush(version, joined, left, groups, timed_out)
+
+
+class Subscriptions:
+    """Who watches whose presence, for clients on interest-based presence.
+
+    A subscriber watches users directly and groups as a whole (every member,
+    current and future). Both are indexed from the watched side, so finding
+    the subscribers of one user's change costs the number of its watchers
+    and groups, not the number of clients.
+
+    A subscriber may also ask to watch at least `fill` users (the rows of a
+    list): online users are added until it does, and so is everyone who
+    comes online while it still does not. A user added that way stops
+    being watched on going offline, which makes room for the next one.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._user_watchers = {}  # username -> {subscriber}
+        self._group_watchers = {}  # group_name -> {subscriber}
+        self._watching = {}  # subscriber -> ({username}, {group_name})
+        self._fill = {}  # subscriber -> (fill, {username} added to reach it)
+        self._filling = set()  # subscribers below their fill
+
+    def subscribe(self, subscriber, users=(), groups=()):
+        with self._lock:
+            watched_users, watched_groups = self._watching.setdefault(
+                subscriber, (set(), set())
+            )
+            added = self._fill[subscriber][1] if subscriber in self._fill else set()
+            for username in users:
+                watched_users.add(username)
+                self._user_watchers.setdefault(username, set()).add(subscriber)
+                added.discard(username)  # asked for, so kept when offline
+            for group_name in groups:
+                watched_groups.add(group_name)
+                self._group_watchers.setdefault(group_name, set()).add(subscriber)
+            self._check_fill(subscriber)
+
+    def unsubscribe(self, subscriber, users=(), groups=()):
+        with self._lock:
+            watched = self._watching.get(subscriber)
+            if watched is None:
+                return
+            for username in users:
+                watched[0].discard(username)
+                _discard(self._user_watchers, username, subscriber)
+            for group_name in groups:
+                watched[1].discard(group_name)
+                _discard(self._group_watchers, group_name, subscriber)
+            self._check_fill(subscriber)
+
+    def forget(self, subscriber):
+        """Drop everything `subscriber` watches (logged out)"""
+        with self._lock:
+            users, groups = self._watching.pop(subscriber, ((), ()))
+            self._fill.pop(subscriber, None)
+            self._filling.discard(subscriber)
+            for username in users:
+                _discard(self._user_watchers, username, subscriber)
+            for group_name in groups:
+                _discard(self._group_watchers, group_name, subscriber)
+
+    def watched(self, subscriber):
+        """({username}, {group_name}) that `subscriber` watches, as copies"""
+        with self._lock:
+            users, groups = self._watching.get(subscriber, ((), ()))
+            return set(users), set(groups)
+
+    def watchers(self, username, group_names=()):
+        """Subscribers of `username` (None: nobody directly) or `group_names`"""
+        with self._lock:
+            found = set(self._user_watchers.get(username, ()))
+            for group_name in group_names:
+                found.update(self._group_watchers.get(group_name, ()))
+            return found
+
+    def fill(self, subscriber, fill, online):
+        """Have `subscriber` watch at least `fill` users, taking them from
+        `online` (in order) for now; returns the ones taken"""
+        with self._lock:
+            self._watching.setdefault(subscriber, (set(), set()))
+            self._fill[subscriber] = (fill, set())
+            self._check_fill(subscriber)
+            return [u for u in online if self._take(subscriber, u)]
+
+    def newcomer(self, username):
+        """Subscribers below their fill, now watching `username` (just online)"""
+        with self._lock:
+            return {s for s in list(self._filling) if self._take(s, username)}
+
+    def gone(self, username):
+        """`username` went offline: stop watching it where fill added it"""
+        with self._lock:
+            for subscriber in list(self._user_watchers.get(username, ())):
+                added = self._fill[subscriber][1] if subscriber in self._fill else ()
+                if username in added:
+                    added.discard(username)
+                    self._watching[subscriber][0].discard(username)
+                    _discard(self._user_watchers, username, subscriber)
+                    self._check_fill(subscriber)
+
+    def _take(self, subscriber, username):
+        users = self._watching[subscriber][0]
+        if subscriber not in self._filling or username == subscriber:
+            return False
+        if username in users:
+            return False
+        users.add(username)
+        self._user_watchers.setdefault(username, set()).add(subscriber)
+        self._fill[subscriber][1].add(username)
+        self._check_fill(subscriber)
+        return True
+
+    def _check_fill(self, subscriber):
+        users, _ = self._watching.get(subscriber, ((), ()))
+        if len(users) < self._fill.get(subscriber, (0,))[0]:
+            self._filling.add(subscriber)
+        else:
+            self._filling.discard(subscriber)
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(u) + len(g) for u, g in self._watching.values())
+
+
+def _discard(index, key, subscriber):
+    watchers = index.get(key)
+    if watchers is not None:
+        watchers.discard(subscriber)
+        if not watchers:
+            del index[key]
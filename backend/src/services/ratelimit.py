@@ -0,0 +1,104 @@
+# (messages per second, burst) per user and message type; "*" covers every
+# type not listed, each with a bucket of its own.
+DEFAULT_LIMITS = {
+    "*": (100, 500),
+    "BROADCAST": (1, 5),
+    "FILE": (5, 20),
+    "CREATE_GROUP": (2, 10),
+    "GET_USERS": (2, 10),
+    "PRESENCE_SUBSCRIBE": (10, 50),
+    "HISTORY": (10, 50),
+}
+DEFAULT_BYTE_RATE = 8 * 1024 * 1024  # per user, all types together
+DEFAULT_BYTE_BURST = 32 * 1024 * 1024
+MAX_DELAY = 2.0  # seconds a message may be held back before it is refused
+
+
+class RateLimited(Exception):
+    def __init__(self, msg_type, retry_after):
+        super().__init__(f"rate limit exceeded for {msg_type}")
+        self.msg_type = msg_type
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "stamp")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def wait(self, amount, now):
+        """Seconds after `now` until `amount` tokens are available (0: now)"""
+        if now > self.stamp:
+            self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+        return max(0.0, (amount - self.tokens) / self.rate)
+
+    def take(self, amount):
+        self.tokens -= amount  # may go negative; the debt is waited off
+
+    def full(self, now):
+        return self.tokens + (now - self.stamp) * self.rate >= self.burst
+
+
+class RateLimiter:
+    """Token buckets per user: one per message type, one for bytes.
+
+    charge() is given the time a message arrived and returns how long
+    after that it may be handled, so messages that arrived together queue
+    up behind each other. A message type over its limit is delayed up to
+    `max_delay` and refused (RateLimited) beyond that; bytes are only ever
+    delayed, so a bulk transfer slows to `byte_rate` instead of failing.
+    Each user's buckets are only updated by the thread or callback serving
+    that user; sweep() only drops whole sets, once they are full.
+    """
+
+    def __init__(
+        self,
+        limits=None,
+        byte_rate=DEFAULT_BYTE_RATE,
+        byte_burst=DEFAULT_BYTE_BURST,
+        max_delay=MAX_DELAY,
+    ):
+        self.limits = dict(DEFAULT_LIMITS if limits is None else limits)
+        self.byte_rate = byte_rate
+        self.byte_burst = byte_burst
+        self.max_delay = max_delay
+        self._users = {}  # username -> {msg_type or None (bytes): TokenBucket}
+
+    def charge(self, username, msg_type, size, now):
+        buckets = self._users.get(username)
+        if buckets is None:
+            buckets = self._users[username] = {
+                None: TokenBucket(self.byte_rate, self.byte_burst, now)
+            }
+        bucket = buckets.get(msg_type)
+        if bucket is None:
+            rate, burst = self.limits.get(msg_type) or self.limits["*"]
+            bucket = buckets[msg_type] = TokenBucket(rate, burst, now)
+        wait = bucket.wait(1, now)
+        if wait > self.max_delay:
+            raise RateLimited(msg_type, wait)
+        bucket.take(1)
+        wait = max(wait, buckets[None].wait(size, now))
+        buckets[None].take(size)
+        return wait
+
+    def sweep(self, now):
+        """Drop the buckets of users whose buckets have all refilled.
+
+        New ones would start out the same, so nothing is lost; until then
+        they are kept, even for users who logged out, so reconnecting does
+        not reset a limit. Returns how many users were dropped.
+        """
+        idle = [
+            username
+            for username, buckets in list(self._users.items())
+            if all(bucket.full(now) for bucket in buckets.values())
+        ]
+        for username in idle:
+            self._users.pop(username, None)
+        return len(idle)
@@ -0,0 +1,193 @@
+import secrets
+import threading
+from collections import deque
+
+from services.connection import LANE_PRELUDE, FileRange, SlowConsumerError
+
+RESUME_GRACE = 30.0  # seconds a dropped session waits to be resumed
+RESUME_BUFFER_BYTES = 1024 * 1024
+RESUME_BUFFER_FRAMES = 4096
+
+
+class Session:
+    """Numbered server-to-client frames of one resumable login.
+
+    Frames are numbered implicitly: the first frame after LOGIN_OK is 1,
+    and client and server both count, so nothing is added on the wire and
+    one EncodedPayload still serves every recipient. Priority lanes may
+    reorder frames, so they are numbered as the connection's writer puts
+    them on the wire (wrote()), which is the order the client counts in.
+    Each is kept, already encoded, in a ring bounded by `max_bytes` and
+    `max_frames` until the client ACKs it. FileRange frames are kept as
+    the file's path and reopened for a replay.
+
+    While the connection is gone the session is detached: what was still
+    queued on it, and every new frame, is numbered and kept. A new
+    connection that presents the token and the last seq it saw gets the
+    frames after it, provided the ring still holds them all, and then
+    carries on with the same numbering. `settings` is what the kept frames
+    were encoded for (framing, codecs, capabilities); the caller only
+    resumes a connection that negotiated the same.
+    """
+
+    def __init__(
+        self,
+        username,
+        settings,
+        max_bytes=RESUME_BUFFER_BYTES,
+        max_frames=RESUME_BUFFER_FRAMES,
+    ):
+        self.username = username
+        self.settings = settings
+        self.token = secrets.token_urlsafe(18)
+        self.max_bytes = max_bytes
+        self.max_frames = max_frames
+        self.seq = 0  # number of the last frame kept
+        self.conn = None  # attached Connection; None while detached
+        self.closed = False  # expired or replaced; cannot be resumed
+        self.timer = None  # grace period while detached
+        self.lock = threading.Lock()
+        self._wire = None  # the connection whose writes are numbered
+        self._ring = deque()  # (seq, frame)
+        self._ring_bytes = 0
+
+    def send(self, frame, lane):
+        """Queue `frame` on the connection, or keep it while there is none"""
+        while True:
+            conn = self.conn
+            if conn is not None:
+                try:
+                    return conn.send(frame, lane)
+                except SlowConsumerError:
+                    raise
+                except ConnectionError:
+                    pass  # kept for a resume; senders need not know
+            with self.lock:
+                if self.conn is conn:  # else resumed meanwhile: send there
+                    if conn is not None and conn is self._wire:
+                        self._keep(conn.take_unsent())  # they came first
+                    self._keep([frame])
+                    return len(frame)
+
+    def wrote(self, conn, frames):
+        """`conn`'s writer put `frames` on the wire, in this order"""
+        with self.lock:
+            if conn is self._wire:
+                self._keep(frames, sending=True)
+
+    def _keep(self, frames, sending=False):
+        for frame in frames:
+            self.seq += 1
+            if isinstance(frame, FileRange):
+                kept = (frame.prefix, frame.file.name, frame.offset, frame.length)
+                if not sending:
+                    frame.file.close()
+            else:
+                kept = frame
+            self._ring.append((self.seq, kept))
+            self._ring_bytes += _size(kept)
+        while len(self._ring) > self.max_frames or (
+            self._ring_bytes > self.max_bytes and len(self._ring) > 1
+        ):
+            self._ring_bytes -= _size(self._ring.popleft()[1])
+
+    def ack(self, seq):
+        """The client has every frame up to `seq`: forget them"""
+        with self.lock:
+            while self._ring and self._ring[0][0] <= seq:
+                self._ring_bytes -= _size(self._ring.popleft()[1])
+
+    def attach(self, conn, after=None, greet=None):
+        """Make `conn` the session's connection.
+
+        With `after` (a resume), first check that every frame past it is
+        still kept; if not, return False. Otherwise call `greet()` (which
+        sends LOGIN_OK), queue those frames on `conn` ahead of anything
+        new and number `conn`'s writes from then on, all under the lock
+        so no other frame can slip in between.
+        """
+        with self.lock:
+            if self.closed:
+                return False
+            if self._wire is not None and self._wire is not conn:
+                # a connection that died unnoticed: its queue comes first
+                self._keep(self._wire.take_unsent())
+            replay = []
+            if after is not None:
+                if not isinstance(after, int) or not 0 <= after <= self.seq:
+                    return False
+                first = self._ring[0][0] if self._ring else self.seq + 1
+                if after + 1 < first:
+                    return False  # part of the gap was already dropped
+                replay = [kept for seq, kept in self._ring if seq > after]
+                if not all(_reopen(kept, check=True) for kept in replay):
+                    return False
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if greet is not None:
+                greet()
+            # one still holding this session now feeds `conn` too
+            self.conn = self._wire = conn
+            conn.session = self
+            for kept in replay:
+                frame = _reopen(kept)
+                try:
+                    conn.send(frame, LANE_PRELUDE)
+                except ConnectionError:
+                    if isinstance(frame, FileRange):
+                        frame.file.close()
+                    break  # still kept for the next resume
+            return True
+
+    def detach(self, conn):
+        """`conn` is gone; keep frames until a resume or close()"""
+        with self.lock:
+            if self.conn is conn:
+                self.conn = None
+                self._keep(conn.take_unsent())
+
+    def expire(self):
+        """close() unless a connection is attached.
+
+        Returns the frames the client never acknowledged, encoded as they
+        were sent (FileRange frames left out), or None if it did not close.
+        """
+        with self.lock:
+            if self.conn is not None or self.closed:
+                return None
+            unacked = [kept for _, kept in self._ring if not isinstance(kept, tuple)]
+            self._close()
+            return unacked
+
+    def close(self):
+        """Stop the session for good (replaced or logged out)"""
+        with self.lock:
+            self._close()
+
+    def _close(self):
+        self.closed = True
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.conn is not None:
+            self.conn.session = None  # carries on unnumbered
+        self._ring.clear()
+        self._ring_bytes = 0
+
+
+def _size(kept):
+    return len(kept[0]) if isinstance(kept, tuple) else len(kept)
+
+
+def _reopen(kept, check=False):
+    if not isinstance(kept, tuple):
+        return kept
+    prefix, path, offset, length = kept
+    if check:
+        try:
+            with open(path, "rb"):
+                return True
+        except OSError:
+            return False
+    return FileRange(prefix, open(path, "rb"), offset, length)
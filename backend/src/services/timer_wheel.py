@@ -0,0 +1,76 @@
+import math
+
+
+class TimerWheel:
+    """Hierarchical timing wheel: O(1) schedule and cancel, O(1) per tick.
+
+    Level 0 has one slot per tick; each level above has slots that span a
+    whole turn of the level below (`slots` ** level ticks). A timer is
+    filed in the lowest level whose range covers its deadline. When a
+    lower level wraps around, the matching slot one level up is emptied
+    and its timers are filed again, now lower down, so every timer moves
+    at most `levels` times before it expires. Deadlines beyond the top
+    level's range wait there and are refiled each time it comes round.
+
+    Keys are any hashable (the server uses Connection objects); a key has
+    at most one timer, so schedule() replaces an earlier one. Not
+    thread-safe: callers hold their own lock.
+    """
+
+    def __init__(self, tick=1.0, slots=64, levels=4, now=0.0):
+        self.tick = tick
+        self.slots = slots
+        self.start = now
+        self.current = 0  # ticks since `start`
+        self._levels = [[{} for _ in range(slots)] for _ in range(levels)]
+        self._where = {}  # key -> slot dict it is filed in
+
+    def __len__(self):
+        return len(self._where)
+
+    def __contains__(self, key):
+        return key in self._where
+
+    def schedule(self, key, delay):
+        """Expire `key` after `delay` seconds (at least one tick)"""
+        self.cancel(key)
+        self._file(key, self.current + max(1, math.ceil(delay / self.tick)))
+
+    def cancel(self, key):
+        slot = self._where.pop(key, None)
+        if slot is not None:
+            del slot[key]
+
+    def _file(self, key, deadline):
+        ticks = deadline - self.current
+        level, span = 0, self.slots
+        while ticks >= span and level < len(self._levels) - 1:
+            level += 1
+            span *= self.slots
+        slot = self._levels[level][deadline // self.slots**level % self.slots]
+        slot[key] = deadline
+        self._where[key] = slot
+
+    def advance(self, now):
+        """Move the wheel up to `now`; returns the keys that expired"""
+        target = int((now - self.start) / self.tick)
+        expired = []
+        while self.current < target:
+            self.current += 1
+            # refile the slots whose span starts now, top level first, so a
+            # timer can move down more than one level in the same tick
+            for level in range(len(self._levels) - 1, 0, -1):
+                span = self.slots**level
+                if self.current % span == 0:
+                    index = self.current // span % self.slots
+                    due = self._levels[level][index]
+                    self._levels[level][index] = {}
+                    for key, deadline in due.items():
+                        self._file(key, deadline)
+            index = self.current % self.slots
+            due = self._levels[0][index]
+            self._levels[0][index] = {}
+            for key in due:
+                del self._where[key]
+            expired.extend(due)
+        return expired
@@ -0,0 +1,262 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+
+from utils import FRAMING_LENGTH, StreamDecoder, encode_message
+from services.log import log
+
+
+def bus_socket(address):
+    """A UNIX socket for a path, TCP for a (host, port) pair"""
+    if isinstance(address, str):
+        return socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    return socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+
+
+class BusHub:
+    """Routing hub between worker processes, run by the supervisor.
+
+    Every worker keeps one socket to the hub and sends it small
+    length-framed JSON ops. The hub owns the presence directory (which
+    worker each user is connected to) and the group list, replays both to a
+    worker when it connects, and routes:
+
+    - join / leave / group: copied to every other worker (joins tagged
+      with the worker they came from)
+    - deliver {to: [usernames], payload}: split by the worker each
+      recipient is on, so a group message crosses to a worker once; the
+      recipients no worker has (logged out meanwhile) go back to the
+      sender as "undelivered", for its inbox
+    - broadcast {payload, exclude}: copied to every other worker
+
+    Workers may also announce an address in their hello; the hub passes
+    those on as "node" / "node_down" ops. The cluster mode (cluster.py)
+    uses that to run the hub over TCP as its built-in presence directory.
+    """
+
+    def __init__(self, address):
+        self.address = address
+        self.users = {}  # username -> (worker_id, directory entry)
+        self.groups = {}  # group name -> members
+        self.addresses = {}  # worker_id -> address it announced
+        self._workers = {}  # worker_id -> (socket, send lock)
+        self._lock = threading.Lock()
+        self._server = bus_socket(address)
+        if not isinstance(address, str):
+            self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(address)
+        self._server.listen()
+
+    def serve_forever(self):
+        while True:
+            sock, _ = self._server.accept()
+            threading.Thread(
+                target=self._serve_worker, args=(sock,), daemon=True
+            ).start()
+
+    def _send(self, worker_id, op):
+        entry = self._workers.get(worker_id)
+        if entry is None:
+            return
+        sock, send_lock = entry
+        try:
+            with send_lock:
+                sock.sendall(encode_message(op, FRAMING_LENGTH))
+        except OSError:
+            pass  # its reader thread cleans up
+
+    def _send_others(self, worker_id, op):
+        for other in list(self._workers):
+            if other != worker_id:
+                self._send(other, op)
+
+    def _serve_worker(self, sock):
+        decoder = StreamDecoder(FRAMING_LENGTH)
+        worker_id = None
+        try:
+            while True:
+                data = sock.recv(1024 * 1024)
+                if not data:
+                    break
+                decoder.feed(data)
+                for op in decoder:
+                    if op["op"] == "hello":
+                        worker_id = op["worker"]
+                        with self._lock:
+                            self._workers[worker_id] = (sock, threading.Lock())
+                            if op.get("address") is not None:
+                                self.addresses[worker_id] = op["address"]
+                            sync = {
+                                "op": "sync",
+                                "users": {u: e for u, (_, e) in self.users.items()},
+                                "owners": {u: w for u, (w, _) in self.users.items()},
+                                "groups": dict(self.groups),
+                                "nodes": dict(self.addresses),
+                            }
+                        self._send(worker_id, sync)
+                        if op.get("address") is not None:
+                            node = {"op": "node", "worker": worker_id}
+                            node["address"] = op["address"]
+                            self._send_others(worker_id, node)
+                    else:
+                        self._route(worker_id, op)
+        except OSError:
+            pass
+        finally:
+            sock.close()
+            with self._lock:
+                self._workers.pop(worker_id, None)
+                had_address = self.addresses.pop(worker_id, None) is not None
+                gone = [u for u, (w, _) in self.users.items() if w == worker_id]
+                for username in gone:
+                    del self.users[username]
+            for username in gone:
+                self._send_others(worker_id, {"op": "leave", "username": username})
+            if had_address:
+                self._send_others(worker_id, {"op": "node_down", "worker": worker_id})
+
+    def _route(self, worker_id, op):
+        kind = op["op"]
+        if kind == "join":
+            with self._lock:
+                self.users[op["username"]] = (worker_id, op["entry"])
+            self._send_others(worker_id, {**op, "worker": worker_id})
+        elif kind == "leave":
+            with self._lock:
+                owner = self.users.get(op["username"], (None,))[0]
+                if owner != worker_id:
+                    return  # already logged in again on another worker
+                del self.users[op["username"]]
+            self._send_others(worker_id, op)
+        elif kind == "group":
+            with self._lock:
+                self.groups[op["name"]] = op["members"]
+            self._send_others(worker_id, op)
+        elif kind == "deliver":
+            by_worker = {}
+            gone = []
+            for username in op["to"]:
+                owner = self.users.get(username, (None,))[0]
+                if owner is None:
+                    gone.append(username)
+                else:
+                    by_worker.setdefault(owner, []).append(username)
+            for owner, usernames in by_worker.items():
+                self._send(
+                    owner, {"op": "deliver", "to": usernames, "payload": op["payload"]}
+                )
+            if gone:
+                self._send(
+                    worker_id,
+                    {"op": "undelivered", "to": gone, "payload": op["payload"]},
+                )
+        elif kind == "broadcast":
+            self._send_others(worker_id, op)
+
+
+class WorkerBus:
+    """A worker's connection to the BusHub.
+
+    publish() may be called from any thread, the event loop's included: it
+    only queues the op, and a writer thread sends everything queued in one
+    write. Ops from the hub are handed to `on_op` on a reader thread; if
+    the hub goes away the worker exits, since the supervisor is gone too.
+    """
+
+    def __init__(self, address, worker_id, on_op, node_address=None):
+        self.worker_id = worker_id
+        self.on_op = on_op
+        self._sock = bus_socket(address)
+        self._sock.connect(address)
+        self._cond = threading.Condition()
+        self._pending = []  # encoded ops for the writer
+        hello = {"op": "hello", "worker": worker_id}
+        if node_address is not None:
+            hello["address"] = node_address
+        self.publish(hello)
+        threading.Thread(target=self._write_loop, daemon=True).start()
+        threading.Thread(target=self._read_loop, daemon=True).start()
+
+    def publish(self, op):
+        """Send `op` to the hub.
+
+        Returns the recipients of a "deliver" op that could not be reached,
+        like ClusterBus.publish(): none yet, since it is only queued. The
+        hub answers for the ones it cannot route with an "undelivered" op.
+        """
+        data = encode_message(op, FRAMING_LENGTH)
+        with self._cond:
+            self._pending.append(data)
+            self._cond.notify()
+        return []
+
+    def _write_loop(self):
+        try:
+            while True:
+                with self._cond:
+                    while not self._pending:
+                        self._cond.wait()
+                    batch, self._pending = self._pending, []
+                self._sock.sendall(b"".join(batch))
+        except Exception as e:
+            log.error("bus_failed", error=repr(e))
+        self._lost()
+
+    def _read_loop(self):
+        decoder = StreamDecoder(FRAMING_LENGTH)
+        try:
+            while True:
+                data = self._sock.recv(1024 * 1024)
+                if not data:
+                    break
+                decoder.feed(data)
+                for op in decoder:
+                    self.on_op(op)
+        except Exception as e:
+            log.error("bus_failed", error=repr(e))
+        self._lost()
+
+    def _lost(self):
+        log.error("bus_lost", worker=self.worker_id)
+        log.flush()
+        os._exit(1)
+
+
+def supervise(workers, worker_argv):
+    """Run `workers` copies of main.py sharing the port, plus the BusHub.
+
+    Each worker is started as `main.py <worker_argv> --bus PATH --worker-id
+    N` and binds the port with SO_REUSEPORT, so the kernel spreads incoming
+    connections across them.
+    """
+    bus_dir = tempfile.mkdtemp(prefix="chat-bus-")
+    path = os.path.join(bus_dir, "bus.sock")
+    hub = BusHub(path)
+    threading.Thread(target=hub.serve_forever, daemon=True).start()
+    src_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    main_py = os.path.join(src_dir, "main.py")
+    procs = [
+        subprocess.Popen(
+            [sys.executable, main_py, *worker_argv, "--bus", path, "--worker-id", str(n)]
+        )
+        for n in range(workers)
+    ]
+    print(f"Supervisor: {workers} workers, routing bus at {path}")
+    # terminate (what service managers send) stops the workers too
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+    try:
+        for proc in procs:
+            proc.wait()
+    except KeyboardInterrupt:
+        print("\nStopping workers...")
+    finally:
+        for proc in procs:
+            proc.terminate()
+        for proc in procs:
+            proc.wait()
+        os.unlink(path)
+        os.rmdir(bus_dir)
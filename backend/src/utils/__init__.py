@@ -1,2 +1,27 @@
 from .happers import ParseStream
-from .happers import get_lan_ip
\ No newline at end of file
+from .happers import get_lan_ip
+from .framing import (
+    FRAMING_JSON,
+    FRAMING_LENGTH,
+    LANE_BULK,
+    LANE_CHAT,
+    LANE_SIGNAL,
+    LOGIN_MAX_FRAME_SIZE,
+    MAX_FRAME_SIZE,
+    SERIALIZATION_JSON,
+    SERIALIZATION_MSGPACK,
+    SUPPORTED_CODECS,
+    SUPPORTED_SERIALIZATIONS,
+    EncodedPayload,
+    FrameError,
+    StreamDecoder,
+    binary_frame_prefix,
+    compression_stats,
+    encode_message,
+    encode_relay,
+    expand_relay,
+    lane_for,
+    negotiate_compression,
+    negotiate_framing,
+    negotiate_serialization,
+)
@@ -0,0 +1,478 @@
+import json
+import re
+import struct
+import threading
+import time
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+decoder = json.JSONDecoder()
+WHITESPACE = re.compile(r"\s*")
+# what the JSON decoder stops at when a value is cut short by the end of
+# the buffer, rather than malformed: a literal, a number's fraction or
+# exponent, or a \u escape, not all there yet
+JSON_LITERALS = ("true", "false", "null", "NaN", "Infinity", "-Infinity")
+JSON_CUT_SHORT = re.compile(r"\.|[eE][-+]?|\\?u[0-9a-fA-F]{0,4}")
+
+# Wire formats. Every connection starts in FRAMING_JSON (concatenated JSON
+# objects, what old clients speak); LOGIN may negotiate FRAMING_LENGTH, after
+# which each message is HEADER + body.
+FRAMING_JSON = "json"
+FRAMING_LENGTH = "length"
+SUPPORTED_FRAMINGS = (FRAMING_LENGTH, FRAMING_JSON)  # in order of preference
+
+# 4-byte big-endian body length, 1 flags byte
+HEADER = struct.Struct("!IB")
+MAX_FRAME_SIZE = 256 * 1024 * 1024
+# until LOGIN succeeds: a LOGIN is small, and nobody has authenticated yet
+LOGIN_MAX_FRAME_SIZE = 64 * 1024
+
+# FLAG_BINARY: the body is a JSON header (length-prefixed) followed by raw
+# bytes, which decode into the header's "data" key. Lets FILE_CHUNK carry
+# file contents without base64.
+FLAG_BINARY = 0x01
+BINARY_HEADER = struct.Struct("!I")
+
+# FLAG_RELAY: the same layout, but the bytes after the header are an opaque
+# JSON object holding the rest of the message; they decode into the
+# header's "body" key. The header carries only routing (type, to, from), so
+# the server can forward MESSAGE, FILE and RTC_* bodies without parsing or
+# re-encoding them.
+FLAG_RELAY = 0x02
+
+# Per-message compression, negotiated at LOGIN on top of FRAMING_LENGTH. A
+# frame body of at least COMPRESS_THRESHOLD bytes is compressed with the
+# agreed codec when that makes it smaller, and its codec flag is set; the
+# decoder reads the flag, so either side may leave any frame uncompressed.
+# Binary file data (FLAG_BINARY) is left alone.
+FLAG_ZLIB = 0x04
+FLAG_ZSTD = 0x08
+COMPRESS_THRESHOLD = 1024
+ZLIB_LEVEL = 6
+ZSTD_LEVEL = 3
+
+# Serialization of frame bodies, negotiated at LOGIN on top of
+# FRAMING_LENGTH. JSON stays the default; with the optional msgpack package
+# a client may pick MessagePack, whose frames carry FLAG_MSGPACK and hold
+# bytes natively (FILE data without base64). Like the codec flags, the flag
+# is all the decoder needs.
+SERIALIZATION_JSON = "json"
+SERIALIZATION_MSGPACK = "msgpack"
+FLAG_MSGPACK = 0x10
+
+
+class FrameError(ValueError):
+    pass
+
+
+def _zlib_compress(data):
+    return zlib.compress(data, ZLIB_LEVEL)
+
+
+def _zlib_decompress(data, limit):
+    d = zlib.decompressobj()
+    out = d.decompress(data, limit + 1)
+    if len(out) > limit or d.unconsumed_tail:
+        raise FrameError(f"compressed frame exceeds {limit} bytes")
+    return out
+
+
+def _zstd_compress(data):
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+
+
+def _zstd_decompress(data, limit):
+    # the compressor always writes the content size, so check it first
+    size = zstandard.frame_content_size(data)
+    if size < 0 or size > limit:
+        raise FrameError(f"compressed frame exceeds {limit} bytes")
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+# codec name -> (frame flag, compress(bytes), decompress(bytes, limit))
+CODECS = {"zlib": (FLAG_ZLIB, _zlib_compress, _zlib_decompress)}
+if zstandard is not None:
+    CODECS["zstd"] = (FLAG_ZSTD, _zstd_compress, _zstd_decompress)
+SUPPORTED_CODECS = tuple(c for c in ("zstd", "zlib") if c in CODECS)  # preferred first
+COMPRESSION_FLAGS = FLAG_ZLIB | FLAG_ZSTD
+SUPPORTED_SERIALIZATIONS = (SERIALIZATION_JSON,)  # in order of preference
+if msgpack is not None:
+    SUPPORTED_SERIALIZATIONS = (SERIALIZATION_MSGPACK, SERIALIZATION_JSON)
+
+# Priority lanes for outbound frames. A writer sends whatever waits in a
+# lower-numbered lane before the next frame of a higher one, so call setup
+# and presence never queue behind a file transfer. Frames are atomic on the
+# wire, so bulk data is preempted between chunks; the order within a lane
+# is kept (FILE_END and BLOB_END follow their chunks).
+LANE_SIGNAL = 0
+LANE_CHAT = 1
+LANE_BULK = 2
+SIGNAL_TYPES = {
+    "RTC_OFFER",
+    "RTC_ANSWER",
+    "RTC_ICE",
+    "RTC_END",
+    "PRESENCE_DELTA",
+    "PRESENCE_SNAPSHOT",
+    "PRESENCE_SUBSCRIBE",
+    "PRESENCE_UNSUBSCRIBE",
+    "USERS",
+    "PING",
+    "PONG",
+    "ACK",
+}
+BULK_TYPES = {
+    "FILE",
+    "FILE_BEGIN",
+    "FILE_CHUNK",
+    "FILE_END",
+    "BLOB_CHUNK",
+    "BLOB_END",
+    "BLOB_DATA",
+}
+
+
+def lane_for(msg_type):
+    if msg_type in SIGNAL_TYPES:
+        return LANE_SIGNAL
+    if msg_type in BULK_TYPES:
+        return LANE_BULK
+    return LANE_CHAT
+
+
+def negotiate_framing(offered):
+    """Pick the best framing from what a client offered at LOGIN"""
+    for framing in SUPPORTED_FRAMINGS:
+        if offered and framing in offered:
+            return framing
+    return FRAMING_JSON
+
+
+def negotiate_compression(offered):
+    """Pick the best codec from what a client offered at LOGIN, or None"""
+    for codec in SUPPORTED_CODECS:
+        if offered and codec in offered:
+            return codec
+    return None
+
+
+def negotiate_serialization(offered):
+    """Pick the best body serialization from what a client offered at LOGIN"""
+    for serialization in SUPPORTED_SERIALIZATIONS:
+        if offered and serialization in offered:
+            return serialization
+    return SERIALIZATION_JSON
+
+
+class CompressionStats:
+    """Outbound frames per message type on connections with a codec.
+
+    For each type: frames sent, body bytes before and after compression,
+    frames that were compressed and the seconds spent compressing, which
+    is what COMPRESS_THRESHOLD trades off. Counts are per send: a fan-out
+    frame (EncodedPayload) sent to N clients counts N times, but it is
+    compressed once, so its seconds count once.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_type = {}
+
+    def record(self, msg_type, raw, wire, seconds):
+        with self._lock:
+            entry = self._by_type.get(msg_type)
+            if entry is None:
+                entry = self._by_type[msg_type] = [0, 0, 0, 0, 0.0]
+            entry[0] += 1
+            entry[1] += raw
+            entry[2] += wire
+            entry[3] += wire < raw
+            entry[4] += seconds
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                t: {
+                    "frames": e[0],
+                    "raw_bytes": e[1],
+                    "wire_bytes": e[2],
+                    "compressed": e[3],
+                    "cpu_seconds": e[4],
+                }
+                for t, e in self._by_type.items()
+            }
+
+
+compression_stats = CompressionStats()
+
+
+def encode_frame(body, flags=0, codec=None, msg_type=None):
+    """HEADER + body, compressed with `codec` if big enough to be worth it"""
+    if codec is not None:
+        raw = len(body)
+        seconds = 0.0
+        if raw >= COMPRESS_THRESHOLD:
+            flag, compress, _ = CODECS[codec]
+            t0 = time.perf_counter()
+            packed = compress(body)
+            seconds = time.perf_counter() - t0
+            if len(packed) < raw:
+                body = packed
+                flags |= flag
+        compression_stats.record(msg_type, raw, len(body), seconds)
+    return HEADER.pack(len(body), flags) + body
+
+
+def binary_frame_prefix(payload, data_len, flags=FLAG_BINARY):
+    """Everything of a FLAG_BINARY frame that precedes its `data_len` bytes"""
+    header = json.dumps({k: v for k, v in payload.items() if k != "data"}).encode()
+    return (
+        HEADER.pack(BINARY_HEADER.size + len(header) + data_len, flags)
+        + BINARY_HEADER.pack(len(header))
+        + header
+    )
+
+
+def encode_relay(header, body, codec=None):
+    """A FLAG_RELAY frame: routing `header` (a dict) + `body` bytes as is"""
+    if codec is None:
+        return binary_frame_prefix(header, len(body), FLAG_RELAY) + body
+    packed = json.dumps(header).encode()
+    return encode_frame(
+        BINARY_HEADER.pack(len(packed)) + packed + body,
+        FLAG_RELAY,
+        codec,
+        header.get("type"),
+    )
+
+
+def expand_relay(header, body):
+    """The single JSON message a relayed header + body stand for"""
+    return {**json.loads(body), **header}
+
+
+def encode_body(payload, serialization):
+    """A payload's frame body and the flags that say how it was serialized"""
+    if serialization == SERIALIZATION_MSGPACK:
+        return msgpack.packb(payload), FLAG_MSGPACK
+    return json.dumps(payload).encode(), 0
+
+
+def encode_message(
+    payload, framing=FRAMING_JSON, codec=None, serialization=SERIALIZATION_JSON
+):
+    if framing == FRAMING_LENGTH and serialization != SERIALIZATION_JSON:
+        body, flags = encode_body(payload, serialization)
+        return encode_frame(body, flags, codec, payload.get("type"))
+    data = payload.get("data")
+    if framing == FRAMING_LENGTH and isinstance(data, (bytes, bytearray, memoryview)):
+        return binary_frame_prefix(payload, len(data)) + data
+    body = json.dumps(payload).encode()
+    if framing == FRAMING_LENGTH:
+        return encode_frame(body, 0, codec, payload.get("type"))
+    return body
+
+
+class EncodedPayload:
+    """A payload serialized at most once per framing, for fan-out.
+
+    json.dumps (or msgpack) runs once no matter how many recipients; each
+    framing, codec and serialization then gets one cached byte string that
+    every recipient's send() shares, so a large delta is compressed once too.
+    """
+
+    def __init__(self, payload):
+        self.payload = payload
+        self._bodies = {}  # serialization -> (body, flags)
+        self._encoded = {}
+
+    def encode(self, framing, codec=None, serialization=SERIALIZATION_JSON):
+        if framing != FRAMING_LENGTH:
+            serialization = SERIALIZATION_JSON
+        key = (framing, codec, serialization)
+        data = self._encoded.get(key)
+        if data is None:
+            if (
+                framing == FRAMING_LENGTH
+                and serialization == SERIALIZATION_JSON
+                and isinstance(self.payload.get("data"), (bytes, bytearray, memoryview))
+            ):
+                # raw bytes "data": a FLAG_BINARY frame, as in encode_message()
+                data = encode_message(self.payload, framing)
+            else:
+                body = self._bodies.get(serialization)
+                if body is None:
+                    body = self._bodies[serialization] = encode_body(
+                        self.payload, serialization
+                    )
+                if framing == FRAMING_LENGTH:
+                    data = encode_frame(*body, codec, self.payload.get("type"))
+                else:
+                    data = body[0]
+            self._encoded[key] = data
+        elif (
+            framing == FRAMING_LENGTH
+            and codec is not None
+            and serialization in self._bodies
+        ):
+            # every send counts, though only the first one compressed it
+            raw = len(self._bodies[serialization][0])
+            compression_stats.record(
+                self.payload.get("type"), raw, len(data) - HEADER.size, 0.0
+            )
+        return data
+
+
+def _json_cut_short(text, error):
+    """Whether `error` only means the JSON in `text` has not all arrived"""
+    if error.pos == len(text) or error.msg.startswith("Unterminated string"):
+        return True
+    rest = text[error.pos :]
+    return bool(JSON_CUT_SHORT.fullmatch(rest)) or any(
+        word.startswith(rest) for word in JSON_LITERALS
+    )
+
+
+class StreamDecoder:
+    """Incremental decoder for a client byte stream.
+
+    Bytes are appended to one bytearray and consumed from a read offset, so
+    a message split across recv() calls is kept until the rest arrives.
+    `mode` may change between messages (after LOGIN negotiates framing);
+    whatever is still buffered is then read in the new mode.
+
+    FRAMING_LENGTH costs O(message): the header says when a body is complete
+    and the body is parsed once. FRAMING_JSON only re-parses when a chunk
+    ends in "}" or the buffer has doubled since the last try, so a multi-MB
+    object is not re-decoded on every recv(), yet bytes that cannot be JSON
+    raise FrameError on the recv() that brings them instead of piling up to
+    max_frame_size.
+    """
+
+    def __init__(self, mode=FRAMING_JSON, max_frame_size=MAX_FRAME_SIZE):
+        self.mode = mode
+        self.max_frame_size = max_frame_size
+        self._buf = bytearray()
+        self._pos = 0
+        self.last_size = 0  # bytes the last message took on the wire
+        # FRAMING_JSON: buffered bytes decoded once, and the char offset
+        # that corresponds to self._pos
+        self._text = None
+        self._text_idx = 0
+        self._json_ready = False
+        self._json_tried = 0  # bytes buffered at the last incomplete parse
+
+    def feed(self, data):
+        self._buf += data
+        self._text = None
+        # a chunk that does not end in "}" cannot complete an object, so
+        # wait for more, but look again now and then to catch garbage
+        self._json_ready = (
+            data.rstrip()[-1:] == b"}" or self.buffered() >= 2 * self._json_tried
+        )
+
+    def buffered(self):
+        return len(self._buf) - self._pos
+
+    def __iter__(self):
+        try:
+            while True:
+                if self.mode == FRAMING_LENGTH:
+                    msg = self._next_frame()
+                else:
+                    msg = self._next_json()
+                if msg is None:
+                    return
+                yield msg
+        finally:
+            # compact once per batch instead of once per message
+            if self._pos:
+                del self._buf[: self._pos]
+                self._pos = 0
+
+    def _next_frame(self):
+        self._text = None
+        if len(self._buf) - self._pos < HEADER.size:
+            return None
+        length, flags = HEADER.unpack_from(self._buf, self._pos)
+        if length > self.max_frame_size:
+            raise FrameError(f"frame of {length} bytes exceeds limit")
+        start = self._pos + HEADER.size
+        end = start + length
+        if len(self._buf) < end:
+            return None
+        with memoryview(self._buf) as view:
+            body = view[start:end]
+            if flags & COMPRESSION_FLAGS:
+                body = memoryview(self._decompress(body, flags))
+            if flags & FLAG_MSGPACK:
+                if msgpack is None:
+                    raise FrameError("MessagePack frame, but msgpack is not installed")
+                msg = msgpack.unpackb(body)
+            elif flags & (FLAG_BINARY | FLAG_RELAY):
+                (header_len,) = BINARY_HEADER.unpack_from(body)
+                header_end = BINARY_HEADER.size + header_len
+                msg = json.loads(body[BINARY_HEADER.size : header_end].tobytes())
+                key = "data" if flags & FLAG_BINARY else "body"
+                msg[key] = body[header_end:].tobytes()
+            else:
+                msg = json.loads(body.tobytes())
+            body.release()
+        self._pos = end
+        self.last_size = HEADER.size + length
+        return msg
+
+    def _decompress(self, data, flags):
+        for flag, _, decompress in CODECS.values():
+            if flags & flag:
+                try:
+                    return decompress(data, self.max_frame_size)
+                except FrameError:
+                    raise
+                except Exception as e:  # zlib.error, zstandard.ZstdError
+                    raise FrameError(f"bad compressed frame: {e}") from e
+        raise FrameError(f"frame compressed with an unsupported codec ({flags:#x})")
+
+    def _next_json(self):
+        if self._text is None:
+            if not self._json_ready:
+                return None
+            # surrogateescape: binary frames may already follow the last
+            # JSON message (right after LOGIN_OK), and the byte count of
+            # each message must round-trip exactly
+            with memoryview(self._buf) as view:
+                self._text = view[self._pos :].tobytes().decode(
+                    errors="surrogateescape"
+                )
+            self._text_idx = 0
+        text = self._text
+        start = WHITESPACE.match(text, self._text_idx).end()
+        try:
+            obj, end = decoder.raw_decode(text, start)
+        except json.JSONDecodeError as e:
+            if start == len(text):
+                # only whitespace left
+                self._pos = len(self._buf)
+            elif not _json_cut_short(text, e):
+                raise FrameError(f"bad JSON message: {e}") from e
+            elif self.buffered() > self.max_frame_size:
+                raise FrameError("unterminated JSON message exceeds limit")
+            self._text = None
+            self._json_ready = False
+            self._json_tried = self.buffered()
+            return None
+        self._json_tried = 0
+        size = len(text[self._text_idx : end].encode(errors="surrogateescape"))
+        self._pos += size
+        self.last_size = size
+        self._text_idx = end
+        return obj
@@ -0,0 +1,101 @@
+# Shared fixtures for the backend tests. They import backend/src directly
+# and drive the handlers in-process, with connections that only record
+# what they would have sent.
+
+import os
+import sys
+
+import pytest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(TESTS_DIR), "src")
+if SRC_DIR not in sys.path:
+    sys.path.insert(0, SRC_DIR)
+
+from services import chat_server  # noqa: E402
+from services.connection import LANE_PRELUDE, Connection, FileRange  # noqa: E402
+from services.presence import Presence, Subscriptions  # noqa: E402
+from utils import FRAMING_LENGTH, StreamDecoder  # noqa: E402
+
+
+class RecordingConnection(Connection):
+    """A Connection whose send() keeps the frames instead of writing them.
+
+    Each frame counts as written at once, as far as a session is concerned.
+    """
+
+    def __init__(self, framing=FRAMING_LENGTH):
+        super().__init__()
+        self.set_framing(framing)
+        self.frames = []
+        self.closed = False
+
+    @property
+    def queued_bytes(self):
+        return 0
+
+    def send(self, data, lane=None):
+        if self.closed:
+            raise ConnectionError("connection closed")
+        self.frames.append(data)
+        if lane != LANE_PRELUDE:
+            self._wrote([data])
+        self._written([data])
+        return len(data)
+
+    def take_unsent(self):
+        return []
+
+    def close(self):
+        self.closed = True
+
+    def messages(self):
+        """Everything sent so far, decoded, and forget it"""
+        decoder = StreamDecoder(self.framing)
+        for frame in self.frames:
+            if isinstance(frame, FileRange):
+                # what sendfile would have written
+                frame.file.seek(frame.offset)
+                data = frame.file.read(frame.length)
+                frame.file.close()
+                frame = frame.prefix + data
+            decoder.feed(frame)
+        self.frames = []
+        return list(decoder)
+
+
+def login(server, username, conn=None, **fields):
+    """A RecordingConnection (or `conn`) logged in as `username`, with what
+    LOGIN said already read; returns it and its handler state"""
+    conn = conn or RecordingConnection()
+    state = server.new_state()
+    msg = {
+        "type": "LOGIN",
+        "username": username,
+        "display_name": username.title(),
+        "framing": [FRAMING_LENGTH],
+        **fields,
+    }
+    server.handle_message(conn, msg, state)
+    conn.messages()
+    return conn, state
+
+
+@pytest.fixture
+def server(monkeypatch):
+    """chat_server with empty module state, restored afterwards.
+
+    Presence windows only close when a test calls presence.flush(), and
+    ICE candidates are relayed at once.
+    """
+    for name in ("clients", "groups", "user_groups", "remote_users", "sessions"):
+        monkeypatch.setattr(chat_server, name, {})
+    monkeypatch.setattr(chat_server, "bus", None)
+    monkeypatch.setattr(chat_server, "inbox", None)
+    monkeypatch.setattr(chat_server, "history", None)
+    monkeypatch.setattr(chat_server, "subscriptions", Subscriptions())
+    monkeypatch.setattr(
+        chat_server, "presence", Presence(chat_server.flush_presence, 3600)
+    )
+    monkeypatch.setattr(chat_server.ice_batch, "window", 0)
+    return chat_server
@@ -0,0 +1,124 @@
+import hashlib
+import os
+import socket
+import time
+
+from conftest import login
+from models import BlobStore
+from models.blob_store import PARTIAL_TTL
+from services.connection import SocketConnection
+from utils import FRAMING_LENGTH, StreamDecoder
+
+
+def store_blob(store, data, used=None):
+    sha256 = hashlib.sha256(data).hexdigest()
+    upload = store.open_upload(sha256, len(data), "alice")
+    upload.write(0, data)
+    assert upload.commit()
+    if used is not None:
+        os.utime(store.path(sha256), (used, used))
+    return sha256
+
+
+def test_abort_removes_the_partial_upload(tmp_path):
+    store = BlobStore(str(tmp_path))
+    upload = store.open_upload("a" * 64, 10, "alice")
+    upload.write(0, b"12345")
+    upload.abort()
+    assert os.listdir(tmp_path / "partial") == []
+
+
+def test_collect_drops_unused_blobs_and_stale_partials(tmp_path):
+    store = BlobStore(str(tmp_path))
+    now = time.time()
+    old = store_blob(store, b"old", used=now - 100)
+    fresh = store_blob(store, b"fresh", used=now - 10)
+    upload = store.open_upload("b" * 64, 10, "alice")
+    upload.write(0, b"1")
+    upload._file.close()
+    os.utime(upload.partial_path, (now - PARTIAL_TTL - 1,) * 2)
+
+    assert store.collect(ttl=50, now=now) == 1
+    assert store.size(old) is None
+    assert store.size(fresh) == len(b"fresh")
+    assert os.listdir(tmp_path / "partial") == []
+
+
+def test_collect_keeps_the_recently_used_under_the_cap(tmp_path):
+    store = BlobStore(str(tmp_path))
+    now = time.time()
+    first = store_blob(store, b"a" * 100, used=now - 30)
+    second = store_blob(store, b"b" * 100, used=now - 20)
+    store.open(first).close()  # read again: now the most recent
+    assert store.collect(max_bytes=150, now=now) == 1
+    assert store.size(first) == 100
+    assert store.size(second) is None
+
+
+def test_oversized_offer_is_refused(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "blob_store", BlobStore(str(tmp_path)))
+    monkeypatch.setattr(server, "MAX_BLOB_SIZE", 1000)
+    alice, state = login(server, "alice", blobs=True)
+    login(server, "bob", blobs=True)
+    offer = {"type": "BLOB_OFFER", "sha256": "c" * 64, "size": 1001, "to": "bob"}
+    server.handle_message(alice, offer, state)
+    assert alice.messages() == [
+        {"type": "ERROR", "message": "Blob larger than 1000 bytes", "sha256": "c" * 64}
+    ]
+
+
+def test_dropped_upload_leaves_nothing_behind(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "blob_store", BlobStore(str(tmp_path)))
+    alice, state = login(server, "alice", blobs=True)
+    login(server, "bob", blobs=True)
+    offer = {"type": "BLOB_OFFER", "sha256": "c" * 64, "size": 10, "to": "bob"}
+    server.handle_message(alice, offer, state)
+    chunk = {"type": "BLOB_CHUNK", "sha256": "c" * 64, "offset": 0, "data": b"12345"}
+    server.handle_message(alice, chunk, state)
+    assert len(os.listdir(tmp_path / "partial")) == 1
+    server.handle_disconnect(alice, state)
+    assert os.listdir(tmp_path / "partial") == []
+
+
+def test_blob_get_serves_a_range(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "blob_store", BlobStore(str(tmp_path)))
+    monkeypatch.setattr(server, "MAX_BLOB_READ", 4)
+    sha256 = store_blob(server.blob_store, b"0123456789")
+    alice, state = login(server, "alice", blobs=True)
+    for msg in [
+        {"offset": 2, "length": 3},
+        {"offset": 8},
+        {"offset": 0},  # capped at MAX_BLOB_READ
+        {"offset": 11},
+    ]:
+        get = {"type": "BLOB_GET", "sha256": sha256, **msg}
+        server.handle_message(alice, get, state)
+    ranges = alice.messages()
+    assert [(m.get("offset"), m.get("data")) for m in ranges[:3]] == [
+        (2, b"234"),
+        (8, b"89"),
+        (0, b"0123"),
+    ]
+    assert {m.get("size") for m in ranges} == {10}
+    assert ranges[3]["message"] == "Range not satisfiable"
+    server.handle_message(alice, {"type": "BLOB_GET", "sha256": "d" * 64}, state)
+    assert alice.messages()[0]["message"] == "Unknown blob"
+
+
+def test_file_range_goes_out_through_sendfile(tmp_path):
+    path = tmp_path / "blob"
+    path.write_bytes(b"0123456789")
+    ours, peer = socket.socketpair()
+    conn = SocketConnection(ours)
+    conn.set_framing(FRAMING_LENGTH)
+    f = open(path, "rb")
+    conn.send_file_range({"type": "BLOB_DATA", "offset": 3}, f, 3, 4)
+    decoder = StreamDecoder(FRAMING_LENGTH)
+    messages = []
+    while not messages:
+        decoder.feed(peer.recv(65536))
+        messages = list(decoder)
+    conn.close()
+    peer.close()
+    assert messages == [{"type": "BLOB_DATA", "offset": 3, "data": b"3456"}]
+    assert f.closed
@@ -0,0 +1,68 @@
+import hashlib
+
+import pytest
+
+from conftest import RecordingConnection, login
+from models import BlobStore, HistoryStore, InboxStore
+
+
+class BlockingConnection(RecordingConnection):
+    """Records what went through run_blocking(), the way off the loop"""
+
+    def __init__(self):
+        super().__init__()
+        self.blocking = []
+
+    def run_blocking(self, fn, *args, then=None):
+        self.blocking.append(fn.__name__)
+        super().run_blocking(fn, *args, then=then)
+
+
+@pytest.fixture
+def stores(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "inbox", InboxStore(str(tmp_path / "inbox.db")))
+    history = HistoryStore(str(tmp_path / "history.db"))
+    monkeypatch.setattr(server, "history", history)
+    monkeypatch.setattr(server, "blob_store", BlobStore(str(tmp_path / "blobs")))
+    yield server
+    history.close()
+
+
+def test_login_reads_the_inbox_off_the_loop(stores):
+    conn, _ = login(stores, "alice", BlockingConnection())
+    assert conn.blocking == ["remember", "drain"]
+
+
+def test_message_to_an_offline_user_looks_them_up_off_the_loop(stores):
+    stores.inbox.remember("bob")
+    alice, state = login(stores, "alice", BlockingConnection())
+    alice.blocking.clear()
+    msg = {"type": "MESSAGE", "to": "bob", "from": "alice", "message": "hi"}
+    stores.handle_message(alice, msg, state)
+    assert alice.blocking == ["known", "deposit"]
+    assert stores.inbox.drain("bob")[0][0]["message"] == "hi"
+
+
+def test_history_page_off_the_loop(stores):
+    alice, state = login(stores, "alice", BlockingConnection())
+    alice.blocking.clear()
+    stores.handle_message(alice, {"type": "HISTORY", "conversation": "user:bob"}, state)
+    assert alice.blocking == ["page"]
+    assert alice.messages()[0]["type"] == "HISTORY_PAGE"
+
+
+def test_blob_lookups_off_the_loop(stores):
+    data = b"attachment"
+    sha256 = hashlib.sha256(data).hexdigest()
+    upload = stores.blob_store.open_upload(sha256, len(data), "alice")
+    upload.write(0, data)
+    assert upload.commit()
+    alice, state = login(stores, "alice", BlockingConnection(), blobs=True)
+    login(stores, "bob", blobs=True)
+    alice.blocking.clear()
+
+    offer = {"type": "BLOB_OFFER", "sha256": sha256, "size": len(data), "to": "bob"}
+    stores.handle_message(alice, offer, state)
+    stores.handle_message(alice, {"type": "BLOB_GET", "sha256": sha256}, state)
+    assert alice.blocking == ["size", "open_blob"]
+    assert [m["type"] for m in alice.messages()] == ["BLOB_HAVE", "BLOB_DATA"]
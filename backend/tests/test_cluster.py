@@ -0,0 +1,185 @@
+import queue
+import socket
+import threading
+import time
+import zlib
+
+import pytest
+
+from conftest import RecordingConnection
+from models import InboxStore
+from services import cluster
+from services.cluster import ClusterBus, mark_node, unshared_nodes
+
+HOST = "127.0.0.1"
+
+
+def free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind((HOST, 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+class MemoryDirectory:
+    """In-process stand-in for the built-in directory (see BuiltinDirectory)"""
+
+    nodes = {}  # node_id -> (link address, on_op)
+    owners = {}  # username -> node_id
+
+    def __init__(self, url, node_id, link_address, on_op):
+        self.node_id = node_id
+        on_op(
+            {
+                "op": "sync",
+                "users": {},
+                "owners": dict(self.owners),
+                "groups": {},
+                "nodes": {n: address for n, (address, _) in self.nodes.items()},
+            }
+        )
+        for _, other_on_op in self.nodes.values():
+            other_on_op({"op": "node", "worker": node_id, "address": link_address})
+        self.nodes[node_id] = (link_address, on_op)
+
+    def publish(self, op):
+        if op["op"] == "join":
+            self.owners[op["username"]] = self.node_id
+            op = {**op, "worker": self.node_id}
+        for node_id, (_, on_op) in list(self.nodes.items()):
+            if node_id != self.node_id:
+                on_op(op)
+
+
+@pytest.fixture
+def directory(monkeypatch):
+    monkeypatch.setitem(cluster.DIRECTORY_BACKENDS, "memory", MemoryDirectory)
+    monkeypatch.setattr(MemoryDirectory, "nodes", {})
+    monkeypatch.setattr(MemoryDirectory, "owners", {})
+    return "memory://test"
+
+
+def start_node(directory, node_id, **kwargs):
+    ops = queue.Queue()
+    bus = ClusterBus(node_id, (HOST, free_port()), directory, ops.put, **kwargs)
+    return bus, ops
+
+
+def next_op(ops, kind):
+    while True:
+        op = ops.get(timeout=5)
+        if op["op"] == kind:
+            return op
+
+
+def test_deliver_goes_to_the_owning_node(directory):
+    a, _ = start_node(directory, "a")
+    b, b_ops = start_node(directory, "b")
+    b.publish({"op": "join", "username": "bob", "entry": {"display_name": "bob"}})
+    assert a.owners == {"bob": "b"}
+
+    op = {"op": "deliver", "to": ["bob"], "payload": {"type": "MESSAGE"}}
+    assert a.publish(op) == []
+    assert next_op(b_ops, "deliver") == op
+
+
+def test_deliver_reports_unreachable_recipients(directory):
+    a, a_ops = start_node(directory, "a")
+    b, _ = start_node(directory, "b")
+    b.publish({"op": "join", "username": "bob", "entry": {"display_name": "bob"}})
+    # node b went away, and the directory has not said so yet
+    a.links["b"] = a._link("b", (HOST, free_port()))
+
+    op = {"op": "deliver", "to": ["bob", "nobody"], "payload": {"type": "MESSAGE"}}
+    assert a.publish(op) == ["nobody"]
+    bounced = next_op(a_ops, "undelivered")
+    assert bounced["to"] == ["bob"]
+    # until the link retries, it says so at once
+    assert sorted(a.publish(op)) == ["bob", "nobody"]
+
+
+def test_publish_does_not_wait_for_a_dead_node(directory, monkeypatch):
+    a, a_ops = start_node(directory, "a")
+    b, _ = start_node(directory, "b")
+    b.publish({"op": "join", "username": "bob", "entry": {"display_name": "bob"}})
+    connecting = threading.Event()
+
+    def hang(address, timeout=None):
+        connecting.set()
+        time.sleep(timeout)
+        raise socket.timeout("timed out")
+
+    monkeypatch.setattr(cluster, "LINK_TIMEOUT", 0.5)
+    monkeypatch.setattr(cluster.socket, "create_connection", hang)
+    a.links["b"] = a._link("b", (HOST, free_port()))
+
+    op = {"op": "deliver", "to": ["bob"], "payload": {"type": "MESSAGE"}}
+    t0 = time.monotonic()
+    assert a.publish(op) == []
+    assert time.monotonic() - t0 < 0.1
+    assert connecting.wait(5)
+    assert next_op(a_ops, "undelivered")["to"] == ["bob"]
+
+
+def test_unreachable_recipient_gets_it_in_the_inbox(server, tmp_path, monkeypatch):
+    class DownBus:
+        def publish(self, op):
+            return list(op.get("to", []))
+
+    monkeypatch.setattr(server, "bus", DownBus())
+    monkeypatch.setattr(server, "inbox", InboxStore(str(tmp_path / "inbox.db")))
+    server.inbox.remember("bob")
+    server.remote_users["bob"] = {"display_name": "bob"}
+    alice = RecordingConnection()
+
+    payload = {"type": "MESSAGE", "from": "alice", "message": "hi"}
+    assert not server.send_to_client("bob", payload)
+    server.send_or_queue(alice, "bob", payload)
+    assert server.inbox.drain("bob")[0] == [payload]
+    assert alice.messages() == []  # no "not online" error
+
+
+def test_file_chunk_crosses_nodes(server, directory, monkeypatch):
+    a, _ = start_node(directory, "a")
+    b, b_ops = start_node(directory, "b")
+    b.publish({"op": "join", "username": "bob", "entry": {"display_name": "bob"}})
+    monkeypatch.setattr(server, "bus", a)
+    server.remote_users["bob"] = {"display_name": "bob", "file_chunks": True}
+
+    data = b"\x00\xff" * 1000
+    chunk = {
+        "type": "FILE_CHUNK",
+        "transfer_id": "t1",
+        "from": "alice",
+        "offset": 0,
+        "crc32": zlib.crc32(data),
+        "data": data,
+    }
+    assert server.send_to_client("bob", chunk)
+
+    op = next_op(b_ops, "deliver")
+    del server.remote_users["bob"]
+    bob = RecordingConnection()
+    server.clients["bob"] = {"conn": bob, "display_name": "bob"}
+    server.on_bus_op(op)
+    assert bob.messages() == [chunk]
+
+
+def test_unshared_nodes(tmp_path):
+    shared, local = str(tmp_path / "shared"), str(tmp_path / "local")
+    mark_node(shared, "a")
+    mark_node(shared, "b")
+    mark_node(local, "c")
+    assert unshared_nodes(shared, ["a", "b"]) == []
+    assert unshared_nodes(local, ["a", "b"]) == ["a", "b"]
+
+
+def test_node_without_the_shared_blob_dir_exits(directory, tmp_path, monkeypatch):
+    exits = []
+    monkeypatch.setattr(cluster.os, "_exit", exits.append)
+    start_node(directory, "a", shared_dir=str(tmp_path / "shared"))
+    start_node(directory, "b", shared_dir=str(tmp_path / "shared"))
+    assert exits == []
+    start_node(directory, "c", shared_dir=str(tmp_path / "local"))
+    assert exits == [1]
@@ -0,0 +1,122 @@
+import socket
+import time
+
+import pytest
+
+from services.connection import SlowConsumerError, SocketConnection
+from services.metrics import Metrics
+from utils import FRAMING_LENGTH, StreamDecoder
+
+BIG = b"x" * (4 * 1024 * 1024)  # more than a socketpair holds
+
+
+@pytest.fixture
+def pair():
+    """A SocketConnection and the peer socket that plays its client"""
+    ours, peer = socket.socketpair()
+    conn = SocketConnection(ours)
+    yield conn, peer
+    conn.close()
+    peer.close()
+
+
+def wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def read(peer, size):
+    data = b""
+    while len(data) < size:
+        data += peer.recv(size - len(data))
+    return data
+
+
+def test_send_queues_instead_of_blocking(pair):
+    conn, peer = pair
+    started = time.monotonic()
+    conn.send(BIG)
+    conn.send(b"after")
+    assert time.monotonic() - started < 0.5  # nobody is reading
+    assert conn.congested
+    assert read(peer, len(BIG) + 5) == BIG + b"after"
+    wait_for(lambda: not conn.congested and conn.queued_bytes == 0)
+
+
+def test_queue_over_the_limit_evicts(pair):
+    conn, peer = pair
+    conn.max_queue_bytes = len(BIG)
+    conn.send(BIG)  # an empty queue takes any frame
+    with pytest.raises(SlowConsumerError):
+        conn.send(b"one too many")
+    assert conn.evicted
+    with pytest.raises(ConnectionError):
+        conn.send(b"closed")
+
+
+def test_congested_too_long_evicts(pair):
+    conn, peer = pair
+    conn.slow_consumer_timeout = 0
+    conn.send(BIG)
+    assert conn.congested
+    with pytest.raises(SlowConsumerError):
+        conn.send(b"late")
+
+
+@pytest.mark.parametrize("write_batch, writes", [(256, 2), (4, 4)])
+def test_frames_queued_together_share_a_write(pair, write_batch, writes):
+    conn, peer = pair
+    conn.metrics = Metrics()
+    conn.metrics.counter("chat_socket_writes_total", "")
+    conn.metrics.counter("chat_socket_write_frames_total", "")
+    conn.write_batch = write_batch
+    conn.send(BIG)
+    wait_for(lambda: not conn._queued_frames)  # stuck writing it, alone
+    for i in range(10):
+        conn.send(b"%d" % i)
+    assert read(peer, len(BIG) + 10) == BIG + b"0123456789"
+    wait_for(lambda: conn.queued_bytes == 0)
+    text = conn.metrics.render()
+    assert f"chat_socket_writes_total {writes}" in text
+    assert "chat_socket_write_frames_total 11" in text
+
+
+@pytest.mark.parametrize("nodelay", [True, False])
+def test_nodelay_is_set_on_client_sockets(monkeypatch, nodelay):
+    monkeypatch.setattr(SocketConnection, "nodelay", nodelay)
+    with socket.create_server(("127.0.0.1", 0)) as listener:
+        client = socket.create_connection(listener.getsockname())
+        accepted, _ = listener.accept()
+    conn = SocketConnection(accepted)
+    try:
+        option = accepted.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+        assert bool(option) == nodelay
+    finally:
+        conn.close()
+        client.close()
+
+
+@pytest.mark.parametrize(
+    "lanes, order",
+    [
+        (True, ["RTC_ICE", "MESSAGE", "FILE_CHUNK", "FILE_END"]),
+        (False, ["FILE_CHUNK", "MESSAGE", "FILE_END", "RTC_ICE"]),
+    ],
+)
+def test_signaling_overtakes_bulk_data(pair, lanes, order):
+    conn, peer = pair
+    conn.lanes = lanes
+    conn.set_framing(FRAMING_LENGTH)
+    conn.send(BIG)
+    wait_for(lambda: not conn._queued_frames)
+    for msg_type in ("FILE_CHUNK", "MESSAGE", "FILE_END", "RTC_ICE"):
+        conn.send_message({"type": msg_type})
+    read(peer, len(BIG))
+    decoder = StreamDecoder(FRAMING_LENGTH)
+    messages = []
+    while len(messages) < 4:
+        decoder.feed(peer.recv(65536))
+        messages.extend(decoder)
+    assert [m["type"] for m in messages] == order
@@ -0,0 +1,154 @@
+import base64
+
+import pytest
+
+from conftest import login
+from utils import SERIALIZATION_MSGPACK, framing
+from utils.framing import FLAG_MSGPACK, HEADER
+
+
+def test_message_to_a_local_user(server):
+    alice, state = login(server, "alice")
+    bob, _ = login(server, "bob")
+    msg = {"type": "MESSAGE", "to": "bob", "from": "alice", "message": "hi"}
+    server.handle_message(alice, msg, state)
+    assert bob.messages() == [
+        {"type": "MESSAGE", "from": "Alice", "message": "hi", "from_username": "alice"}
+    ]
+    assert alice.messages() == []
+    assert not alice.closed
+
+
+def test_message_to_nobody(server):
+    alice, state = login(server, "alice")
+    msg = {"type": "MESSAGE", "to": "bob", "from": "alice", "message": "hi"}
+    server.handle_message(alice, msg, state)
+    assert alice.messages() == [{"type": "ERROR", "message": "User bob not online"}]
+
+
+@pytest.mark.parametrize(
+    "msg, relayed",
+    [
+        (
+            {"type": "RTC_OFFER", "sdp": "o"},
+            {"type": "RTC_OFFER", "from": "alice", "from_display": "Alice", "sdp": "o"},
+        ),
+        (
+            {"type": "RTC_ANSWER", "sdp": "a"},
+            {
+                "type": "RTC_ANSWER",
+                "from": "alice",
+                "from_display": "Alice",
+                "sdp": "a",
+            },
+        ),
+        (
+            {"type": "RTC_ICE", "candidate": "c"},
+            {"type": "RTC_ICE", "from": "alice", "candidate": "c"},
+        ),
+        ({"type": "RTC_END"}, {"type": "RTC_END", "from": "alice"}),
+    ],
+)
+def test_rtc_signaling(server, msg, relayed):
+    alice, state = login(server, "alice")
+    bob, _ = login(server, "bob")
+    server.handle_message(alice, {**msg, "to": "bob"}, state)
+    assert bob.messages() == [relayed]
+    server.handle_message(alice, {**msg, "to": "carol"}, state)
+    assert alice.messages() == [{"type": "ERROR", "message": "User carol not online"}]
+
+
+def test_rtc_ice_batch(server):
+    alice, state = login(server, "alice")
+    bob, _ = login(server, "bob", ice="batch")
+    msg = {"type": "RTC_ICE", "to": "bob", "candidate": "c"}
+    server.handle_message(alice, msg, state)
+    assert bob.messages() == [{"type": "RTC_ICE", "from": "alice", "candidates": ["c"]}]
+
+
+def test_chunked_file_transfer_is_relayed_both_ways(server):
+    alice, alice_state = login(server, "alice", files="chunked")
+    bob, bob_state = login(server, "bob", files="chunked")
+    begin = {"type": "FILE_BEGIN", "to": "bob", "transfer_id": "t", "size": 6}
+    server.handle_message(alice, begin, alice_state)
+    assert bob.messages() == [{**begin, "from": "alice"}]
+
+    accept = {"type": "FILE_ACCEPT", "to": "alice", "transfer_id": "t", "offset": 2}
+    server.handle_message(bob, accept, bob_state)
+    assert alice.messages() == [{**accept, "from": "bob"}]
+
+    chunk = {"type": "FILE_CHUNK", "to": "bob", "transfer_id": "t", "data": b"\0abc"}
+    end = {"type": "FILE_END", "to": "bob", "transfer_id": "t"}
+    server.handle_message(alice, chunk, alice_state)
+    server.handle_message(alice, end, alice_state)
+    assert bob.messages() == [{**chunk, "from": "alice"}, {**end, "from": "alice"}]
+    assert alice.messages() == []
+
+
+def test_chunked_file_refusals(server, monkeypatch):
+    monkeypatch.setattr(server, "MAX_FILE_CHUNK", 3)
+    alice, state = login(server, "alice", files="chunked")
+    login(server, "bob")
+    login(server, "carol", files="chunked")
+    msgs = [
+        {"type": "FILE_BEGIN", "to": "bob", "transfer_id": "t"},
+        {"type": "FILE_BEGIN", "to": "dave", "transfer_id": "t"},
+        {"type": "FILE_CHUNK", "to": "carol", "transfer_id": "t", "data": b"abcd"},
+    ]
+    for msg in msgs:
+        server.handle_message(alice, msg, state)
+    assert [m["message"] for m in alice.messages()] == [
+        "User bob cannot receive chunked files",
+        "User dave not online",
+        "File chunk larger than 3 bytes",
+    ]
+
+
+def test_relay_passes_the_body_through_untouched(server):
+    alice, state = login(server, "alice", relay=True)
+    bob, _ = login(server, "bob", relay=True)
+    carol, _ = login(server, "carol")
+    body = b'{"message":  "hi",   "extra": [1, 2]}'  # spacing json.dumps would change
+    for to in ("bob", "carol"):
+        msg = {"type": "MESSAGE", "to": to, "from": "alice", "body": body}
+        server.handle_message(alice, msg, state)
+    [frame] = bob.frames
+    assert frame.endswith(body)
+    assert bob.messages() == [
+        {"type": "MESSAGE", "from": "Alice", "from_username": "alice", "body": body}
+    ]
+    assert carol.messages() == [
+        {
+            "type": "MESSAGE",
+            "from": "Alice",
+            "from_username": "alice",
+            "message": "hi",
+            "extra": [1, 2],
+        }
+    ]
+    offer = {"type": "RTC_OFFER", "to": "dave", "body": b"{}"}
+    server.handle_message(alice, offer, state)
+    assert alice.messages() == [{"type": "ERROR", "message": "User dave not online"}]
+
+
+def test_msgpack_clients_exchange_raw_file_bytes(server):
+    pytest.importorskip("msgpack")
+    alice, state = login(server, "alice", serialization=[SERIALIZATION_MSGPACK])
+    bob, _ = login(server, "bob", serialization=[SERIALIZATION_MSGPACK, "json"])
+    carol, _ = login(server, "carol")
+    assert alice.serialization == bob.serialization == SERIALIZATION_MSGPACK
+    assert carol.serialization == "json"
+    for to in ("bob", "carol"):
+        msg = {"type": "FILE", "to": to, "filename": "a.bin", "data": b"\0\xff"}
+        server.handle_message(alice, msg, state)
+    assert HEADER.unpack_from(bob.frames[0])[1] & FLAG_MSGPACK
+    [to_bob] = bob.messages()
+    [to_carol] = carol.messages()
+    assert to_bob["data"] == b"\0\xff"
+    assert to_carol["data"] == base64.b64encode(b"\0\xff").decode()
+
+
+def test_msgpack_turned_off_falls_back_to_json(server, monkeypatch):
+    monkeypatch.setattr(framing, "SUPPORTED_SERIALIZATIONS", ("json",))
+    alice, _ = login(server, "alice", serialization=[SERIALIZATION_MSGPACK])
+    assert alice.serialization == "json"
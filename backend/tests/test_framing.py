@@ -0,0 +1,156 @@
+import json
+
+import pytest
+
+from services.connection import Connection
+from utils import (
+    FRAMING_JSON,
+    FRAMING_LENGTH,
+    LOGIN_MAX_FRAME_SIZE,
+    MAX_FRAME_SIZE,
+    SERIALIZATION_MSGPACK,
+    FrameError,
+    StreamDecoder,
+    encode_message,
+    encode_relay,
+    expand_relay,
+)
+from utils.framing import COMPRESS_THRESHOLD, FLAG_ZLIB, HEADER
+
+MESSAGE = {"type": "MESSAGE", "from": "alice", "message": "xin chào"}
+
+
+def decode(framing, chunks):
+    decoder = StreamDecoder(framing)
+    messages = []
+    for chunk in chunks:
+        decoder.feed(chunk)
+        messages.extend(decoder)
+    return messages, decoder
+
+
+def bytewise(data):
+    return [data[i : i + 1] for i in range(len(data))]
+
+
+@pytest.mark.parametrize("framing", [FRAMING_JSON, FRAMING_LENGTH])
+def test_messages_split_anywhere(framing):
+    data = encode_message(MESSAGE, framing) * 3
+    messages, decoder = decode(framing, bytewise(data))
+    assert messages == [MESSAGE] * 3
+    assert decoder.buffered() == 0
+    assert decoder.last_size == len(data) // 3
+
+
+def test_json_stream_with_whitespace_between_messages():
+    data = b' {"type": "PING"}\n\n{"type": "PONG"} \n'
+    messages, _ = decode(FRAMING_JSON, [data])
+    assert messages == [{"type": "PING"}, {"type": "PONG"}]
+
+
+def test_mode_switch_reads_what_is_buffered_in_the_new_framing():
+    decoder = StreamDecoder(FRAMING_JSON)
+    decoder.feed(
+        encode_message({"type": "LOGIN_OK"}, FRAMING_JSON)
+        + encode_message(MESSAGE, FRAMING_LENGTH)
+    )
+    messages = iter(decoder)
+    assert next(messages) == {"type": "LOGIN_OK"}
+    decoder.mode = FRAMING_LENGTH
+    assert list(decoder) == [MESSAGE]
+
+
+def test_binary_frame_carries_raw_data():
+    chunk = {"type": "FILE_CHUNK", "transfer_id": "t1", "data": bytes(range(256))}
+    data = encode_message(chunk, FRAMING_LENGTH)
+    messages, _ = decode(FRAMING_LENGTH, bytewise(data))
+    assert messages == [chunk]
+
+
+@pytest.mark.parametrize("codec", [None, "zlib"])
+def test_relay_frame_keeps_the_body_opaque(codec):
+    header = {"type": "MESSAGE", "to": "bob", "from": "alice"}
+    body = json.dumps({"message": "hi " * COMPRESS_THRESHOLD}).encode()
+    [msg], _ = decode(FRAMING_LENGTH, [encode_relay(header, body, codec)])
+    assert msg == {**header, "body": body}
+    assert expand_relay(header, msg["body"]) == {**json.loads(body), **header}
+
+
+def test_compressed_frame():
+    big = {**MESSAGE, "message": "a" * (COMPRESS_THRESHOLD * 4)}
+    data = encode_message(big, FRAMING_LENGTH, codec="zlib")
+    assert HEADER.unpack_from(data)[1] & FLAG_ZLIB
+    assert len(data) < len(encode_message(big, FRAMING_LENGTH))
+    messages, _ = decode(FRAMING_LENGTH, bytewise(data))
+    assert messages == [big]
+
+
+def test_small_frame_is_not_compressed():
+    data = encode_message(MESSAGE, FRAMING_LENGTH, codec="zlib")
+    assert data == encode_message(MESSAGE, FRAMING_LENGTH)
+
+
+def test_msgpack_frame():
+    pytest.importorskip("msgpack")
+    chunk = {"type": "FILE", "filename": "a.bin", "data": b"\x00\x01"}
+    data = encode_message(chunk, FRAMING_LENGTH, serialization=SERIALIZATION_MSGPACK)
+    messages, _ = decode(FRAMING_LENGTH, [data])
+    assert messages == [chunk]
+
+
+def test_oversized_frame_is_refused_from_its_header():
+    decoder = StreamDecoder(FRAMING_LENGTH, max_frame_size=1024)
+    decoder.feed(HEADER.pack(1025, 0))
+    with pytest.raises(FrameError):
+        list(decoder)
+
+
+def test_compressed_frame_may_not_inflate_past_the_limit():
+    big = {**MESSAGE, "message": "a" * (COMPRESS_THRESHOLD * 4)}
+    decoder = StreamDecoder(FRAMING_LENGTH, max_frame_size=COMPRESS_THRESHOLD)
+    decoder.feed(encode_message(big, FRAMING_LENGTH, codec="zlib"))
+    with pytest.raises(FrameError):
+        list(decoder)
+
+
+def test_corrupt_compressed_frame():
+    decoder = StreamDecoder(FRAMING_LENGTH)
+    decoder.feed(HEADER.pack(4, FLAG_ZLIB) + b"junk")
+    with pytest.raises(FrameError):
+        list(decoder)
+
+
+def test_unterminated_json_past_the_limit():
+    decoder = StreamDecoder(FRAMING_JSON, max_frame_size=64)
+    decoder.feed(b'{"type": "MESSAGE", "message": "' + b"a" * 100 + b'}')
+    with pytest.raises(FrameError):
+        list(decoder)
+
+
+@pytest.mark.parametrize("garbage", [b"GET / HTTP/1.1\r\n", b'{"type": x}', b"}{"])
+def test_bad_json_is_refused_without_waiting_for_more(garbage):
+    decoder = StreamDecoder(FRAMING_JSON)
+    decoder.feed(garbage)
+    with pytest.raises(FrameError):
+        list(decoder)
+
+
+def test_json_cut_short_waits_for_the_rest():
+    data = b'{"n": -1.5e+3, "ok": true, "s": "\\u00e9"}'
+    cuts = (0, 9, 11, 23, 36)  # after "1.", "5e", "tr" and "\\u0"
+    chunks = [data[a:b] for a, b in zip(cuts, cuts[1:])]
+    messages, decoder = decode(FRAMING_JSON, chunks)
+    assert messages == []
+    decoder.feed(data[36:])
+    assert list(decoder) == [{"n": -1500.0, "ok": True, "s": "\u00e9"}]
+
+
+def test_frames_are_small_until_login():
+    conn = Connection()
+    assert conn.decoder.max_frame_size == LOGIN_MAX_FRAME_SIZE
+    conn.decoder.feed(b'{"type": "LOGIN", "username": "' + b"a" * LOGIN_MAX_FRAME_SIZE)
+    with pytest.raises(FrameError):
+        list(conn.decoder)
+    conn = Connection()
+    conn.set_framing(FRAMING_LENGTH)
+    assert conn.decoder.max_frame_size == MAX_FRAME_SIZE
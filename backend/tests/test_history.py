@@ -0,0 +1,106 @@
+import sqlite3
+
+from models import HistoryStore, direct_conversation
+from models import history_store
+from models.history_store import ID_SEQ_BITS, ID_TIME_SHIFT
+
+CHAT = direct_conversation("alice", "bob")
+
+
+def frozen_clock(monkeypatch, ms):
+    monkeypatch.setattr(history_store.time, "time", lambda: ms / 1000)
+
+
+def test_ids_grow_within_one_millisecond(tmp_path, monkeypatch):
+    frozen_clock(monkeypatch, 1_000_000)
+    store = HistoryStore(str(tmp_path / "history.db"))
+    ids = [store.append(CHAT, "alice", "Alice", str(i)) for i in range(3)]
+    store.close()
+    assert ids == sorted(ids) and len(set(ids)) == 3
+    assert {i >> ID_TIME_SHIFT for i in ids} == {1_000_000}
+
+
+def test_full_millisecond_borrows_the_next(tmp_path, monkeypatch):
+    frozen_clock(monkeypatch, 1_000_000)
+    store = HistoryStore(str(tmp_path / "history.db"))
+    count = (1 << ID_SEQ_BITS) + 1
+    ids = [store.append(CHAT, "alice", "Alice", "x") for _ in range(count)]
+    store.close()
+    assert ids == sorted(ids)
+    assert ids[-1] >> ID_TIME_SHIFT == 1_000_001
+
+
+def test_ids_keep_growing_after_a_restart_with_the_clock_behind(tmp_path, monkeypatch):
+    path = str(tmp_path / "history.db")
+    frozen_clock(monkeypatch, 2_000_000)
+    store = HistoryStore(path)
+    last = max(store.append(CHAT, "alice", "Alice", "before") for _ in range(3))
+    store.close()
+    frozen_clock(monkeypatch, 1_000_000)
+    store = HistoryStore(path)
+    assert store.append(CHAT, "bob", "Bob", "after") > last
+    store.close()
+
+
+def test_nodes_sharing_a_file_interleave_in_time_order(tmp_path, monkeypatch):
+    path = str(tmp_path / "history.db")
+    a, b = HistoryStore(path, node=1), HistoryStore(path, node=2)
+    sent = []
+    for ms in range(1_000_000, 1_000_005):
+        frozen_clock(monkeypatch, ms)
+        for store, name in ((a, "alice"), (b, "bob")):
+            sent.append(f"{name} {ms}")
+            store.append(CHAT, name, name, sent[-1])
+    a.close()
+    b.close()
+
+    store = HistoryStore(path)
+    messages, _ = store.page(CHAT)
+    store.close()
+    assert [m["message"] for m in messages] == sent
+
+
+def test_pages_walk_back_from_the_newest(tmp_path):
+    store = HistoryStore(str(tmp_path / "history.db"))
+    for i in range(5):
+        store.append(CHAT, "alice", "Alice", str(i))
+    store.append(direct_conversation("alice", "carol"), "carol", "Carol", "elsewhere")
+    store.flush()
+
+    newest, before = store.page(direct_conversation("bob", "alice"), limit=3)
+    older, end = store.page(CHAT, before_id=before, limit=3)
+    store.close()
+    assert [m["message"] for m in newest] == ["2", "3", "4"]
+    assert [m["message"] for m in older] == ["0", "1"]
+    assert end is None
+
+
+def test_locked_database_is_retried_not_fatal(tmp_path, monkeypatch):
+    monkeypatch.setattr(history_store, "WRITE_BUSY_TIMEOUT", 0.01)
+    path = str(tmp_path / "history.db")
+    store = HistoryStore(path)
+    other = sqlite3.connect(path, isolation_level=None)
+    other.execute("BEGIN EXCLUSIVE")
+    store.append(CHAT, "alice", "Alice", "while locked")
+    assert not store.flush(timeout=0.3)
+    other.execute("COMMIT")
+    other.close()
+    assert store.flush(timeout=5)
+    store.append(CHAT, "bob", "Bob", "after")
+    assert store.flush(timeout=5)
+    messages, _ = store.page(CHAT)
+    store.close()
+    assert [m["message"] for m in messages] == ["while locked", "after"]
+
+
+def test_close_gives_up_on_a_batch_that_never_commits(tmp_path, monkeypatch):
+    monkeypatch.setattr(history_store, "WRITE_BUSY_TIMEOUT", 0.01)
+    path = str(tmp_path / "history.db")
+    store = HistoryStore(path)
+    other = sqlite3.connect(path, isolation_level=None)
+    other.execute("BEGIN EXCLUSIVE")
+    store.append(CHAT, "alice", "Alice", "lost")
+    store.close()
+    other.execute("ROLLBACK")
+    other.close()
+    assert store.commits == 0
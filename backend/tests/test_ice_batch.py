@@ -0,0 +1,41 @@
+from conftest import login
+from services.ice_batch import IceBatcher
+
+
+def test_window_coalesces_per_direction_in_order():
+    flushed = []
+    batcher = IceBatcher(lambda *batch: flushed.append(batch), window=3600)
+    batcher.add("alice", "bob", "c1")
+    batcher.add("bob", "alice", "d1")
+    batcher.add("alice", "bob", "c2")
+    assert flushed == []
+    batcher.flush()
+    batcher.flush()  # nothing new
+    assert flushed == [("alice", "bob", ["c1", "c2"]), ("bob", "alice", ["d1"])]
+
+
+def test_no_window_hands_over_each_candidate():
+    flushed = []
+    batcher = IceBatcher(lambda *batch: flushed.append(batch), window=0)
+    batcher.add("alice", "bob", "c1")
+    assert flushed == [("alice", "bob", ["c1"])]
+
+
+def test_batching_clients_get_one_frame_per_window(server, monkeypatch):
+    monkeypatch.setattr(server.ice_batch, "window", 3600)
+    alice, state = login(server, "alice")
+    bob, _ = login(server, "bob", ice="batch")
+    carol, _ = login(server, "carol")
+    for to in ("bob", "carol"):
+        for candidate in ("c1", "c2"):
+            msg = {"type": "RTC_ICE", "to": to, "candidate": candidate}
+            server.handle_message(alice, msg, state)
+    assert bob.messages() == carol.messages() == []
+    server.ice_batch.flush()
+    assert bob.messages() == [
+        {"type": "RTC_ICE", "from": "alice", "candidates": ["c1", "c2"]}
+    ]
+    assert carol.messages() == [
+        {"type": "RTC_ICE", "from": "alice", "candidate": "c1"},
+        {"type": "RTC_ICE", "from": "alice", "candidate": "c2"},
+    ]
@@ -0,0 +1,69 @@
+import pytest
+
+from conftest import RecordingConnection, login
+from models import InboxStore
+from utils import FRAMING_LENGTH
+
+
+@pytest.fixture
+def inbox(server, tmp_path, monkeypatch):
+    store = InboxStore(str(tmp_path / "inbox.db"))
+    monkeypatch.setattr(server, "inbox", store)
+    return store
+
+
+def arrive(server, username, **fields):
+    """Log `username` in; returns the connection, its handler state and the
+    inbox messages it was sent"""
+    conn = RecordingConnection()
+    state = server.new_state()
+    msg = {
+        "type": "LOGIN",
+        "username": username,
+        "display_name": username.title(),
+        "framing": [FRAMING_LENGTH],
+        **fields,
+    }
+    server.handle_message(conn, msg, state)
+    inbox = [m for m in conn.messages() if m["type"] in ("INBOX", "MESSAGE")]
+    return conn, state, inbox
+
+
+def leave_messages(server, texts):
+    alice, state = login(server, "alice")
+    for text in texts:
+        msg = {"type": "MESSAGE", "to": "bob", "from": "alice", "message": text}
+        server.handle_message(alice, msg, state)
+    assert alice.messages() == []  # queued, not "not online"
+
+
+def test_batched_inbox_waits_for_its_ack(server, inbox):
+    inbox.remember("bob")
+    leave_messages(server, ["one", "two"])
+
+    bob, state, [batch] = arrive(server, "bob", inbox="batch")
+    assert [m["message"] for m in batch["messages"]] == ["one", "two"]
+    server.handle_disconnect(bob, state)
+    bob, state, [again] = arrive(server, "bob", inbox="batch")  # never acked
+    assert again["messages"] == batch["messages"]
+
+    server.handle_message(bob, {"type": "INBOX_ACK", "id": again["id"]}, state)
+    assert inbox.drain("bob") == ([], None)
+
+
+def test_old_clients_get_the_original_frames(server, inbox):
+    inbox.remember("bob")
+    leave_messages(server, ["one", "two"])
+    _, _, delivered = arrive(server, "bob")
+    assert [(m["type"], m["message"]) for m in delivered] == [
+        ("MESSAGE", "one"),
+        ("MESSAGE", "two"),
+    ]
+    assert inbox.drain("bob") == ([], None)  # acked once written
+
+
+def test_strangers_are_not_queued_for(server, inbox):
+    alice, state = login(server, "alice")
+    msg = {"type": "MESSAGE", "to": "nobody", "from": "alice", "message": "hi"}
+    server.handle_message(alice, msg, state)
+    assert alice.messages() == [{"type": "ERROR", "message": "User nobody not online"}]
@@ -0,0 +1,66 @@
+import pytest
+
+from conftest import RecordingConnection, login
+from services.timer_wheel import TimerWheel
+
+
+def test_timers_expire_on_their_tick_at_every_level():
+    wheel = TimerWheel(tick=1.0, slots=4, levels=2)
+    delays = {"a": 1, "b": 3, "c": 4, "d": 7, "e": 16, "f": 40}  # f: past the top
+    for key, delay in delays.items():
+        wheel.schedule(key, delay)
+    wheel.schedule("gone", 5)
+    wheel.cancel("gone")
+    expired = {}
+    for now in range(1, 50):
+        for key in wheel.advance(now):
+            expired[key] = now
+    assert expired == delays
+    assert len(wheel) == 0
+
+
+def connect(server, username):
+    """Accepted (and so on the wheel), then logged in with keepalive"""
+    conn = RecordingConnection()
+    server.watch_idle(conn)
+    login(server, username, conn, keepalive=True)
+    return conn
+
+
+@pytest.fixture
+def keepalive(server, monkeypatch):
+    monkeypatch.setattr(server, "idle_wheel", TimerWheel(now=0.0))
+    monkeypatch.setattr(server, "ping_interval", 30.0)
+    monkeypatch.setattr(server, "idle_timeout", 90.0)
+    return server
+
+
+def test_silent_client_is_pinged_then_reaped(keepalive):
+    alice = connect(keepalive, "alice")
+    assert alice.keepalive and alice in keepalive.idle_wheel
+
+    alice.received_at = 100.0
+    keepalive.check_idle(alice, 131.0)
+    assert alice.messages() == [{"type": "PING"}]
+    assert alice in keepalive.idle_wheel and not alice.closed
+
+    keepalive.check_idle(alice, 190.0)
+    assert alice.timed_out and alice.closed
+
+
+def test_traffic_puts_the_ping_off(keepalive):
+    alice = connect(keepalive, "alice")
+    alice.received_at = 120.0
+    keepalive.check_idle(alice, 131.0)
+    assert alice.messages() == []
+    assert alice in keepalive.idle_wheel
+
+
+def test_connection_that_never_logs_in_is_reaped_without_a_ping(keepalive):
+    conn = RecordingConnection()
+    keepalive.watch_idle(conn)
+    conn.received_at = 100.0
+    keepalive.check_idle(conn, 131.0)
+    assert conn.messages() == [] and not conn.closed
+    keepalive.check_idle(conn, 190.0)
+    assert conn.timed_out and conn.closed
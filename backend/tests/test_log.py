@@ -0,0 +1,60 @@
+import io
+import json
+import threading
+
+from services.log import DEBUG, Log
+
+
+def json_log(**kwargs):
+    log = Log(fmt="json", **kwargs)
+    log.stream = io.StringIO()
+    return log
+
+
+def records(log):
+    log.flush()
+    return [json.loads(line) for line in log.stream.getvalue().splitlines()]
+
+
+def test_traffic_is_sampled_per_type_and_cut_short():
+    log = json_log(level=DEBUG, truncate=8)
+    log.sampling = {"RTC_ICE": 3, "FILE_CHUNK": 0}
+    for i in range(7):
+        log.traffic("recv", {"type": "RTC_ICE", "candidate": f"candidate-{i}"})
+        log.traffic("recv", {"type": "FILE_CHUNK", "data": "x"})
+    log.traffic("recv", {"type": "MESSAGE", "message": "hi"})
+    got = [
+        (r["payload"]["type"], r["payload"].get("candidate"), r.get("sampled"))
+        for r in records(log)
+    ]
+    assert got == [
+        ("RTC_ICE", "candidat...(+3)", 3),
+        ("RTC_ICE", "candidat...(+3)", 3),
+        ("RTC_ICE", "candidat...(+3)", 3),
+        ("MESSAGE", None, None),
+    ]
+
+
+def test_traffic_costs_nothing_above_debug():
+    log = json_log()
+    log.traffic("recv", {"type": "MESSAGE"})
+    log.info("joined", user="alice")
+    assert [r["event"] for r in records(log)] == ["joined"]
+
+
+def test_full_queue_drops_instead_of_blocking():
+    release = threading.Event()
+
+    class StuckStream(io.StringIO):
+        def write(self, text):
+            release.wait()
+            return super().write(text)
+
+    log = Log(queue_size=2)
+    log.stream = StuckStream()
+    for i in range(10):
+        log.info("event", n=i)  # returns at once even though nothing is written
+    assert log.dropped >= 7
+    release.set()
+    log.flush()
+    assert len(log.stream.getvalue().splitlines()) == 10 - log.dropped
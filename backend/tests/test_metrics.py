@@ -0,0 +1,68 @@
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from conftest import login
+from services.metrics import Metrics, serve
+
+
+def test_counters_from_every_thread_add_up():
+    metrics = Metrics()
+    metrics.counter("sent_total", "Sent", ("type",))
+    metrics.inc("sent_total", ("MESSAGE",))
+    worker = threading.Thread(target=metrics.inc, args=("sent_total", ("MESSAGE",), 2))
+    worker.start()
+    worker.join()
+    metrics.inc("sent_total", ('say "hi"\n',))
+    assert metrics.render() == (
+        "# HELP sent_total Sent\n"
+        "# TYPE sent_total counter\n"
+        'sent_total{type="MESSAGE"} 3\n'
+        'sent_total{type="say \\"hi\\"\\n"} 1\n'
+    )
+
+
+def test_histogram_buckets_are_cumulative():
+    metrics = Metrics()
+    metrics.histogram("latency_seconds", "Latency", buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.7, 3.0):
+        metrics.observe("latency_seconds", (), value)
+    lines = metrics.render().splitlines()[2:]
+    assert lines == [
+        'latency_seconds_bucket{le="0.1"} 1',
+        'latency_seconds_bucket{le="1.0"} 3',
+        'latency_seconds_bucket{le="+Inf"} 4',
+        "latency_seconds_sum 4.25",
+        "latency_seconds_count 4",
+    ]
+
+
+def test_served_over_http():
+    metrics = Metrics()
+    queued = [5]
+    metrics.gauge("queue_bytes", "Queued", lambda: {(): queued[0]})
+    server = serve(metrics, "127.0.0.1", 0)
+    url = f"http://127.0.0.1:{server.server_address[1]}/"
+    try:
+        queued[0] = 7  # read at scrape time
+        with urllib.request.urlopen(url + "metrics") as response:
+            assert response.read().decode().endswith("queue_bytes 7\n")
+        with pytest.raises(urllib.error.HTTPError):
+            urllib.request.urlopen(url + "other")
+    finally:
+        server.shutdown()
+
+
+def test_handlers_count_each_message_type(server, monkeypatch):
+    monkeypatch.setattr(server, "metrics", Metrics())
+    server.metrics.counter("chat_messages_received_total", "", ("type",))
+    server.metrics.counter("chat_received_bytes_total", "", ("type",))
+    server.metrics.histogram("chat_relay_latency_seconds", "", ("type",))
+    alice, state = login(server, "alice")
+    server.handle_message(alice, {"type": "GET_USERS"}, state)
+    server.handle_message(alice, {"type": "NO_SUCH_TYPE"}, state)
+    text = server.metrics.render()
+    for msg_type in ("LOGIN", "GET_USERS", "other"):
+        assert f'chat_messages_received_total{{type="{msg_type}"}} 1' in text
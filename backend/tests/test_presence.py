@@ -0,0 +1,81 @@
+from conftest import RecordingConnection, login
+from services.presence import Presence, Subscriptions
+from utils import FRAMING_JSON
+
+
+def subscriber(server, username):
+    conn = RecordingConnection()
+    conn.presence_deltas = conn.presence_subscribed = True
+    server.clients[username] = {"conn": conn, "display_name": username}
+    return conn
+
+
+def test_fill_takes_online_users_then_newcomers():
+    subscriptions = Subscriptions()
+    assert subscriptions.fill("carol", 2, ["alice", "carol"]) == ["alice"]
+    assert subscriptions.newcomer("bob") == {"carol"}
+    assert subscriptions.newcomer("dave") == set()  # full
+    subscriptions.gone("alice")
+    assert subscriptions.watched("carol")[0] == {"bob"}
+    assert subscriptions.newcomer("dave") == {"carol"}
+
+
+def test_fill_keeps_what_was_asked_for():
+    subscriptions = Subscriptions()
+    subscriptions.fill("carol", 2, ["alice"])
+    subscriptions.subscribe("carol", ["alice"])  # a contact now
+    subscriptions.gone("alice")
+    assert subscriptions.watched("carol")[0] == {"alice"}
+
+
+def test_subscriber_hears_about_newcomers(server, monkeypatch):
+    monkeypatch.setattr(server, "subscriptions", Subscriptions())
+    carol = subscriber(server, "carol")
+    server.subscriptions.fill("carol", 200, [])  # nobody online at login
+
+    server.flush_presence(1, {"dave": "Dave"}, set(), {}, set())
+    [delta] = carol.messages()
+    assert delta["joined"] == [{"username": "dave", "display_name": "Dave"}]
+
+    server.flush_presence(2, {}, {"dave"}, {}, set())
+    [delta] = carol.messages()
+    assert delta["left"] == ["dave"]
+    assert server.subscriptions.watched("carol")[0] == set()
+
+
+def test_window_coalesces_changes_into_one_version():
+    flushed = []
+    presence = Presence(lambda *delta: flushed.append(delta), 3600)
+    presence.user_joined("alice", "Alice")
+    presence.user_joined("bob", "Bob")
+    presence.user_left("bob", timed_out=True)
+    presence.flush()
+    presence.flush()  # nothing new: no version
+    assert flushed == [(1, {"alice": "Alice"}, {"bob"}, {}, {"bob"})]
+    assert presence.version == 1
+
+
+def test_delta_clients_get_deltas_and_old_clients_the_list(server):
+    alice, state = login(server, "alice", presence="delta")
+    old, _ = login(server, "old", RecordingConnection(FRAMING_JSON), framing=None)
+    server.presence.flush()
+    alice.messages(), old.messages()
+
+    login(server, "bob")
+    login(server, "carol")
+    server.presence.flush()
+    [delta] = alice.messages()
+    assert delta["type"] == "PRESENCE_DELTA" and delta["left"] == []
+    assert [u["username"] for u in delta["joined"]] == ["bob", "carol"]
+    [users] = old.messages()
+    assert users["type"] == "USERS"
+    assert [u["username"] for u in users["users"]] == ["alice", "bob", "carol"]
+
+    version = delta["version"]
+    server.handle_message(alice, {"type": "GET_PRESENCE", "version": version}, state)
+    assert alice.messages() == [
+        {"type": "PRESENCE_SNAPSHOT", "version": version, "unchanged": True}
+    ]
+    server.handle_message(alice, {"type": "GET_PRESENCE", "version": 0}, state)
+    [snapshot] = alice.messages()
+    assert [u["username"] for u in snapshot["users"]] == ["old", "bob", "carol"]
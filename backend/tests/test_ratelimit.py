@@ -0,0 +1,41 @@
+import sys
+
+import pytest
+
+import main
+from services.ratelimit import RateLimited, RateLimiter
+
+
+def make_limiter():
+    return RateLimiter({"*": (1, 2)}, byte_rate=1000, byte_burst=1000, max_delay=0)
+
+
+def test_burst_then_refused():
+    limiter = make_limiter()
+    assert limiter.charge("alice", "MESSAGE", 10, 0.0) == 0
+    assert limiter.charge("alice", "MESSAGE", 10, 0.0) == 0
+    with pytest.raises(RateLimited) as e:
+        limiter.charge("alice", "MESSAGE", 10, 0.0)
+    assert e.value.retry_after == pytest.approx(1.0)
+
+
+def test_sweep_keeps_buckets_until_they_refill():
+    limiter = make_limiter()
+    limiter.charge("alice", "MESSAGE", 10, 0.0)
+    limiter.charge("alice", "MESSAGE", 10, 0.0)
+    # alice logs out and straight back in: her bucket is still empty
+    assert limiter.sweep(0.5) == 0
+    with pytest.raises(RateLimited):
+        limiter.charge("alice", "MESSAGE", 10, 0.5)
+    # two seconds on, a new bucket would be no different
+    assert limiter.sweep(2.5) == 1
+    assert limiter.charge("alice", "MESSAGE", 10, 2.5) == 0
+
+
+@pytest.mark.parametrize(
+    "argv, limits",
+    [([], None), (["--rate-limit"], []), (["--rate-limit", "FILE=1/2"], ["FILE=1/2"])],
+)
+def test_rate_limits_are_opt_in(monkeypatch, argv, limits):
+    monkeypatch.setattr(sys, "argv", ["main.py", *argv])
+    assert main.parse_args().rate_limit == limits
@@ -0,0 +1,84 @@
+from conftest import RecordingConnection
+from models import InboxStore
+from services.connection import LANE_CHAT
+from services.session import Session
+from utils import FRAMING_LENGTH
+
+SETTINGS = (FRAMING_LENGTH,)
+
+
+def attached(session):
+    conn = RecordingConnection()
+    session.attach(conn)
+    return conn
+
+
+def test_frames_are_numbered_as_written():
+    session = Session("bob", SETTINGS)
+    attached(session)
+    for frame in (b"1", b"2", b"3"):
+        session.send(frame, LANE_CHAT)
+    assert session.seq == 3
+
+
+def test_resume_replays_what_was_not_acked():
+    session = Session("bob", SETTINGS)
+    first = attached(session)
+    for frame in (b"1", b"2", b"3"):
+        session.send(frame, LANE_CHAT)
+    session.ack(1)
+    session.detach(first)
+    session.send(b"4", LANE_CHAT)  # kept while nobody is attached
+
+    second = RecordingConnection()
+    assert session.attach(second, after=1)
+    assert second.frames == [b"2", b"3", b"4"]
+    session.send(b"5", LANE_CHAT)
+    assert second.frames[-1] == b"5"
+    assert session.seq == 5
+
+
+def test_resume_refused_once_the_gap_was_dropped():
+    session = Session("bob", SETTINGS, max_frames=2)
+    first = attached(session)
+    for frame in (b"1", b"2", b"3"):
+        session.send(frame, LANE_CHAT)
+    session.detach(first)
+    assert not session.attach(RecordingConnection(), after=0)
+    assert session.attach(RecordingConnection(), after=1)
+
+
+def test_expire_hands_back_the_unacked_frames():
+    session = Session("bob", SETTINGS)
+    first = attached(session)
+    assert session.expire() is None  # still attached
+    for frame in (b"1", b"2", b"3"):
+        session.send(frame, LANE_CHAT)
+    session.ack(1)
+    session.detach(first)
+    assert session.expire() == [b"2", b"3"]
+    assert session.closed
+    assert not session.attach(RecordingConnection(), after=1)
+
+
+def test_expired_session_goes_to_the_inbox(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "inbox", InboxStore(str(tmp_path / "inbox.db")))
+    server.inbox.remember("bob")
+    session = Session("bob", SETTINGS)
+    bob = attached(session)
+    server.clients["bob"] = {"conn": bob, "display_name": "bob"}
+    server.sessions["bob"] = session
+
+    message = {"type": "MESSAGE", "from": "alice", "message": "hi"}
+    server.send_to_client("bob", message)
+    server.send_to_client("bob", {"type": "PRESENCE_DELTA", "joined": []})
+    bob.relay = True
+    bob.send_relay({"type": "MESSAGE", "from": "carol"}, b'{"message": "yo"}')
+    session.detach(bob)
+    server.expire_session(session, bob)
+
+    assert "bob" not in server.clients
+    assert server.inbox.drain("bob")[0] == [
+        message,
+        {"type": "MESSAGE", "from": "carol", "message": "yo"},
+    ]
@@ -0,0 +1,78 @@
+import os
+import queue
+import threading
+import time
+import zlib
+
+from conftest import RecordingConnection
+from models import InboxStore
+from services.workers import BusHub, WorkerBus
+
+
+def start_hub(tmp_path):
+    path = os.path.join(tmp_path, "bus.sock")
+    hub = BusHub(path)
+    threading.Thread(target=hub.serve_forever, daemon=True).start()
+    return hub, path
+
+
+def wait_for(condition):
+    deadline = time.monotonic() + 5
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def next_op(ops, kind):
+    while True:
+        op = ops.get(timeout=5)
+        if op["op"] == kind:
+            return op
+
+
+def test_file_chunk_crosses_workers(server, tmp_path, monkeypatch):
+    hub, path = start_hub(tmp_path)
+    ops = queue.Queue()
+    # worker 1 has bob; this process plays worker 0, where alice is
+    other = WorkerBus(path, 1, ops.put)
+    other.publish({"op": "join", "username": "bob", "entry": {"display_name": "bob"}})
+    wait_for(lambda: "bob" in hub.users)
+    monkeypatch.setattr(server, "bus", WorkerBus(path, 0, lambda op: None))
+    server.remote_users["bob"] = {"display_name": "bob", "file_chunks": True}
+
+    data = bytes(range(256)) * 16
+    chunk = {
+        "type": "FILE_CHUNK",
+        "transfer_id": "t1",
+        "from": "alice",
+        "offset": 0,
+        "crc32": zlib.crc32(data),
+        "data": data,
+    }
+    assert server.send_to_client("bob", chunk)
+
+    # what worker 1 does with the op the hub routed to it
+    op = next_op(ops, "deliver")
+    assert op["to"] == ["bob"]
+    del server.remote_users["bob"]
+    bob = RecordingConnection()
+    server.clients["bob"] = {"conn": bob, "display_name": "bob"}
+    server.on_bus_op(op)
+    assert bob.messages() == [chunk]
+
+
+def test_deliver_to_a_user_who_left_goes_to_the_inbox(server, tmp_path, monkeypatch):
+    _, path = start_hub(tmp_path)
+    ops = queue.Queue()
+    monkeypatch.setattr(server, "bus", WorkerBus(path, 0, ops.put))
+    monkeypatch.setattr(server, "inbox", InboxStore(str(tmp_path / "inbox.db")))
+    # bob was on another worker, which the hub has heard leave
+    server.inbox.remember("bob")
+    server.remote_users["bob"] = {"display_name": "bob"}
+
+    payload = {"type": "MESSAGE", "from": "alice", "message": "hi"}
+    assert server.send_to_client("bob", payload)
+    op = next_op(ops, "undelivered")
+    assert op["to"] == ["bob"]
+    server.on_bus_op(op)
+    assert server.inbox.drain("bob")[0] == [payload]
@@ -49,8 +49,8 @@ class ChatBubble(QWidget):
             btn.setFixedSize(24, 24)
             btn.setStyleSheet("border:none;")
 
-            if self.is_sender and local_path:
-                # Button to open sender's file
+            if local_path:
+                # Button to open a file already on disk
                 btn.setText("📂")
                 btn.clicked.connect(self.open_local_file)
             else:
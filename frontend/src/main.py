@@ -52,6 +52,7 @@ class ChatAppRTC(QWidget):
         self.main_window.chat_panel.area_message.file_selected.connect(self.send_file)
         # When file is received
         self.client.fileReceived.connect(self.on_file_received)
+        self.client.fileSaved.connect(self.on_file_saved)
 
         # WebRTC incoming offer (only if available)
         if WEBRTC_AVAILABLE:
@@ -135,6 +136,12 @@ class ChatAppRTC(QWidget):
             sender, filename, file_data=data, is_sender=False
         )
 
+    def on_file_saved(self, sender: str, filename: str, path: str):
+        # Large files arrive in chunks and are already on disk
+        self.main_window.chat_panel.area_message.append_message(
+            sender, filename, local_path=path, is_sender=False
+        )
+
     # ========== WebRTC ==========
     def _show_webrtc_unavailable(self):
         """Show message when WebRTC is not available"""
@@ -216,5 +223,6 @@ if __name__ == "__main__":
             lambda msg: QMessageBox.critical(None, "Lỗi kết nối", f"{msg}")
         )
         main_window = ChatAppRTC(client)
+        app.aboutToQuit.connect(client.logout)
 
     sys.exit(app.exec())
@@ -2,12 +2,42 @@ import socket
 import threading
 import json
 import base64
+import shutil
+import time
+import zlib
 from pathlib import Path
 from PySide6.QtCore import QObject, Signal
 
 decoder = json.JSONDecoder()
 
-from utils.parse import ParseStream
+from utils.parse import (
+    FRAMING_JSON,
+    FRAMING_LENGTH,
+    LANE_BULK,
+    SERIALIZATION_JSON,
+    SERIALIZATION_MSGPACK,
+    SUPPORTED_CODECS,
+    SUPPORTED_FRAMINGS,
+    SUPPORTED_SERIALIZATIONS,
+    StreamDecoder,
+    encode_message,
+    lane_for,
+)
+from services.file_transfer import (
+    CHUNK_SIZE,
+    SMALL_FILE_LIMIT,
+    BlobDownload,
+    IncomingTransfer,
+    OutgoingTransfer,
+    file_sha256,
+    transfer_id_for,
+    unique_path,
+)
+
+DOWNLOAD_DIR = Path.home() / "Downloads" / "ChatAppRTC"
+ACK_EVERY = 64  # frames between ACKs that let the server trim its replay ring
+RECONNECT_ATTEMPTS = 5
+ROSTER_PAGE = 200  # online users listed (and watched) with interest-based presence
 
 
 class ChatClient(QObject):
@@ -17,13 +47,19 @@ class ChatClient(QObject):
     loginSuccess = Signal()
     connectionFailed = Signal(str)
     fileReceived = Signal(str, str, bytes)
+    # chunked transfers
+    fileProgress = Signal(str, str, int, int)  # peer, filename, done, total
+    fileSaved = Signal(str, str, str)  # from_username, filename, path
+    fileTransferFailed = Signal(str, str, str)  # peer, filename, error
+    # conversation, messages (oldest first), before_id for the older page
+    historyReceived = Signal(str, list, object)
     # WebRTC signaling
     rtcOfferReceived = Signal(str, str)  # from_username, sdp
     rtcAnswerReceived = Signal(str, str)  # from_username, sdp
     rtcIceReceived = Signal(str, dict)  # from_username, candidate
     rtcEndReceived = Signal(str)  # from_username
 
-    def __init__(self, username, display_name):
+    def __init__(self, username, display_name, download_dir=DOWNLOAD_DIR):
         super().__init__()
         self.username = username
         self.display_name = display_name
@@ -31,9 +67,53 @@ class ChatClient(QObject):
         self._cached_users = None  # temporarily store user list if emitted before
         self.client = None  # not create socket yet
         self._listening_thread = None
-
-    def connect_to_server(self, host: str, port: int = 4105, timeout: float = 3.0):
-        """Connect socket with timeout"""
+        # wire format: legacy JSON until LOGIN_OK says otherwise
+        self.framing = FRAMING_JSON
+        self._decoder = StreamDecoder()
+        # GUI, WebRTC and file threads all send; whole frames, one at a time,
+        # signaling and chat ahead of bulk chunks that are waiting too
+        self._send_cond = threading.Condition()
+        self._sending = False
+        self._waiting = [0] * (LANE_BULK + 1)  # senders waiting, per lane
+        # presence: roster kept up to date from PRESENCE_DELTA frames, for
+        # the users and groups we subscribed to (all of them on old servers)
+        self._presence_deltas = False
+        self._presence_subscribed = False
+        self._watching = set()  # users subscribed to since LOGIN_OK
+        self._presence_version = None
+        self._roster = {}  # username -> user/group entry
+        # chunked file transfers, by transfer_id
+        self._file_chunks = False
+        self.download_dir = Path(download_dir)
+        self._outgoing = {}
+        self._incoming = {}
+        # server blob store, by sha256
+        self._blobs = False
+        self._uploads = {}
+        self._downloads = {}
+        # MESSAGE, FILE and RTC_* as routing header + opaque body
+        self._relay = False
+        self._compression = None  # codec the server picked, if any
+        self._serialization = SERIALIZATION_JSON  # MessagePack if both have it
+        # session resumption: frames after LOGIN_OK are numbered by counting
+        self._host = None
+        self._port = None
+        self._resume_token = None
+        self._seq = 0  # frames received since LOGIN_OK
+        self._counting = False
+        self._logged_out = False
+
+    def connect_to_server(
+        self, host: str, port: int = 4105, timeout: float = 3.0, report=True
+    ):
+        """Connect socket with timeout; `report` emits connectionFailed"""
+        self._host, self._port = host, port
+        # a new connection starts in the legacy format until LOGIN_OK
+        self.framing = FRAMING_JSON
+        self._decoder = StreamDecoder()
+        self._compression = None
+        self._serialization = SERIALIZATION_JSON
+        self._counting = False
         self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         # set short timeout
         self.client.settimeout(timeout)
@@ -41,21 +121,39 @@ class ChatClient(QObject):
         try:
             self.client.connect((host, port))
         except Exception as e:
-            self.connectionFailed.emit(str(e))
+            if report:
+                self.connectionFailed.emit(str(e))
             return False
 
         self.client.settimeout(None)  # transfer to blocking mode
 
         # send login
-        login_payload = json.dumps({
+        login_payload = {
             "type": "LOGIN",
             "username": self.username,
             "display_name": self.display_name,
-        })
+            "framing": list(SUPPORTED_FRAMINGS),
+            "presence": "subscribe",
+            "files": "chunked",
+            "blobs": True,
+            "inbox": "batch",
+            "relay": True,
+            "ice": "batch",
+            "keepalive": True,
+            "compression": list(SUPPORTED_CODECS),
+            "serialization": list(SUPPORTED_SERIALIZATIONS),
+            # pick up where a dropped connection left off, if we can
+            "resume": (
+                {"token": self._resume_token, "seq": self._seq}
+                if self._resume_token
+                else True
+            ),
+        }
         try:
-            self.client.sendall(login_payload.encode())
+            self._send(login_payload)
         except Exception as e:
-            self.connectionFailed.emit(str(e))
+            if report:
+                self.connectionFailed.emit(str(e))
             return False
 
         # start listening thread
@@ -64,97 +162,626 @@ class ChatClient(QObject):
         return True
 
 
+    def _send(self, payload: dict):
+        data = encode_message(
+            payload, self.framing, self._compression, self._serialization
+        )
+        lane = lane_for(payload.get("type"))
+        with self._send_cond:
+            self._waiting[lane] += 1
+            while self._sending or any(self._waiting[:lane]):
+                self._send_cond.wait()
+            self._waiting[lane] -= 1
+            self._sending = True
+        try:
+            self.client.sendall(data)
+        finally:
+            with self._send_cond:
+                self._sending = False
+                self._send_cond.notify_all()
+
+    def _send_relayed(self, header: dict, fields: dict):
+        """Send header + fields; the server only parses the header if it can"""
+        if self._relay and self.framing == FRAMING_LENGTH:
+            self._send({**header, "body": json.dumps(fields).encode()})
+        else:
+            self._send({**header, **fields})
+
     def listen_server(self):
-        buffer = ""
         while True:
             try:
-                data = self.client.recv(4096).decode()
+                data = self.client.recv(65536)
                 if not data:
                     break
 
-                buffer += data
-                new_buffer = ""
-                for payload in ParseStream(buffer):
-                    if payload["type"] == "LOGIN_OK":
-                        # login thành công
-                        if not self._gui_ready:
-                            self.loginSuccess.emit()  # GUI connect signals
-                        # gửi yêu cầu users sau GUI connect
-                        self.request_users()
-
-                    elif payload["type"] == "USERS":
-                        users = payload.get("users", [])
-                        if self._gui_ready:
-                            self.usersUpdated.emit(users)
-                        else:
-                            # lưu tạm
-                            self._cached_users = users
-
-                    elif payload["type"] in ("MESSAGE", "BROADCAST"):
-                        from_username = payload.get("from_username", None)
-                        self.messageReceived.emit(payload["from"], payload["message"], from_username)
-
-                    elif payload["type"] == "FILE":
-                        # nhận file
-                        import base64
-
-                        raw_bytes = base64.b64decode(payload["data"])
-                        self.fileReceived.emit(
-                            payload["from"], payload["filename"], raw_bytes
-                        )
-
-                    elif payload["type"] == "GROUP_MESSAGE":
-                        from_user = payload["from"]
-                        group_name = payload["group_name"]
-                        message = payload["message"]
-                        self.groupMessageReceived.emit(group_name, from_user, message)
-
-                    # WebRTC signaling messages from server
-                    elif payload["type"] == "RTC_OFFER":
-                        self.rtcOfferReceived.emit(payload["from"], payload["sdp"])
-                    elif payload["type"] == "RTC_ANSWER":
-                        self.rtcAnswerReceived.emit(payload["from"], payload["sdp"])
-                    elif payload["type"] == "RTC_ICE":
-                        self.rtcIceReceived.emit(
-                            payload["from"], payload.get("candidate")
-                        )
-                    elif payload["type"] == "RTC_END":
-                        self.rtcEndReceived.emit(payload["from"])
-
-                buffer = new_buffer
-
+                # parse every complete message; partial ones stay buffered
+                self._decoder.feed(data)
+                for payload in self._decoder:
+                    counted = self._counting
+                    self._handle_payload(payload)
+                    if counted:
+                        self._seq += 1
+                        if self._seq % ACK_EVERY == 0:
+                            self._send({"type": "ACK", "seq": self._seq})
             except Exception as e:
                 print("Connection closed", e)
                 break
+        if self._resume_token and not self._logged_out:
+            self._reconnect()
+
+    def _reconnect(self):
+        """Resume the session on a new connection, backing off between tries"""
+        for attempt in range(RECONNECT_ATTEMPTS):
+            time.sleep(min(8.0, 0.5 * 2**attempt))
+            if self._logged_out:
+                return
+            self.client.close()
+            if self.connect_to_server(self._host, self._port, report=False):
+                return
+        self.connectionFailed.emit("connection lost")
+
+    def logout(self):
+        """Leave for good, so the server does not hold the session open"""
+        self._logged_out = True
+        if self.client is None:
+            return
+        try:
+            self._send({"type": "LOGOUT"})
+        except OSError:
+            pass
+        self.client.close()
+
+    def _handle_payload(self, payload):
+        if payload["type"] == "LOGIN_OK":
+            # server answers in the old framing, switch now
+            framing = payload.get("framing", FRAMING_JSON)
+            self.framing = framing
+            self._decoder.mode = framing
+            self._presence_deltas = payload.get("presence") in ("delta", "subscribe")
+            self._presence_subscribed = payload.get("presence") == "subscribe"
+            self._file_chunks = payload.get("files") == "chunked"
+            self._blobs = bool(payload.get("blobs"))
+            self._relay = bool(payload.get("relay"))
+            self._compression = payload.get("compression")
+            self._serialization = payload.get("serialization", SERIALIZATION_JSON)
+            self._resume_token = payload.get("resume_token")
+            self._counting = self._resume_token is not None
+            if payload.get("resumed"):
+                # only the frames we missed follow: roster and GUI are current
+                return
+            self._seq = 0
+            self._watching = set()  # a new login subscribes afresh
+            # login thành công
+            if not self._gui_ready:
+                self.loginSuccess.emit()  # GUI connect signals
+            # gửi yêu cầu users sau GUI connect
+            self.request_users()
+
+        elif payload["type"] == "PING":
+            # keepalive: a client that stays silent too long is dropped
+            self._send({"type": "PONG"})
+
+        elif payload["type"] == "INBOX":
+            # everything sent to us while we were offline, in order
+            for queued in payload.get("messages", []):
+                self._handle_payload(queued)
+            if "id" in payload:
+                # only now may the server drop them
+                self._send({"type": "INBOX_ACK", "id": payload["id"]})
+
+        elif payload["type"] == "USERS":
+            if self._presence_subscribed and "total" in payload:
+                # a page of the list: watch these rows, the answer fills them in
+                self.subscribe_presence(
+                    users=[u["username"] for u in payload.get("users", [])]
+                )
+            else:
+                self._emit_users(payload.get("users", []))
+
+        elif payload["type"] == "PRESENCE_SNAPSHOT":
+            self._presence_version = payload["version"]
+            if payload.get("partial"):
+                # presence of what we just subscribed to
+                self._merge_roster(payload.get("users", []))
+            elif not payload.get("unchanged"):
+                self._roster = {
+                    u["username"]: u
+                    for u in payload.get("users", [])
+                    if u["username"] != self.username
+                }
+                self._emit_users(list(self._roster.values()))
+                self._subscribe_groups(payload.get("users", []))
+
+        elif payload["type"] == "PRESENCE_DELTA":
+            self._apply_presence_delta(payload)
+
+        elif payload["type"] in ("MESSAGE", "BROADCAST"):
+            from_username = payload.get("from_username", None)
+            if from_username and from_username not in self._watching:
+                self.subscribe_presence(users=[from_username])  # a new contact
+            self.messageReceived.emit(payload["from"], payload["message"], from_username)
+
+        elif payload["type"] == "FILE":
+            # nhận file: raw bytes over MessagePack, base64 otherwise
+            raw_bytes = payload["data"]
+            if isinstance(raw_bytes, str):
+                raw_bytes = base64.b64decode(raw_bytes)
+            self.fileReceived.emit(
+                payload["from"], payload["filename"], raw_bytes
+            )
+
+        elif payload["type"] == "FILE_REF":
+            self._start_blob_download(payload)
+
+        elif payload["type"].startswith("FILE_"):
+            try:
+                self._handle_file_transfer(payload)
+            except (KeyError, TypeError, ValueError, OSError) as e:
+                # a malformed FILE_* from a peer ends that transfer, not us
+                self._reject_transfer(payload, str(e))
+
+        elif payload["type"].startswith("BLOB_"):
+            self._handle_blob(payload)
+
+        elif payload["type"] == "ERROR" and payload.get("transfer_id"):
+            transfer = self._outgoing.get(payload["transfer_id"])
+            if transfer:
+                transfer.finish(payload.get("message"))
+
+        elif payload["type"] == "ERROR" and payload.get("sha256"):
+            self._blob_failed(payload["sha256"], payload.get("message"))
+
+        elif payload["type"] == "HISTORY_PAGE":
+            self.historyReceived.emit(
+                payload["conversation"],
+                payload.get("messages", []),
+                payload.get("before_id"),
+            )
+
+        elif payload["type"] == "GROUP_MESSAGE":
+            from_user = payload["from"]
+            group_name = payload["group_name"]
+            message = payload["message"]
+            self.groupMessageReceived.emit(group_name, from_user, message)
+
+        # WebRTC signaling messages from server
+        elif payload["type"] == "RTC_OFFER":
+            self.rtcOfferReceived.emit(payload["from"], payload["sdp"])
+        elif payload["type"] == "RTC_ANSWER":
+            self.rtcAnswerReceived.emit(payload["from"], payload["sdp"])
+        elif payload["type"] == "RTC_ICE":
+            # the server batches candidates trickled within a few ms
+            candidates = payload.get("candidates")
+            if candidates is None:
+                candidates = [payload.get("candidate")]
+            for candidate in candidates:
+                self.rtcIceReceived.emit(payload["from"], candidate)
+        elif payload["type"] == "RTC_END":
+            self.rtcEndReceived.emit(payload["from"])
+
+    def _emit_users(self, users):
+        if self._gui_ready:
+            self.usersUpdated.emit(users)
+        else:
+            # lưu tạm
+            self._cached_users = users
+
+    def _merge_roster(self, users):
+        for user in users:
+            if user["username"] != self.username:
+                self._roster[user["username"]] = user
+        self._emit_users(list(self._roster.values()))
+
+    def _subscribe_groups(self, entries):
+        group_names = [e["username"] for e in entries if e.get("type") == "group"]
+        if group_names:
+            self.subscribe_presence(groups=group_names)
+
+    def _apply_presence_delta(self, delta):
+        if self._presence_version is None:
+            return  # snapshot still on its way and will include this
+        if self._presence_subscribed:
+            # only windows with news for us come, so versions skip; each
+            # delta is the latest state of its users and applies as is
+            self._presence_version = delta["version"]
+            for username in delta.get("left", []):
+                self._roster.pop(username, None)
+            self._merge_roster(delta.get("joined", []) + delta.get("groups", []))
+            self._subscribe_groups(delta.get("groups", []))
+            return
+        if delta["version"] != self._presence_version + 1:
+            # missed a window: ask for a fresh roster, ignore deltas till then
+            self.request_users()
+            self._presence_version = None
+            return
+        self._presence_version = delta["version"]
+        for username in delta.get("left", []):
+            self._roster.pop(username, None)
+        for user in delta.get("joined", []) + delta.get("groups", []):
+            if user["username"] != self.username:
+                self._roster[user["username"]] = user
+        self._emit_users(list(self._roster.values()))
 
     def request_users(self):
-        get_users_payload = json.dumps({"type": "GET_USERS"})
-        self.client.sendall(get_users_payload.encode())
+        if self._presence_subscribed:
+            # our groups and whoever we watch, then the rows of the list:
+            # who is online now, and newcomers while rows are free
+            self._send({"type": "GET_PRESENCE"})
+            self.subscribe_presence(fill=ROSTER_PAGE)
+        elif self._presence_deltas:
+            self._send({"type": "GET_PRESENCE", "version": self._presence_version})
+        else:
+            self._send({"type": "GET_USERS"})
+
+    def subscribe_presence(self, users=(), groups=(), fill=None):
+        """Hear about these users and the members of these groups; with
+        `fill`, also about enough online users to list that many"""
+        if self._presence_subscribed and (users or groups or fill is not None):
+            self._watching.update(users)
+            subscribe = {
+                "type": "PRESENCE_SUBSCRIBE",
+                "users": list(users),
+                "groups": list(groups),
+            }
+            if fill is not None:
+                subscribe["fill"] = fill
+            self._send(subscribe)
 
     def send_message(self, to, msg):
-        payload = json.dumps(
-            {"type": "MESSAGE", "to": to, "from": self.username, "message": msg}
+        header = {"type": "MESSAGE", "to": to, "from": self.username}
+        self._send_relayed(header, {"message": msg})
+
+    def request_history(self, conversation, before_id=None, limit=50):
+        """Ask for a page of "user:<name>" or "group:<name>" history.
+
+        The first page is the newest; pass the before_id of a page to get
+        the one before it.
+        """
+        self._send(
+            {
+                "type": "HISTORY",
+                "conversation": conversation,
+                "before_id": before_id,
+                "limit": limit,
+            }
         )
-        self.client.sendall(payload.encode())
 
     def send_file(self, to: str, file_path: str):
         """Gửi file cho user"""
         path = Path(file_path)
         if not path.exists():
             return
+        if path.stat().st_size > SMALL_FILE_LIMIT:
+            # stored once on the server, or streamed to the peer
+            if self._blobs:
+                target = self._upload_blob
+            elif self._file_chunks:
+                target = self._send_file_chunked
+            else:
+                target = None
+            if target:
+                threading.Thread(target=target, args=(to, path), daemon=True).start()
+                return
+        # small file (or old server): one FILE message, base64 in JSON
         with open(path, "rb") as f:
             raw = f.read()
+        if self._serialization == SERIALIZATION_MSGPACK:
+            # MessagePack carries the bytes as they are
+            self._send(
+                {
+                    "type": "FILE",
+                    "to": to,
+                    "from": self.username,
+                    "filename": path.name,
+                    "data": raw,
+                }
+            )
+            return
         b64 = base64.b64encode(raw).decode()
-        payload = json.dumps(
-            {
-                "type": "FILE",
-                "to": to,
-                "from": self.username,
-                "filename": path.name,
-                "data": b64,
-            }
-        )
-        self.client.sendall(payload.encode())
+        header = {"type": "FILE", "to": to, "from": self.username}
+        self._send_relayed(header, {"filename": path.name, "data": b64})
+
+    def _send_file_chunked(self, to: str, path: Path):
+        """Stream a file in CHUNK_SIZE binary frames, WINDOW_CHUNKS in flight.
+
+        Runs on its own thread. The receiver answers FILE_BEGIN with the
+        offset it already has, so sending the same file again after a
+        reconnect resumes instead of starting over.
+        """
+        size = path.stat().st_size
+        sha256 = file_sha256(path)
+        transfer_id = transfer_id_for(sha256, self.username, to)
+        transfer = OutgoingTransfer(transfer_id, to, path, size, sha256)
+        self._outgoing[transfer_id] = transfer
+        try:
+            self._send(
+                {
+                    "type": "FILE_BEGIN",
+                    "transfer_id": transfer_id,
+                    "to": to,
+                    "from": self.username,
+                    "filename": path.name,
+                    "size": size,
+                    "chunk_size": CHUNK_SIZE,
+                    "sha256": sha256,
+                }
+            )
+            self._stream_file(
+                transfer,
+                lambda offset, data: {
+                    "type": "FILE_CHUNK",
+                    "transfer_id": transfer_id,
+                    "to": to,
+                    "offset": offset,
+                    "crc32": zlib.crc32(data),
+                    "data": data,
+                },
+                {"type": "FILE_END", "transfer_id": transfer_id, "to": to},
+            )
+        except OSError as e:
+            transfer.finish(str(e))
+        finally:
+            self._outgoing.pop(transfer_id, None)
+
+        if transfer.error:
+            self.fileTransferFailed.emit(to, path.name, transfer.error)
+        else:
+            self.fileProgress.emit(to, path.name, size, size)
+
+    def _stream_file(self, transfer, make_chunk, end):
+        """Send transfer.path from wherever the other side asks, then `end`"""
+        with open(transfer.path, "rb") as f:
+            while True:
+                offset = transfer.wait_for_window()
+                if offset is None:
+                    break
+                if offset >= transfer.size:
+                    self._send(end)
+                    transfer.wait_done()
+                    break
+                f.seek(offset)
+                data = f.read(CHUNK_SIZE)
+                with transfer.cond:
+                    if transfer.next_offset != offset:
+                        continue  # receiver asked for a rewind meanwhile
+                    transfer.next_offset = offset + len(data)
+                self._send(make_chunk(offset, data))
+
+    def _upload_blob(self, to: str, path: Path):
+        """Offer a file to the server's blob store, uploading only if needed.
+
+        Runs on its own thread. The server answers BLOB_HAVE when it already
+        stores the content (nothing is sent), or BLOB_UPLOAD with the offset
+        to continue from. Either way `to` gets a FILE_REF once it is stored.
+        """
+        size = path.stat().st_size
+        sha256 = file_sha256(path)
+        offer = {
+            "type": "BLOB_OFFER",
+            "to": to,
+            "sha256": sha256,
+            "size": size,
+            "filename": path.name,
+        }
+        if sha256 in self._uploads:
+            # already uploading it: the server adds this recipient
+            self._send(offer)
+            return
+        transfer = OutgoingTransfer(sha256, to, path, size, sha256)
+        self._uploads[sha256] = transfer
+        try:
+            self._send(offer)
+            self._stream_file(
+                transfer,
+                lambda offset, data: {
+                    "type": "BLOB_CHUNK",
+                    "sha256": sha256,
+                    "offset": offset,
+                    "data": data,
+                },
+                {"type": "BLOB_END", "sha256": sha256},
+            )
+        except OSError as e:
+            transfer.finish(str(e))
+        finally:
+            self._uploads.pop(sha256, None)
+
+        if transfer.error:
+            self.fileTransferFailed.emit(to, path.name, transfer.error)
+        else:
+            self.fileProgress.emit(to, path.name, size, size)
+
+    def _start_blob_download(self, ref):
+        download = self._downloads.get(ref["sha256"])
+        if download:
+            # same content already on its way
+            download.copies.append((ref["from"], ref["filename"]))
+            return
+        download = BlobDownload(ref, self.download_dir)
+        self._downloads[download.sha256] = download
+        self._request_blob_ranges(download)
+
+    def _request_blob_ranges(self, download):
+        if download.complete:
+            self._finish_blob_download(download)
+            return
+        for offset, length in download.ranges():
+            self._send(
+                {
+                    "type": "BLOB_GET",
+                    "sha256": download.sha256,
+                    "offset": offset,
+                    "length": length,
+                }
+            )
+
+    def _finish_blob_download(self, download):
+        self._downloads.pop(download.sha256, None)
+        path = download.finish()
+        if path is None:
+            self.fileTransferFailed.emit(
+                download.sender, download.filename, "checksum mismatch"
+            )
+            return
+        self.fileSaved.emit(download.sender, download.filename, str(path))
+        for sender, filename in download.copies:
+            copy = unique_path(self.download_dir, filename)
+            shutil.copyfile(path, copy)
+            self.fileSaved.emit(sender, copy.name, str(copy))
+
+    def _blob_failed(self, sha256, error):
+        transfer = self._uploads.get(sha256)
+        if transfer:
+            transfer.finish(error)
+        download = self._downloads.pop(sha256, None)
+        if download:
+            download.close()
+            self.fileTransferFailed.emit(download.sender, download.filename, error)
+
+    def _handle_blob(self, payload):
+        kind = payload["type"]
+        sha256 = payload.get("sha256")
+
+        # ---- uploader side ----
+        if kind == "BLOB_UPLOAD":
+            transfer = self._uploads.get(sha256)
+            if transfer:
+                transfer.accepted(payload["offset"])
+        elif kind == "BLOB_ACK":
+            transfer = self._uploads.get(sha256)
+            if transfer:
+                transfer.ack(payload["offset"])
+                self.fileProgress.emit(
+                    transfer.to, transfer.path.name, payload["offset"], transfer.size
+                )
+        elif kind == "BLOB_HAVE":
+            transfer = self._uploads.get(sha256)
+            if transfer:
+                transfer.finish()
+        elif kind == "BLOB_STORED":
+            transfer = self._uploads.get(sha256)
+            if transfer:
+                transfer.finish(None if payload.get("ok") else payload.get("error"))
+
+        # ---- downloader side ----
+        elif kind == "BLOB_DATA":
+            download = self._downloads.get(sha256)
+            if download is None:
+                return
+            # no crc32: served straight from disk, checked by sha256 at the end
+            if download.write(payload["offset"], payload["data"]):
+                if download.should_ack():
+                    self.fileProgress.emit(
+                        download.sender, download.filename, download.offset, download.size
+                    )
+            elif download.should_rewind():
+                download.rewind()
+            self._request_blob_ranges(download)
+
+    def _handle_file_transfer(self, payload):
+        kind = payload["type"]
+        transfer_id = payload.get("transfer_id")
+        sender = payload.get("from")
+
+        # ---- receiver side ----
+        if kind == "FILE_BEGIN":
+            old = self._incoming.pop(transfer_id, None)
+            if old:
+                old.close()
+            incoming = IncomingTransfer(payload, self.download_dir)
+            self._incoming[transfer_id] = incoming
+            self._send(
+                {
+                    "type": "FILE_ACCEPT",
+                    "transfer_id": transfer_id,
+                    "to": sender,
+                    "offset": incoming.offset,
+                }
+            )
+        elif kind == "FILE_CHUNK":
+            incoming = self._incoming.get(transfer_id)
+            if incoming is None:
+                return
+            if incoming.write(payload["offset"], payload["data"], payload["crc32"]):
+                if incoming.should_ack():
+                    self._send(
+                        {
+                            "type": "FILE_ACK",
+                            "transfer_id": transfer_id,
+                            "to": sender,
+                            "offset": incoming.offset,
+                        }
+                    )
+                    self.fileProgress.emit(
+                        sender, incoming.filename, incoming.offset, incoming.size
+                    )
+            elif incoming.should_rewind():
+                self._send(
+                    {
+                        "type": "FILE_ACCEPT",
+                        "transfer_id": transfer_id,
+                        "to": sender,
+                        "offset": incoming.offset,
+                    }
+                )
+        elif kind == "FILE_END":
+            incoming = self._incoming.pop(transfer_id, None)
+            if incoming is None:
+                return
+            path = incoming.finish()
+            done = {"type": "FILE_DONE", "transfer_id": transfer_id, "to": sender}
+            if path:
+                self._send({**done, "ok": True})
+                self.fileSaved.emit(sender, incoming.filename, str(path))
+            else:
+                error = "checksum mismatch"
+                self._send({**done, "ok": False, "error": error})
+                self.fileTransferFailed.emit(sender, incoming.filename, error)
+
+        # ---- sender side ----
+        elif kind == "FILE_ACCEPT":
+            transfer = self._outgoing.get(transfer_id)
+            if transfer:
+                transfer.accepted(payload["offset"])
+        elif kind == "FILE_ACK":
+            transfer = self._outgoing.get(transfer_id)
+            if transfer:
+                transfer.ack(payload["offset"])
+                self.fileProgress.emit(
+                    transfer.to, transfer.path.name, payload["offset"], transfer.size
+                )
+        elif kind == "FILE_DONE":
+            transfer = self._outgoing.get(transfer_id)
+            if transfer:
+                transfer.finish(None if payload.get("ok") else payload.get("error"))
+
+        elif kind == "FILE_CANCEL":
+            transfer = self._outgoing.get(transfer_id)
+            if transfer:
+                transfer.finish("cancelled")
+            incoming = self._incoming.pop(transfer_id, None)
+            if incoming:
+                incoming.close()
+
+    def _reject_transfer(self, payload, error):
+        transfer_id = payload.get("transfer_id")
+        sender = payload.get("from")
+        if not isinstance(transfer_id, str):
+            return  # nothing to match it to
+        filename = payload.get("filename")
+        incoming = self._incoming.pop(transfer_id, None)
+        if incoming:
+            filename = incoming.filename
+            incoming.close()
+        transfer = self._outgoing.get(transfer_id)
+        if transfer:
+            filename = transfer.path.name
+            transfer.finish(error)
+        if isinstance(sender, str):
+            self._send(
+                {"type": "FILE_CANCEL", "transfer_id": transfer_id, "to": sender}
+            )
+        self.fileTransferFailed.emit(str(sender), str(filename or ""), error)
 
     def gui_ready(self):
         """
@@ -168,70 +795,47 @@ class ChatClient(QObject):
 
     # ========== WebRTC signaling senders ==========
     def send_rtc_offer(self, to: str, sdp: str):
-        payload = json.dumps(
-            {
-                "type": "RTC_OFFER",
-                "to": to,
-                "from": self.username,
-                "sdp": sdp,
-            }
-        )
-        self.client.sendall(payload.encode())
+        header = {"type": "RTC_OFFER", "to": to, "from": self.username}
+        self._send_relayed(header, {"sdp": sdp})
 
     def send_rtc_answer(self, to: str, sdp: str):
-        payload = json.dumps(
-            {
-                "type": "RTC_ANSWER",
-                "to": to,
-                "from": self.username,
-                "sdp": sdp,
-            }
-        )
-        self.client.sendall(payload.encode())
+        header = {"type": "RTC_ANSWER", "to": to, "from": self.username}
+        self._send_relayed(header, {"sdp": sdp})
 
     def send_rtc_ice(self, to: str, candidate: dict):
-        payload = json.dumps(
-            {
-                "type": "RTC_ICE",
-                "to": to,
-                "from": self.username,
-                "candidate": candidate,
-            }
-        )
-        self.client.sendall(payload.encode())
+        header = {"type": "RTC_ICE", "to": to, "from": self.username}
+        self._send_relayed(header, {"candidate": candidate})
 
     def send_rtc_end(self, to: str):
-        payload = json.dumps(
-            {
-                "type": "RTC_END",
-                "to": to,
-                "from": self.username,
-            }
-        )
-        self.client.sendall(payload.encode())
+        payload = {
+            "type": "RTC_END",
+            "to": to,
+            "from": self.username,
+        }
+        self._send(payload)
 
     def create_group(self, group_name, members):
-        payload = json.dumps({
+        payload = {
             "type": "CREATE_GROUP",
             "group_name": group_name,
             "members": members
-        })
-        self.client.sendall(payload.encode())
+        }
+        self._send(payload)
         print("📤 Sending CREATE_GROUP:", payload)
 
     def send_group_message(self, group_name, msg):
-        payload = json.dumps({
+        payload = {
             "type": "GROUP_MESSAGE",
             "group_name": group_name,
             "from": self.username,
             "message": msg
-        })
-        self.client.sendall(payload.encode())
+        }
+        self._send(payload)
 
     def join_group(self, group_name):
-        payload = json.dumps({
+        payload = {
             "type": "JOIN_GROUP",
             "username": self.username,
             "group_name": group_name
-        })
-        self.client.sendall(payload.encode())
+        }
+        self._send(payload)
@@ -0,0 +1,207 @@
+# This file holds the state of chunked file transfers (FILE_BEGIN /
+# FILE_CHUNK / FILE_END) and of blob-store downloads (FILE_REF / BLOB_GET).
+# It only touches the disk; ChatClient does the sending and emits the Qt
+# signals.
+
+import hashlib
+import os
+import re
+import threading
+import zlib
+from pathlib import Path
+
+CHUNK_SIZE = 64 * 1024
+WINDOW_CHUNKS = 8  # unacknowledged chunks allowed in flight
+ACK_EVERY_CHUNKS = 4
+SMALL_FILE_LIMIT = 256 * 1024  # up to this size a single FILE is fine
+ACK_TIMEOUT = 30.0
+BLOB_RANGE = 1024 * 1024  # bytes per BLOB_GET
+BLOB_RANGES_IN_FLIGHT = 4
+TRANSFER_ID = re.compile(r"[0-9a-f]{1,64}")
+
+
+def file_sha256(path, block_size=1024 * 1024):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def transfer_id_for(sha256, sender, recipient):
+    """Same file to the same user -> same id, so a re-send resumes"""
+    return hashlib.sha256(f"{sha256}:{sender}:{recipient}".encode()).hexdigest()[:32]
+
+
+def unique_path(directory, filename):
+    path = Path(directory) / Path(filename).name
+    stem, suffix = path.stem, path.suffix
+    n = 1
+    while path.exists():
+        path = path.with_name(f"{stem} ({n}){suffix}")
+        n += 1
+    return path
+
+
+class OutgoingTransfer:
+    """Sender side: window bookkeeping shared with the listening thread"""
+
+    def __init__(self, transfer_id, to, path, size, sha256):
+        self.transfer_id = transfer_id
+        self.to = to
+        self.path = Path(path)
+        self.size = size
+        self.sha256 = sha256
+        self.cond = threading.Condition()
+        self.next_offset = None  # set by FILE_ACCEPT
+        self.acked = 0
+        self.done = False
+        self.error = None
+
+    def accepted(self, offset):
+        """FILE_ACCEPT: start (or rewind) sending at `offset`"""
+        with self.cond:
+            self.next_offset = offset
+            self.acked = offset
+            self.cond.notify_all()
+
+    def ack(self, offset):
+        with self.cond:
+            self.acked = max(self.acked, offset)
+            self.cond.notify_all()
+
+    def finish(self, error=None):
+        with self.cond:
+            self.done = True
+            self.error = error
+            self.cond.notify_all()
+
+    def wait_for_window(self):
+        """Block until a chunk may be sent; returns its offset or None"""
+        with self.cond:
+            ok = self.cond.wait_for(
+                lambda: self.done
+                or (
+                    self.next_offset is not None
+                    and self.next_offset - self.acked < WINDOW_CHUNKS * CHUNK_SIZE
+                ),
+                timeout=ACK_TIMEOUT,
+            )
+            if not ok:
+                self.done, self.error = True, "timed out waiting for receiver"
+            if self.done:
+                return None
+            return self.next_offset
+
+    def wait_done(self):
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.done, timeout=ACK_TIMEOUT):
+                self.done, self.error = True, "timed out waiting for receiver"
+            return self.error
+
+
+class IncomingTransfer:
+    """Receiver side: appends chunks to a .part file that survives reconnects"""
+
+    def __init__(self, begin, download_dir):
+        if not TRANSFER_ID.fullmatch(begin["transfer_id"]):
+            raise ValueError("bad transfer_id")  # it names a file on disk
+        self.transfer_id = begin["transfer_id"]
+        self.sender = begin["from"]
+        self.filename = Path(begin["filename"]).name
+        self.size = begin["size"]
+        self.chunk_size = begin.get("chunk_size", CHUNK_SIZE)
+        self.sha256 = begin["sha256"]
+        self.download_dir = Path(download_dir)
+        partial_dir = self.download_dir / ".partial"
+        partial_dir.mkdir(parents=True, exist_ok=True)
+        self.partial_path = partial_dir / f"{self.transfer_id}.part"
+        # resume on a chunk boundary; a torn last chunk is dropped
+        self.offset = 0
+        if self.partial_path.exists():
+            have = self.partial_path.stat().st_size
+            self.offset = min(have - have % self.chunk_size, self.size)
+        self._file = open(self.partial_path, "r+b" if self.offset else "wb")
+        self._file.truncate(self.offset)
+        self._file.seek(self.offset)
+        self._chunks_since_ack = 0
+        self._rewound_at = None
+
+    def write(self, offset, data, crc32=None):
+        """Append one chunk; False if it is not the one expected"""
+        if offset != self.offset or (crc32 is not None and zlib.crc32(data) != crc32):
+            return False
+        self._file.write(data)
+        self.offset += len(data)
+        self._chunks_since_ack += 1
+        return True
+
+    def should_rewind(self):
+        """After a rejected chunk: ask the sender to rewind, once per offset"""
+        if self._rewound_at == self.offset:
+            return False
+        self._rewound_at = self.offset
+        return True
+
+    def should_ack(self):
+        if self._chunks_since_ack >= ACK_EVERY_CHUNKS:
+            self._chunks_since_ack = 0
+            return True
+        return False
+
+    def finish(self):
+        """Verify the whole file and move it into download_dir"""
+        self._file.close()
+        if self.offset != self.size or file_sha256(self.partial_path) != self.sha256:
+            os.remove(self.partial_path)
+            return None
+        path = unique_path(self.download_dir, self.filename)
+        os.replace(self.partial_path, path)
+        return path
+
+    def close(self):
+        """Stop without deleting, so the next FILE_BEGIN can resume"""
+        self._file.close()
+
+
+class BlobDownload(IncomingTransfer):
+    """Receiver side of a FILE_REF: pulls the blob in BLOB_GET ranges.
+
+    The partial file is named after the blob, so a reconnect (or the same
+    file arriving again) resumes where the last download stopped.
+    """
+
+    def __init__(self, ref, download_dir):
+        super().__init__(
+            {
+                "transfer_id": ref["sha256"],
+                "from": ref["from"],
+                "filename": ref["filename"],
+                "size": ref["size"],
+                "chunk_size": BLOB_RANGE,
+                "sha256": ref["sha256"],
+            },
+            download_dir,
+        )
+        self.next_request = self.offset
+        self.copies = []  # (sender, filename) of later refs to the same blob
+
+    @property
+    def complete(self):
+        return self.offset >= self.size
+
+    def ranges(self):
+        """(offset, length) pairs to request so BLOB_RANGES_IN_FLIGHT are out"""
+        ranges = []
+        while (
+            self.next_request < self.size
+            and self.next_request - self.offset < BLOB_RANGES_IN_FLIGHT * BLOB_RANGE
+        ):
+            length = min(BLOB_RANGE, self.size - self.next_request)
+            ranges.append((self.next_request, length))
+            self.next_request += length
+        return ranges
+
+    def rewind(self):
+        """Re-request everything after the last good byte"""
+        self.next_request = self.offset
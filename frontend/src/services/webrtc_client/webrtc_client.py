@@ -7,6 +7,7 @@ from aiortc import (
     RTCConfiguration,
     RTCIceServer,
 )
+from aiortc.sdp import candidate_from_sdp, candidate_to_sdp
 from av import VideoFrame, AudioFrame
 from aiortc.mediastreams import AudioStreamTrack
 import traceback
@@ -22,6 +23,13 @@ class WebRTCClient(QObject):
     Usage:
     - Initiator: call start_call(target_username)
     - Receiver: call accept_offer(caller_username, sdp)
+
+    Trickle ICE: the offer and answer go out as soon as they are created,
+    without candidates, and each side gathers its candidates while the
+    other is already working on the SDP. aiortc gathers them all in
+    setLocalDescription(); they follow as RTC_ICE, then an empty
+    "candidate" for end-of-candidates. Remote candidates that arrive
+    before the description they belong to wait in _pending_ice.
     """
 
     localFrame = Signal(object)  # numpy ndarray (RGB)
@@ -46,6 +54,9 @@ class WebRTCClient(QObject):
         self._camera_enabled = True
         self._microphone_enabled = True
         self._track_tasks: set[asyncio.Task] = set()
+        self._pending_ice: dict[str, list] = {}  # from_username -> candidates
+        self._local_described: Optional[asyncio.Event] = None
+        self._ice_lock = asyncio.Lock()  # remote candidates go in in order
 
         self._rtc_config = RTCConfiguration(
             iceServers=(
@@ -59,6 +70,7 @@ class WebRTCClient(QObject):
 
         # hook signaling from ChatClient
         self.chat_client.rtcAnswerReceived.connect(self._on_rtc_answer)
+        self.chat_client.rtcIceReceived.connect(self._on_rtc_ice)
         self.chat_client.rtcEndReceived.connect(self._on_rtc_end)
 
         # emit local preview from capture thread via timer-ish approach
@@ -116,6 +128,7 @@ class WebRTCClient(QObject):
     def _ensure_pc(self):
         if self.pc is None:
             self.pc = RTCPeerConnection(self._rtc_config)
+            self._local_described = asyncio.Event()
 
             @self.pc.on("track")
             async def on_track(track):
@@ -222,7 +235,6 @@ class WebRTCClient(QObject):
                 print(f"  Track {i}: {sender.track.kind}")
 
         offer = await self.pc.createOffer()
-        await self.pc.setLocalDescription(offer)
 
         # Log SDP for debugging
         print("📋 Local SDP Offer:")
@@ -231,10 +243,11 @@ class WebRTCClient(QObject):
         for line in audio_lines[:5]:  # Show first 5 relevant lines
             print(f"  {line}")
 
-        # wait for ICE gathering to complete
-        await self._wait_ice_gathering_complete(self.pc)
-        # send offer
-        self.chat_client.send_rtc_offer(self._partner, self.pc.localDescription.sdp)
+        # send offer before gathering; candidates follow as RTC_ICE
+        self.chat_client.send_rtc_offer(self._partner, offer.sdp)
+        await self.pc.setLocalDescription(offer)
+        self._local_described.set()
+        self._send_local_candidates()
 
     async def _accept_offer_async(self, sdp: str):
         self._ensure_pc()
@@ -250,8 +263,8 @@ class WebRTCClient(QObject):
 
         offer = RTCSessionDescription(sdp=sdp, type="offer")
         await self.pc.setRemoteDescription(offer)
+        await self._add_pending_ice()
         answer = await self.pc.createAnswer()
-        await self.pc.setLocalDescription(answer)
 
         # Log answer SDP
         print("📋 Local SDP Answer:")
@@ -260,19 +273,69 @@ class WebRTCClient(QObject):
         for line in audio_lines[:5]:  # Show first 5 relevant lines
             print(f"  {line}")
 
-        await self._wait_ice_gathering_complete(self.pc)
-        # send answer
+        # send answer before gathering; candidates follow as RTC_ICE
         if self._partner:
-            self.chat_client.send_rtc_answer(
-                self._partner, self.pc.localDescription.sdp
-            )
+            self.chat_client.send_rtc_answer(self._partner, answer.sdp)
+        await self.pc.setLocalDescription(answer)
+        self._local_described.set()
+        self._send_local_candidates()
 
     async def _set_remote_answer_async(self, sdp: str):
         if not self.pc:
             # answer without existing pc: ignore
             return
+        # the answer can overtake our own gathering
+        pc = self.pc
+        await self._local_described.wait()
+        if pc is not self.pc or pc.signalingState != "have-local-offer":
+            return  # call ended meanwhile
         answer = RTCSessionDescription(sdp=sdp, type="answer")
         await self.pc.setRemoteDescription(answer)
+        await self._add_pending_ice()
+
+    def _send_local_candidates(self):
+        """Trickle the gathered candidates to the partner, one transport each"""
+        if not (self.pc and self._partner):
+            return
+        gatherers = set()
+        for index, transceiver in enumerate(self.pc.getTransceivers()):
+            gatherer = transceiver.sender.transport.transport.iceGatherer
+            if id(gatherer) in gatherers:
+                continue  # bundled onto an earlier transport
+            gatherers.add(id(gatherer))
+            for candidate in gatherer.getLocalCandidates():
+                self.chat_client.send_rtc_ice(
+                    self._partner,
+                    {
+                        "candidate": "candidate:" + candidate_to_sdp(candidate),
+                        "sdpMid": transceiver.mid,
+                        "sdpMLineIndex": index,
+                    },
+                )
+            self.chat_client.send_rtc_ice(
+                self._partner,
+                {"candidate": "", "sdpMid": transceiver.mid, "sdpMLineIndex": index},
+            )
+
+    async def _add_remote_ice_async(self, from_user: str, candidate: dict):
+        self._pending_ice.setdefault(from_user, []).append(candidate)
+        if self.pc and self.pc.remoteDescription and from_user == self._partner:
+            await self._add_pending_ice()
+
+    async def _add_pending_ice(self):
+        async with self._ice_lock:
+            for candidate in self._pending_ice.pop(self._partner, []):
+                line = candidate.get("candidate")
+                if line:
+                    ice = candidate_from_sdp(line.split(":", 1)[1])
+                    ice.sdpMid = candidate.get("sdpMid")
+                    ice.sdpMLineIndex = candidate.get("sdpMLineIndex")
+                else:
+                    ice = None  # end-of-candidates
+                try:
+                    await self.pc.addIceCandidate(ice)
+                except Exception as e:
+                    print(f"⚠️ Bad ICE candidate from {self._partner}: {e}")
 
     async def _consume_remote_video_track(self, track):
         try:
@@ -410,31 +473,23 @@ class WebRTCClient(QObject):
         self._audio_track = None
 
         self._partner = None
+        self._pending_ice.clear()
+        if self._local_described is not None:
+            self._local_described.set()  # release a waiting answer
         self.callEnded.emit()
 
-    async def _wait_ice_gathering_complete(
-        self, pc: RTCPeerConnection, timeout: float = 5.0
-    ):
-        if pc.iceGatheringState == "complete":
-            return
-        done = asyncio.Event()
-
-        @pc.on("icegatheringstatechange")
-        async def on_state_change():
-            if pc.iceGatheringState == "complete":
-                done.set()
-
-        try:
-            await asyncio.wait_for(done.wait(), timeout=timeout)
-        except asyncio.TimeoutError:
-            pass
-
     # ========== ChatClient signaling handlers ==========
     def _on_rtc_answer(self, from_user: str, sdp: str):
         # only accept answer from current partner
         if self._partner and from_user == self._partner:
             self.set_remote_answer(sdp)
 
+    def _on_rtc_ice(self, from_user: str, candidate: dict):
+        # may come before the call is accepted; kept until it is
+        asyncio.run_coroutine_threadsafe(
+            self._add_remote_ice_async(from_user, candidate), self._loop
+        )
+
     def _on_rtc_end(self, from_user: str):
         if self._partner and from_user == self._partner:
             self.end_call()
@@ -1,9 +1,25 @@
-# This file provides a utility function to parse a stream of data
-# that may contain multiple concatenated JSON objects.
+# This file provides utilities to parse the stream of data sent by the
+# server: the legacy format (multiple concatenated JSON objects) and the
+# length-prefixed frames negotiated at LOGIN.
 
 import json
+import re
+import struct
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 decoder = json.JSONDecoder()
+WHITESPACE = re.compile(r"\s*")
+
 
 def ParseStream(buffer):
     while buffer:
@@ -13,4 +29,275 @@ def ParseStream(buffer):
             buffer = buffer[idx:].lstrip()
         except json.JSONDecodeError:
             break
-    return buffer
\ No newline at end of file
+    return buffer
+
+
+# Wire formats. Every connection starts in FRAMING_JSON (concatenated JSON
+# objects, all an old server speaks). LOGIN offers SUPPORTED_FRAMINGS and
+# LOGIN_OK names the one the server picked; after it each message is
+# HEADER + body.
+FRAMING_JSON = "json"
+FRAMING_LENGTH = "length"
+SUPPORTED_FRAMINGS = (FRAMING_LENGTH, FRAMING_JSON)  # in order of preference
+
+# 4-byte big-endian body length, 1 flags byte
+HEADER = struct.Struct("!IB")
+MAX_FRAME_SIZE = 256 * 1024 * 1024
+
+# FLAG_BINARY: the body is a JSON header (length-prefixed) followed by raw
+# bytes, which decode into the header's "data" key. Lets FILE_CHUNK carry
+# file contents without base64.
+FLAG_BINARY = 0x01
+BINARY_HEADER = struct.Struct("!I")
+
+# FLAG_RELAY: the same layout, but the bytes after the header are a JSON
+# object with the rest of the message, which the server forwards without
+# parsing. Sent when a payload has "body" bytes; received frames are merged
+# back into one message.
+FLAG_RELAY = 0x02
+
+# Compression of large frames, offered at LOGIN as SUPPORTED_CODECS; the
+# server names the codec it picked in LOGIN_OK. Frames of at least
+# COMPRESS_THRESHOLD bytes are compressed when that makes them smaller and
+# carry the codec's flag, which is all the decoder looks at.
+FLAG_ZLIB = 0x04
+FLAG_ZSTD = 0x08
+COMPRESS_THRESHOLD = 1024
+
+# Frame body serialization, offered at LOGIN as SUPPORTED_SERIALIZATIONS
+# when the optional msgpack package is installed. MessagePack frames carry
+# FLAG_MSGPACK and hold bytes natively, so FILE data needs no base64.
+SERIALIZATION_JSON = "json"
+SERIALIZATION_MSGPACK = "msgpack"
+FLAG_MSGPACK = 0x10
+SUPPORTED_SERIALIZATIONS = (SERIALIZATION_JSON,)
+if msgpack is not None:
+    SUPPORTED_SERIALIZATIONS = (SERIALIZATION_MSGPACK, SERIALIZATION_JSON)
+
+
+class FrameError(ValueError):
+    pass
+
+
+def _zlib_decompress(data, limit):
+    d = zlib.decompressobj()
+    out = d.decompress(data, limit + 1)
+    if len(out) > limit or d.unconsumed_tail:
+        raise FrameError(f"compressed frame exceeds {limit} bytes")
+    return out
+
+
+def _zstd_decompress(data, limit):
+    size = zstandard.frame_content_size(data)
+    if size < 0 or size > limit:
+        raise FrameError(f"compressed frame exceeds {limit} bytes")
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+# codec name -> (frame flag, compress(bytes), decompress(bytes, limit))
+CODECS = {"zlib": (FLAG_ZLIB, zlib.compress, _zlib_decompress)}
+if zstandard is not None:
+    CODECS["zstd"] = (
+        FLAG_ZSTD,
+        lambda data: zstandard.ZstdCompressor().compress(data),
+        _zstd_decompress,
+    )
+SUPPORTED_CODECS = tuple(c for c in ("zstd", "zlib") if c in CODECS)
+
+# Priority lanes for outbound frames. A writer sends whatever waits in a
+# lower-numbered lane before the next frame of a higher one, so call setup
+# and presence never queue behind a file transfer. Frames are atomic on the
+# wire, so bulk data is preempted between chunks; the order within a lane
+# is kept (FILE_END and BLOB_END follow their chunks).
+LANE_SIGNAL = 0
+LANE_CHAT = 1
+LANE_BULK = 2
+SIGNAL_TYPES = {
+    "RTC_OFFER",
+    "RTC_ANSWER",
+    "RTC_ICE",
+    "RTC_END",
+    "PRESENCE_DELTA",
+    "PRESENCE_SNAPSHOT",
+    "PRESENCE_SUBSCRIBE",
+    "PRESENCE_UNSUBSCRIBE",
+    "USERS",
+    "PING",
+    "PONG",
+    "ACK",
+}
+BULK_TYPES = {
+    "FILE",
+    "FILE_BEGIN",
+    "FILE_CHUNK",
+    "FILE_END",
+    "BLOB_CHUNK",
+    "BLOB_END",
+    "BLOB_DATA",
+}
+
+
+def lane_for(msg_type):
+    if msg_type in SIGNAL_TYPES:
+        return LANE_SIGNAL
+    if msg_type in BULK_TYPES:
+        return LANE_BULK
+    return LANE_CHAT
+
+
+def encode_frame(body, flags=0, codec=None):
+    if codec is not None and len(body) >= COMPRESS_THRESHOLD:
+        flag, compress, _ = CODECS[codec]
+        packed = compress(body)
+        if len(packed) < len(body):
+            body = packed
+            flags |= flag
+    return HEADER.pack(len(body), flags) + body
+
+
+def encode_message(
+    payload, framing=FRAMING_JSON, codec=None, serialization=SERIALIZATION_JSON
+):
+    body = payload.get("body")
+    if framing == FRAMING_LENGTH and isinstance(body, bytes):
+        header = json.dumps({k: v for k, v in payload.items() if k != "body"}).encode()
+        return encode_frame(
+            BINARY_HEADER.pack(len(header)) + header + body, FLAG_RELAY, codec
+        )
+    if framing == FRAMING_LENGTH and serialization == SERIALIZATION_MSGPACK:
+        return encode_frame(msgpack.packb(payload), FLAG_MSGPACK, codec)
+    data = payload.get("data")
+    if framing == FRAMING_LENGTH and isinstance(data, (bytes, bytearray, memoryview)):
+        header = json.dumps({k: v for k, v in payload.items() if k != "data"}).encode()
+        return encode_frame(
+            BINARY_HEADER.pack(len(header)) + header + data, FLAG_BINARY
+        )
+    body = json.dumps(payload).encode()
+    if framing == FRAMING_LENGTH:
+        return encode_frame(body, 0, codec)
+    return body
+
+
+class StreamDecoder:
+    """Incremental decoder for a client byte stream.
+
+    Bytes are appended to one bytearray and consumed from a read offset, so
+    a message split across recv() calls is kept until the rest arrives.
+    `mode` may change between messages (after LOGIN negotiates framing);
+    whatever is still buffered is then read in the new mode.
+
+    FRAMING_LENGTH costs O(message): the header says when a body is complete
+    and the body is parsed once. FRAMING_JSON only re-parses when a chunk
+    ends in "}", so a multi-MB object is not re-decoded on every recv().
+    """
+
+    def __init__(self, mode=FRAMING_JSON, max_frame_size=MAX_FRAME_SIZE):
+        self.mode = mode
+        self.max_frame_size = max_frame_size
+        self._buf = bytearray()
+        self._pos = 0
+        # FRAMING_JSON: buffered bytes decoded once, and the char offset
+        # that corresponds to self._pos
+        self._text = None
+        self._text_idx = 0
+        self._json_ready = False
+
+    def feed(self, data):
+        self._buf += data
+        self._text = None
+        # a chunk that does not end in "}" cannot complete an object, so
+        # wait for more
+        self._json_ready = data.rstrip()[-1:] == b"}"
+
+    def buffered(self):
+        return len(self._buf) - self._pos
+
+    def __iter__(self):
+        try:
+            while True:
+                if self.mode == FRAMING_LENGTH:
+                    msg = self._next_frame()
+                else:
+                    msg = self._next_json()
+                if msg is None:
+                    return
+                yield msg
+        finally:
+            # compact once per batch instead of once per message
+            if self._pos:
+                del self._buf[: self._pos]
+                self._pos = 0
+
+    def _next_frame(self):
+        self._text = None
+        if len(self._buf) - self._pos < HEADER.size:
+            return None
+        length, flags = HEADER.unpack_from(self._buf, self._pos)
+        if length > self.max_frame_size:
+            raise FrameError(f"frame of {length} bytes exceeds limit")
+        start = self._pos + HEADER.size
+        end = start + length
+        if len(self._buf) < end:
+            return None
+        with memoryview(self._buf) as view:
+            body = view[start:end]
+            if flags & (FLAG_ZLIB | FLAG_ZSTD):
+                body = memoryview(self._decompress(body, flags))
+            if flags & FLAG_MSGPACK:
+                if msgpack is None:
+                    raise FrameError("MessagePack frame, but msgpack is not installed")
+                msg = msgpack.unpackb(body)
+            elif flags & (FLAG_BINARY | FLAG_RELAY):
+                (header_len,) = BINARY_HEADER.unpack_from(body)
+                header_end = BINARY_HEADER.size + header_len
+                msg = json.loads(body[BINARY_HEADER.size : header_end].tobytes())
+                rest = body[header_end:].tobytes()
+                if flags & FLAG_BINARY:
+                    msg["data"] = rest
+                else:
+                    msg = {**json.loads(rest), **msg}
+            else:
+                msg = json.loads(body.tobytes())
+            body.release()
+        self._pos = end
+        return msg
+
+    def _decompress(self, data, flags):
+        for flag, _, decompress in CODECS.values():
+            if flags & flag:
+                try:
+                    return decompress(data, self.max_frame_size)
+                except FrameError:
+                    raise
+                except Exception as e:  # zlib.error, zstandard.ZstdError
+                    raise FrameError(f"bad compressed frame: {e}") from e
+        raise FrameError(f"frame compressed with an unsupported codec ({flags:#x})")
+
+    def _next_json(self):
+        if self._text is None:
+            if not self._json_ready:
+                return None
+            # surrogateescape: binary frames may already follow the last
+            # JSON message (right after LOGIN_OK), and the byte count of
+            # each message must round-trip exactly
+            with memoryview(self._buf) as view:
+                self._text = view[self._pos :].tobytes().decode(
+                    errors="surrogateescape"
+                )
+            self._text_idx = 0
+        text = self._text
+        start = WHITESPACE.match(text, self._text_idx).end()
+        try:
+            obj, end = decoder.raw_decode(text, start)
+        except json.JSONDecodeError:
+            if start == len(text):
+                # only whitespace left
+                self._pos = len(self._buf)
+            elif self.buffered() > self.max_frame_size:
+                raise FrameError("unterminated JSON message exceeds limit")
+            self._text = None
+            self._json_ready = False
+            return None
+        self._pos += len(text[self._text_idx : end].encode(errors="surrogateescape"))
+        self._text_idx = end
+        return obj